@@ -0,0 +1,257 @@
+"""
+Benchmarks for the interrogation pipeline, run against synthetic data for the shop app.
+
+Each interrogation is timed stage by stage:
+
+    parse        - turning columns, filters and ordering into a queryset (including permission checks)
+    compile      - Django compiling the queryset to SQL
+    execute      - running the SQL and fetching the raw rows
+    materialise  - converting the raw rows into dictionaries
+    render_json  - rendering the rows as a JSON response
+
+Pivot tables are timed as a whole. Results are written as JSON so they can be compared across releases.
+
+Usage:
+
+    python -m benchmarks.run --rows 10000 100000 --output bench.json
+
+Datasets are stored in SQLite files in `--data-dir` and reused by later runs with the same number of rows.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.management import call_command  # noqa: E402
+from django.db import connections  # noqa: E402
+from django.http import JsonResponse  # noqa: E402
+
+import data_interrogator  # noqa: E402
+from data_interrogator.interrogators import Allowable, Interrogator, PivotInterrogator  # noqa: E402
+from shop.models import Branch, Product, Sale, SalesPerson  # noqa: E402
+
+# name, base model, columns, filters, order_by
+SCENARIOS = [
+    ('sales_by_seller', 'shop:SalesPerson',
+     ['name', 'sales:=count(sale)', 'revenue:=sum(sale.sale_price)'], [], ['name']),
+    ('profit_by_state', 'shop:SalesPerson',
+     ['branch.state', 'profit:=sum(sale.sale_price - sale.product.cost_price)'], [], ['branch.state']),
+    ('sumif_by_product', 'shop:Product',
+     ['name', 'vic:=sumif(sale.sale_price, sale.state.iexact=VIC)'], [], ['name']),
+    ('filtered_sales', 'shop:Sale',
+     ['id', 'sale_date', 'sale_price', 'product.name', 'seller.name'], ['state = VIC'], ['id']),
+]
+
+# name, base model, columns, aggregators, filters
+PIVOTS = [
+    ('category_by_state', 'shop:Sale', ['product.category', 'seller.branch.state'], ['sum(sale_price)'], []),
+]
+
+
+class BenchmarkInterrogator(Interrogator):
+    # Measure the full pipeline every time
+    use_query_cache = False
+
+
+def use_database(path):
+    connection = connections['default']
+    connection.close()
+    connection.settings_dict['NAME'] = path
+
+
+def generate_data(rows, seed=1):
+    """Fill the shop tables with `rows` sales spread over proportionally sized products, branches and staff"""
+    rng = random.Random(seed)
+    states = [s for s, _ in Branch.states]
+
+    Product.objects.bulk_create([
+        Product(
+            name='Product %d' % i,
+            category=rng.choice([c for c, _ in Product.categories]),
+            cost_price=Decimal(rng.randint(100, 10000)) / 100,
+        )
+        for i in range(max(10, rows // 1000))
+    ])
+    Branch.objects.bulk_create([
+        Branch(name='Branch %d' % i, state=rng.choice(states))
+        for i in range(max(5, rows // 5000))
+    ])
+    # SQLite doesn't return primary keys from bulk_create
+    branches = list(Branch.objects.all())
+    SalesPerson.objects.bulk_create([
+        SalesPerson(name='Seller %d' % i, branch=rng.choice(branches), age=rng.randint(18, 70))
+        for i in range(max(20, rows // 200))
+    ])
+    product_ids = list(Product.objects.values_list('id', flat=True))
+    seller_ids = list(SalesPerson.objects.values_list('id', flat=True))
+
+    start = datetime(2010, 1, 1, tzinfo=timezone.utc)
+    batch_size = 5000
+    for offset in range(0, rows, batch_size):
+        Sale.objects.bulk_create([
+            Sale(
+                product_id=rng.choice(product_ids),
+                seller_id=rng.choice(seller_ids),
+                sale_date=start + timedelta(minutes=rng.randint(0, 10 * 365 * 24 * 60)),
+                sale_price=Decimal(rng.randint(100, 20000)) / 100,
+                state=rng.choice(states),
+            )
+            for _ in range(min(batch_size, rows - offset))
+        ])
+    with connections['default'].cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+
+def prepare_dataset(rows, data_dir):
+    path = os.path.join(data_dir, 'data_interrogator_benchmark_%d.sqlite3' % rows)
+    use_database(path)
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    if Sale.objects.count() != rows:
+        Sale.objects.all().delete()
+        SalesPerson.objects.all().delete()
+        Branch.objects.all().delete()
+        Product.objects.all().delete()
+        generate_data(rows)
+    return path
+
+
+def time_interrogation(base_model, columns, filters, order_by, limit):
+    """Run one interrogation, returning the time spent in each stage and the number of rows"""
+    interrogator = BenchmarkInterrogator(
+        report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[]
+    )
+    timings = {}
+
+    start = time.perf_counter()
+    queryset, errors, output_columns, _ = interrogator.generate_queryset(
+        base_model, columns, filters, order_by, limit=limit
+    )
+    timings['parse'] = time.perf_counter() - start
+    if errors:
+        raise ValueError(errors)
+
+    start = time.perf_counter()
+    query = queryset.query
+    compiler = query.get_compiler(using=queryset.db)
+    sql, params = compiler.as_sql()
+    timings['compile'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        results = cursor.fetchall()
+    timings['execute'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    names = [*query.extra_select, *query.values_select, *query.annotation_select]
+    rows = [dict(zip(names, row)) for row in compiler.results_iter(results=[results])]
+    timings['materialise'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    JsonResponse({'rows': rows, 'count': len(rows), 'columns': output_columns, 'errors': []})
+    timings['render_json'] = time.perf_counter() - start
+
+    return timings, len(rows)
+
+
+def time_pivot(base_model, columns, aggregators, filters):
+    interrogator = PivotInterrogator(aggregators=aggregators)
+    interrogator.use_query_cache = False
+    start = time.perf_counter()
+    data = interrogator.pivot(base_model, columns, filters)
+    elapsed = time.perf_counter() - start
+    if data['errors']:
+        raise ValueError(data['errors'])
+    return {'pivot': elapsed}, len(data['rows'])
+
+
+def summarise(runs):
+    """Reduce repeated timings of each stage to their minimum and median, in milliseconds"""
+    return {
+        stage: {
+            'min_ms': round(min(run[stage] for run in runs) * 1000, 3),
+            'median_ms': round(statistics.median(run[stage] for run in runs) * 1000, 3),
+        }
+        for stage in runs[0]
+    }
+
+
+def run(sizes, repeat, limit, data_dir, only=None):
+    results = []
+    for rows in sizes:
+        started = time.perf_counter()
+        prepare_dataset(rows, data_dir)
+        print('Dataset of %d sales ready in %.1fs' % (rows, time.perf_counter() - started), file=sys.stderr)
+
+        benchmarks = [
+            (name, lambda s=scenario: time_interrogation(*s, limit=limit)) for name, *scenario in SCENARIOS
+        ] + [
+            ('pivot_%s' % name, lambda p=pivot: time_pivot(*p)) for name, *pivot in PIVOTS
+        ]
+        for name, benchmark in benchmarks:
+            if only and name not in only:
+                continue
+            benchmark()  # Warm up connections and caches that aren't under test
+            runs = []
+            for _ in range(repeat):
+                timings, returned = benchmark()
+                runs.append(timings)
+            results.append({
+                'benchmark': name,
+                'dataset_rows': rows,
+                'returned_rows': returned,
+                'repeat': repeat,
+                'stages': summarise(runs),
+            })
+            print('%-24s %10d rows  %s' % (
+                name, rows, '  '.join('%s=%.2fms' % (k, v['median_ms']) for k, v in results[-1]['stages'].items())
+            ), file=sys.stderr)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000], help='Number of sales in each dataset')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs of each benchmark')
+    parser.add_argument('--limit', type=int, default=10000, help='Row limit for each interrogation')
+    parser.add_argument('--data-dir', default=os.path.dirname(connections['default'].settings_dict['NAME']))
+    parser.add_argument('--only', nargs='*', help='Only run the named benchmarks')
+    parser.add_argument('--output', help='File to write JSON results to, defaults to stdout')
+    args = parser.parse_args(argv)
+
+    import sqlite3
+    report = {
+        'data_interrogator': data_interrogator.__version__,
+        'django': django.get_version(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'results': run(args.rows, args.repeat, args.limit, args.data_dir, args.only),
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+"""
+Settings for running benchmarks, these are the test settings with a file based SQLite database
+so that generated datasets can be reused between runs.
+"""
+import os
+import tempfile
+
+from tests.settings import *  # noqa
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(tempfile.gettempdir(), 'data_interrogator_benchmark.sqlite3'),
+    }
+}
+DEBUG = False
@@ -1,8 +1,12 @@
+from django.conf import settings
 from django.contrib.auth.decorators import user_passes_test
+from django.db import NotSupportedError
 from django.utils.decorators import method_decorator
+from django.views.generic import TemplateView
 
 from data_interrogator.admin.forms import AdminInvestigationForm, AdminPivotTableForm
-from data_interrogator.interrogators import Allowable
+from data_interrogator.advisor import advise_from_log
+from data_interrogator.interrogators import Allowable, Interrogator
 from data_interrogator.views import InterrogationView, InterrogationAutocompleteUrls, PivotTableView, \
     InterrogationAutoComplete
 
@@ -28,3 +32,36 @@ class AdminInterrogationAutocompleteUrls(InterrogationAutocompleteUrls):
 class AdminPivotTableView(PivotTableView):
     form_class = AdminPivotTableForm
     template_name = 'admin/analytics/pivot.html'
+
+
+class AdminIndexAdvisorView(TemplateView):
+    """Suggests indexes from the interrogations logged to ``INTERROGATOR_STATS_LOG``"""
+    template_name = 'admin/analytics/index_advisor.html'
+    interrogator_class = Interrogator
+    limit = 1000
+
+    @method_decorator(user_passes_test(lambda u: u.is_superuser))
+    def get(self, request):
+        return super().get(request)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        log = getattr(settings, 'INTERROGATOR_STATS_LOG', None)
+        context['log'] = log
+        if not log:
+            return context
+        try:
+            advisor = advise_from_log(log, self.interrogator_class, limit=self.limit)
+        except (OSError, NotSupportedError) as e:
+            context['error'] = str(e)
+            return context
+        context['advisor'] = advisor
+        context['suggestions'] = [
+            {
+                'suggestion': suggestion,
+                'index': suggestion.as_code(suggestion.index()),
+                'partial_index': suggestion.partial_index() and suggestion.as_code(suggestion.partial_index()),
+            }
+            for suggestion in advisor.suggestions()
+        ]
+        return context
@@ -0,0 +1,294 @@
+"""
+Suggests indexes for the interrogations people actually run.
+
+Interrogations logged by ``data_interrogator.profiling.log_stats`` are replayed: each one's SQL is
+built again and the database's plan is checked for tables read in full. The filters, sorting and
+joins that touch those tables are collected by model, and turned into composite indexes (equality
+filters first, then a range filter or the sort order), or partial indexes when every interrogation
+filtered a column on the same value.
+"""
+import json
+from collections import Counter, OrderedDict, deque
+
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.db import connections, models
+
+from data_interrogator.db import scanned_tables
+from data_interrogator.interrogators import Allowable, clean_filter, math_infix_symbols, normalise_field
+
+# Lookups a B-tree index can answer, either with an exact match or by reading a range of it
+EQUALITY_LOOKUPS = {'exact', 'in', 'isnull'}
+RANGE_LOOKUPS = {'lt', 'lte', 'gt', 'gte', 'range'}
+
+
+def read_stats_log(lines, limit=None) -> list:
+    """
+    Return the last `limit` interrogations from lines written by `log_stats`. Anything
+    before the JSON on each line, such as a timestamp from a log formatter, is ignored.
+    """
+    entries = deque(maxlen=limit)
+    for line in lines:
+        start = line.find('{')
+        if start < 0:
+            continue
+        try:
+            stats = json.loads(line[start:])
+        except ValueError:
+            continue
+        if isinstance(stats, dict) and stats.get('base_model') and stats.get('columns'):
+            entries.append(stats)
+    return list(entries)
+
+
+def resolve_path(model, path):
+    """
+    Follow a lookup path (eg. ``seller__branch__state__in``) from a model. Returns the reverse joins
+    made, as (model, foreign key name) for the model holding the key, and the concrete field the path
+    ends on with the model it belongs to and the lookup used. The field is None if the path
+    doesn't end on a concrete field, such as an annotation.
+    """
+    joins = []
+    parts = path.split('__')
+    for index, part in enumerate(parts):
+        if part == 'pk':
+            part = model._meta.pk.name
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            return joins, None, None, None
+        remaining = parts[index + 1:]
+        if field.is_relation and remaining and is_field(field.related_model, remaining[0]):
+            if not field.concrete and not field.many_to_many:
+                # Following a foreign key backwards looks up rows by the key's column,
+                # forwards joins and through tables use primary keys and indexed columns
+                joins.append((field.related_model, field.field.name))
+            model = field.related_model
+            continue
+        if not field.concrete or field.many_to_many:
+            return joins, None, None, None
+        return joins, model, field, '__'.join(remaining) or 'exact'
+    return joins, None, None, None
+
+
+def is_field(model, name) -> bool:
+    if name == 'pk':
+        return True
+    try:
+        model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return False
+    return True
+
+
+def existing_indexes(model) -> list:
+    """Return the field names of every index on a model, in column order"""
+    opts = model._meta
+    indexes = [[field.name] for field in opts.concrete_fields if field.db_index or field.unique or field.primary_key]
+    indexes.extend([name.lstrip('-') for name in index.fields] for index in opts.indexes if not index.condition)
+    indexes.extend(list(fields) for fields in opts.index_together)
+    indexes.extend(list(fields) for fields in opts.unique_together)
+    return indexes
+
+
+def is_indexed(model, fields) -> bool:
+    """Whether an existing index already starts with these fields"""
+    fields = list(fields)
+    return any(index[:len(fields)] == fields for index in existing_indexes(model))
+
+
+class IndexSuggestion:
+    """An index that would have stopped the database reading a table in full, and the interrogations that wanted it"""
+
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = list(fields)
+        self.count = 0
+        self.reasons = Counter()
+        self.equalities = Counter()
+
+    @property
+    def label(self) -> str:
+        return self.model._meta.label
+
+    def add(self, reasons, equalities):
+        self.count += 1
+        self.reasons.update(set(reasons))
+        self.equalities.update(set(equalities))
+
+    def index(self) -> models.Index:
+        index = models.Index(fields=self.fields)
+        index.set_name_with_model(self.model)
+        return index
+
+    @property
+    def condition(self):
+        """A (field, value) every interrogation filtered on exactly, if the index has other columns to cover"""
+        if len(self.fields) < 2:
+            return None
+        for (field, value), count in self.equalities.most_common():
+            if count == self.count and field in self.fields:
+                return field, value
+        return None
+
+    def partial_index(self):
+        """The same index restricted to the rows every interrogation asked for, or None"""
+        condition = self.condition
+        if condition is None:
+            return None
+        field, value = condition
+        name = self.index().name
+        return models.Index(
+            fields=[f for f in self.fields if f != field],
+            condition=models.Q(**{field: self.model._meta.get_field(field).to_python(value)}),
+            name=name[:-3] + 'prt',
+        )
+
+    def as_code(self, index) -> str:
+        """Write out an index the way it would be added to the model's ``Meta.indexes``"""
+        args = ['fields=%r' % index.fields]
+        if index.condition is not None:
+            args.append('condition=models.Q(%s)' % ', '.join('%s=%r' % child for child in index.condition.children))
+        args.append('name=%r' % index.name)
+        return 'models.Index(%s)' % ', '.join(args)
+
+
+class IndexAdvisor:
+    """Replays interrogations against a database and collects the indexes that would avoid full table scans"""
+
+    def __init__(self, interrogator_class, using='default'):
+        self.interrogator = interrogator_class(
+            report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[]
+        )
+        self.interrogator.use_rollups = False
+        self.interrogator.database = using
+        self.using = using
+        self.interrogations = 0
+        self.failed = 0
+        self.table_scans = Counter()
+        self.unindexable = Counter()
+        self.candidates = OrderedDict()
+
+    def replay(self, entries):
+        for stats in entries:
+            self.analyse(
+                stats['base_model'], stats.get('columns', []), stats.get('filters', []), stats.get('order_by', [])
+            )
+        return self
+
+    def analyse(self, base_model, columns, filters, order_by):
+        try:
+            rows, errors, output_columns, base_model_data = self.interrogator.generate_queryset(
+                base_model, columns, filters, order_by
+            )
+            compiler = rows.query.get_compiler(using=self.using)
+            sql, params = compiler.as_sql()
+        except EmptyResultSet:
+            self.interrogations += 1
+            return
+        except Exception:
+            # eg. the model or a field has gone since the interrogation was logged
+            errors = True
+        if errors:
+            self.failed += 1
+            return
+        self.interrogations += 1
+
+        alias_map = compiler.query.alias_map
+        scanned = {
+            alias_map[name].table_name if name in alias_map else name
+            for name in scanned_tables(connections[self.using], sql, params)
+        }
+        for table in scanned:
+            self.table_scans[table] += 1
+
+        model = self.interrogator.base_model
+        for scanned_model, (fields, reasons, equalities) in self.get_paths(model, columns, filters, order_by).items():
+            if scanned_model._meta.db_table not in scanned:
+                continue
+            self.add(scanned_model, fields, reasons, equalities)
+            scanned.discard(scanned_model._meta.db_table)
+        for table in scanned:
+            self.unindexable[table] += 1
+
+    def add(self, model, fields, reasons, equalities):
+        key = (model._meta.label, tuple(fields))
+        if key not in self.candidates:
+            self.candidates[key] = IndexSuggestion(model, fields)
+        self.candidates[key].add(reasons, equalities)
+
+    def get_paths(self, model, columns, filters, order_by) -> OrderedDict:
+        """
+        Work out which columns of each model an interrogation's filters, sorting and joins use.
+        Returns (index fields, reasons, exact matches) for each model.
+        """
+        paths = OrderedDict()
+
+        def use(target, kind, field_name, reason, equality=None):
+            path = paths.setdefault(target, {'equal': [], 'range': [], 'order': [], 'reasons': [], 'equalities': []})
+            if field_name not in path[kind]:
+                path[kind].append(field_name)
+            path['reasons'].append(reason)
+            if equality is not None:
+                path['equalities'].append(equality)
+
+        def use_joins(joins):
+            for target, field_name in joins:
+                use(target, 'equal', field_name, 'join on %s.%s' % (target._meta.label, field_name))
+
+        for column in columns:
+            if ':=' in column:
+                column = column.split(':=', 1)[1]
+            column = normalise_field(column)
+            if any(s in column for s in math_infix_symbols.keys()):
+                continue
+            joins, target, field, lookup = resolve_path(model, column.split('::')[-1])
+            use_joins(joins)
+
+        for expression in filters:
+            cleaned = clean_filter(normalise_field(expression))
+            if isinstance(cleaned, str) or '::' in cleaned[0]:
+                continue
+            path, lookup, value = cleaned
+            path = path.strip() + lookup
+            if path.endswith('!') or path.endswith('__all'):
+                continue  # Negations and multiple matches aren't helped much by an index
+            joins, target, field, lookup = resolve_path(model, path)
+            use_joins(joins)
+            if field is None:
+                continue
+            reason = 'filter %s' % expression.strip()
+            if lookup in EQUALITY_LOOKUPS:
+                equality = (field.name, value.strip()) if lookup == 'exact' and not value.strip().startswith('~') else None
+                use(target, 'equal', field.name, reason, equality)
+            elif lookup in RANGE_LOOKUPS:
+                use(target, 'range', field.name, reason)
+
+        for column in order_by:
+            column = normalise_field(column).lstrip('-')
+            joins, target, field, lookup = resolve_path(model, column)
+            if field is not None and target is model and lookup == 'exact':
+                use(target, 'order', field.name, 'order by %s' % column.replace('__', '.'))
+
+        result = OrderedDict()
+        for target, path in paths.items():
+            # Exact matches first, then one range, or the ordering if there's no range to read
+            fields = path['equal'] + (path['range'][:1] or path['order'])
+            result[target] = (fields, path['reasons'], path['equalities'])
+        return result
+
+    def suggestions(self, min_count=1) -> list:
+        """Return the suggested indexes that aren't already covered, most wanted first"""
+        return sorted(
+            (
+                suggestion for suggestion in self.candidates.values()
+                if suggestion.count >= min_count and not is_indexed(suggestion.model, suggestion.fields)
+            ),
+            key=lambda suggestion: -suggestion.count
+        )
+
+
+def advise_from_log(path, interrogator_class, using='default', limit=1000) -> IndexAdvisor:
+    """Replay the last `limit` interrogations logged in a file"""
+    with open(path) as log:
+        entries = read_stats_log(log, limit=limit)
+    return IndexAdvisor(interrogator_class, using=using).replay(entries)
@@ -1,6 +1,28 @@
 from django.apps import AppConfig
+from django.core.signals import setting_changed
+from django.db.models.signals import class_prepared, m2m_changed, post_delete, post_save
 
 
 class InterrogatorConfig(AppConfig):
     name = 'data_interrogator'
     verbose_name = "Data Interrogator"
+
+    def ready(self):
+        from data_interrogator import cache, rollups, schema
+
+        # Compiled queries and field indexes hold references to models and fields,
+        # so drop them if the registry changes
+        class_prepared.connect(cache.clear_query_cache, dispatch_uid='data_interrogator_clear_query_cache')
+        setting_changed.connect(
+            cache.clear_query_cache_on_setting_change, dispatch_uid='data_interrogator_query_cache_settings'
+        )
+        class_prepared.connect(schema.clear_schema_indexes, dispatch_uid='data_interrogator_clear_schema_indexes')
+        setting_changed.connect(schema.clear_schema_indexes, dispatch_uid='data_interrogator_schema_settings')
+        setting_changed.connect(rollups.clear_rollups, dispatch_uid='data_interrogator_rollup_settings')
+
+        # Keep rollups up to date as the models they read from change
+        for signal in [post_save, post_delete, m2m_changed]:
+            signal.connect(rollups.track_change, dispatch_uid='data_interrogator_track_rollups')
+
+        # Drop cached results as soon as a model they read from changes
+        cache.connect_invalidation()
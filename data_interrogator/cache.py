@@ -0,0 +1,384 @@
+"""Caches used to avoid re-compiling and re-running repeated interrogations"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from enum import Enum
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.db.models.sql import Query
+
+from data_interrogator.columnar import build_columns, get_column_type, get_output_field
+from data_interrogator.db import estimate_cost, estimate_count, explain, statement_timeout
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LRUCache:
+    """A small thread-safe, bounded, least-recently-used mapping with hit/miss counters"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+
+class LocalResultCache:
+    """
+    An in-process fallback for when no Django cache backend has been chosen for results.
+    Implements the small part of the Django cache API that interrogators need, with per entry expiry.
+    """
+
+    def __init__(self, maxsize=128):
+        self._cache = LRUCache(maxsize=maxsize)
+
+    def get(self, key, default=None):
+        entry = self._cache.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires is not None and expires < time.monotonic():
+            self._cache.delete(key)
+            return default
+        return value
+
+    def get_many(self, keys):
+        missing = object()
+        found = {key: self.get(key, missing) for key in keys}
+        return {key: value for key, value in found.items() if value is not missing}
+
+    def set(self, key, value, timeout=None):
+        expires = None if timeout is None else time.monotonic() + timeout
+        self._cache.set(key, (expires, value))
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is None:
+            self.set(key, value, timeout)
+            return True
+        return False
+
+    def incr(self, key, delta=1):
+        # Read and write under the LRU's lock, so that concurrent increments aren't lost
+        with self._cache._lock:
+            entry = self._cache._data.get(key)
+            if entry is None or entry[0] is not None and entry[0] < time.monotonic():
+                raise ValueError("Key '%s' not found" % key)
+            expires, value = entry
+            self._cache._data[key] = (expires, value + delta)
+            self._cache._data.move_to_end(key)
+            return value + delta
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    def clear(self):
+        self._cache.clear()
+
+
+def freeze(value):
+    """Turn (possibly nested) lists, dicts and sets into something hashable for use in a cache key"""
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(freeze(v) for v in value))
+    if isinstance(value, Enum):
+        return (type(value).__name__, value.name)
+    return value
+
+
+class CompiledQuery:
+    """
+    The SQL and parameters of an interrogation, along with everything needed to turn
+    the raw database rows back into the dictionaries that `QuerySet.values()` would return.
+    """
+
+    def __init__(self, queryset, errors, output_columns, base_model_data):
+        self.errors = errors
+        self.output_columns = output_columns
+        self.base_model_data = base_model_data
+        self.using = queryset.db
+        self.sql, self.params = None, ()
+        self.names = []
+        self.models = get_query_models(queryset.query)
+
+        if errors:
+            # Nothing will be run, so don't bother compiling the query
+            return
+
+        query = queryset.query
+        self.names = [*query.extra_select, *query.values_select, *query.annotation_select]
+        self.table = query.get_meta().db_table
+        self.filtered = bool(query.where) or query.group_by is not None or query.distinct
+        self.compiler = query.get_compiler(using=self.using)
+        try:
+            self.sql, self.params = self.compiler.as_sql()
+        except EmptyResultSet:
+            # Django has decided that no rows can match, eg. `pk__in=[]`
+            self.sql = None
+
+    def fetch(self, timeout=None) -> list:
+        """Run the precompiled SQL and return the raw database rows, giving up after `timeout` seconds"""
+        if self.sql is None:
+            return []
+        connection = connections[self.using]
+        with statement_timeout(connection, timeout), connection.cursor() as cursor:
+            cursor.execute(self.sql, self.params)
+            return cursor.fetchall()
+
+    def iterate(self, chunk_size=2000, timeout=None):
+        """
+        Run the precompiled SQL and yield the rows as dictionaries, fetching them a chunk at a time (from a
+        server-side cursor where the database has one). `timeout` limits each fetch, but not the time
+        spent between them, such as while a client downloads the rows already sent.
+        """
+        if self.sql is None:
+            return
+        connection = connections[self.using]
+        with statement_timeout(connection, timeout) as restart, connection.chunked_cursor() as cursor:
+            cursor.execute(self.sql, self.params)
+            while True:
+                restart()
+                results = cursor.fetchmany(chunk_size)
+                if not results:
+                    return
+                yield from self.build_rows(results)
+
+    def build_rows(self, results) -> list:
+        """Convert raw database rows to dictionaries, applying the same conversions Django would"""
+        if not results:
+            return []
+        names = self.names
+        return [dict(zip(names, row)) for row in self.compiler.results_iter(results=[results])]
+
+    def build_tuples(self, results) -> list:
+        """Convert raw database rows to tuples in the order of `names`, applying the same conversions Django would"""
+        if not results:
+            return []
+        return list(self.compiler.results_iter(results=[results]))
+
+    @property
+    def fields(self) -> OrderedDict:
+        """The output field of each selected column, by row key"""
+        return OrderedDict(
+            (name, get_output_field(expression)) for name, (expression, sql, alias) in zip(self.names, self.compiler.select)
+        )
+
+    @property
+    def types(self) -> list:
+        """The internal type of each selected column's output field, in the order of `names`"""
+        return [get_column_type(expression) for expression, sql, alias in self.compiler.select]
+
+    def build_columns(self, rows, exclude=()):
+        """Turn tuples from `build_tuples` into an ordered mapping of column name to array"""
+        if not rows:
+            return build_columns(self.names, [None] * len(self.names), rows, exclude)
+        return build_columns(self.names, self.types, rows, exclude)
+
+    def execute(self) -> list:
+        """Run the precompiled SQL and return the rows as a list of dictionaries"""
+        return self.build_rows(self.fetch())
+
+    def explain(self) -> str:
+        if self.sql is None:
+            return ''
+        return explain(connections[self.using], self.sql, self.params)
+
+    def count(self, timeout=None) -> int:
+        """Count the rows the query would return, without fetching them"""
+        if self.sql is None:
+            return 0
+        connection = connections[self.using]
+        with statement_timeout(connection, timeout), connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM (%s) di_count' % self.sql, self.params)
+            return cursor.fetchone()[0]
+
+    def estimate_count(self):
+        """Return the database's estimate of how many rows the query would return, or None if it can't say"""
+        if self.sql is None:
+            return 0
+        return estimate_count(connections[self.using], self.sql, self.params, self.table, self.filtered)
+
+    def estimate_cost(self):
+        """Return the database's estimate of how expensive the query is, or None if it can't say"""
+        if self.sql is None:
+            return 0
+        return estimate_cost(connections[self.using], self.sql, self.params)
+
+
+_query_cache = None
+
+
+def get_query_cache() -> LRUCache:
+    """Return the process wide cache of compiled interrogations"""
+    global _query_cache
+    if _query_cache is None:
+        _query_cache = LRUCache(maxsize=getattr(settings, 'INTERROGATOR_QUERY_CACHE_SIZE', 256))
+    return _query_cache
+
+
+def clear_query_cache(**kwargs):
+    """Throw away every compiled query, used as a signal receiver when models or apps change"""
+    global _table_models
+    _table_models = None
+    if _query_cache is not None:
+        _query_cache.clear()
+
+
+def clear_query_cache_on_setting_change(setting, **kwargs):
+    global _query_cache, _table_models, _local_result_cache
+    if setting in ['INSTALLED_APPS', 'DATABASES', 'INTERROGATOR_QUERY_CACHE_SIZE']:
+        _query_cache = None
+        _table_models = None
+    if setting in ['INTERROGATOR_RESULT_CACHE', 'INTERROGATOR_RESULT_CACHE_SIZE']:
+        _local_result_cache = None
+    if setting == 'INTERROGATOR_RESULT_CACHE_INVALIDATION':
+        disconnect_invalidation()
+        connect_invalidation()
+
+
+_table_models = None
+
+
+def get_query_tables(query) -> set:
+    """Return every table a query reads, including through joins and subqueries in its annotations"""
+    tables = {query.get_meta().db_table}
+    tables.update(join.table_name for join in query.alias_map.values())
+    pending = list(query.annotations.values())
+    while pending:
+        expression = pending.pop()
+        if isinstance(expression, Query):
+            tables.update(get_query_tables(expression))
+        elif expression is not None:
+            pending.extend(expression.get_source_expressions())
+    return tables
+
+
+def get_query_models(query) -> list:
+    """Return the label of every model whose table is read by a query, including those reached by joins"""
+    global _table_models
+    if _table_models is None:
+        _table_models = {
+            model._meta.db_table: model._meta.label_lower
+            for model in apps.get_models(include_auto_created=True)
+        }
+    return sorted(set(_table_models[table] for table in get_query_tables(query) if table in _table_models))
+
+
+_local_result_cache = None
+
+
+def get_result_cache():
+    """
+    Return the cache that interrogation results are stored in. This is the Django cache
+    named by ``INTERROGATOR_RESULT_CACHE``, or an in-process LRU if that isn't set.
+    """
+    global _local_result_cache
+    alias = getattr(settings, 'INTERROGATOR_RESULT_CACHE', None)
+    if alias:
+        return caches[alias]
+    if _local_result_cache is None:
+        _local_result_cache = LocalResultCache(maxsize=getattr(settings, 'INTERROGATOR_RESULT_CACHE_SIZE', 128))
+    return _local_result_cache
+
+
+def generation_key(label) -> str:
+    return 'data_interrogator:generation:%s' % label
+
+
+def get_generations(labels) -> list:
+    """
+    Return the current generation of each model. Cached results include these in their key,
+    so bumping a model's generation makes every result that read from it unreachable.
+    """
+    cache = get_result_cache()
+    keys = [generation_key(label) for label in labels]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            # Start from a fresh value, in case an evicted generation would match an old result
+            cache.add(key, time.time_ns(), None)
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+def invalidate_model(model):
+    """Bump the generation of a model so that any cached result that read from it is discarded"""
+    cache = get_result_cache()
+    key = generation_key(model._meta.concrete_model._meta.label_lower)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), None)
+
+
+def invalidate_on_change(sender, **kwargs):
+    """Signal receiver for post_save, post_delete and m2m_changed"""
+    invalidate_model(sender)
+
+
+def connect_invalidation():
+    """
+    Connect the signals that drop cached results as soon as a model they read from changes. Every
+    process connects them, as one that only writes still has to bump the generations other processes read.
+    """
+    if getattr(settings, 'INTERROGATOR_RESULT_CACHE_INVALIDATION', True):
+        for signal in [post_save, post_delete, m2m_changed]:
+            signal.connect(invalidate_on_change, dispatch_uid='data_interrogator_invalidate_results')
+
+
+def disconnect_invalidation():
+    for signal in [post_save, post_delete, m2m_changed]:
+        signal.disconnect(dispatch_uid='data_interrogator_invalidate_results')
+
+
+def result_cache_key(query_key, generations) -> str:
+    digest = hashlib.sha1(repr((query_key, generations)).encode('utf-8')).hexdigest()
+    return 'data_interrogator:result:%s' % digest
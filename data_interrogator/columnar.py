@@ -0,0 +1,82 @@
+"""
+Interrogation results as one array per column, rather than a dictionary per row.
+
+Integer and float columns are packed into typed arrays (NumPy arrays if NumPy is installed, otherwise
+the standard library's `array`), everything else is a list. Columns that contain nulls, or values that
+don't fit the column's type, are left as lists.
+"""
+from array import array
+from collections import OrderedDict
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+INTEGER_TYPES = {
+    'AutoField', 'BigAutoField', 'SmallAutoField', 'IntegerField', 'BigIntegerField', 'SmallIntegerField',
+    'PositiveIntegerField', 'PositiveSmallIntegerField',
+}
+FLOAT_TYPES = {'FloatField'}
+
+
+def get_output_field(expression):
+    """Return the field a selected expression's values are read as, following relations to their target"""
+    try:
+        field = expression.output_field
+    except Exception:
+        return None
+    if field.is_relation:
+        field = field.target_field
+    return field
+
+
+def get_column_type(expression):
+    """Return the internal type of a selected expression's output field, or None if it doesn't have one"""
+    field = get_output_field(expression)
+    if field is None:
+        return None
+    return field.get_internal_type()
+
+
+def make_column(values, column_type=None):
+    """Pack the values of one column as tightly as their type allows"""
+    if column_type in INTEGER_TYPES:
+        typecode, dtype = 'q', 'int64'
+    elif column_type in FLOAT_TYPES:
+        typecode, dtype = 'd', 'float64'
+    else:
+        return list(values)
+
+    if None in values:
+        return list(values)
+    try:
+        if numpy is not None:
+            return numpy.array(values, dtype=dtype)
+        return array(typecode, values)
+    except (TypeError, ValueError, OverflowError):
+        # eg. SQLite returning floats from an integer expression
+        return list(values)
+
+
+def build_columns(names, types, rows, exclude=()) -> OrderedDict:
+    """Turn a list of row tuples into an ordered mapping of column name to array"""
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    return OrderedDict(
+        (name, make_column(values, column_type))
+        for name, column_type, values in zip(names, types, columns)
+        if name not in exclude
+    )
+
+
+class ColumnarJSONEncoder(DjangoJSONEncoder):
+    """Encodes typed arrays as JSON lists"""
+
+    def default(self, o):
+        if isinstance(o, array):
+            return o.tolist()
+        if numpy is not None and isinstance(o, (numpy.ndarray, numpy.generic)):
+            return o.tolist()
+        return super().default(o)
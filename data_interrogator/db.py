@@ -1,8 +1,17 @@
-from django.db.models import Aggregate, CharField
+import json
+import re
+import time
+from contextlib import contextmanager
+
+from django.db import DatabaseError, NotSupportedError, transaction
+from django.db.models import Aggregate, CharField, Value
 from django.db.models import Case, Lookup, Sum, Q, When
 from django.db.models.expressions import Func
 from django.db.models.fields import Field  # , RelatedField
 from django.db.models.fields.related import RelatedField, ForeignObject, ManyToManyField
+from django.db.models.sql.datastructures import BaseTable
+
+from data_interrogator.exceptions import QueryTimeoutError
 
 
 # This is different to the built in Django Concat command, as that concats columns in a row
@@ -82,6 +91,59 @@ class DateDiff(Func):
         return super(DateDiff, self).as_sql(compiler, connection)
 
 
+class Scale(Func):
+    """Multiply an expression by a constant, rounding it if it is a whole number"""
+    function = ''
+    arg_joiner = ' * '
+    arity = 2
+
+    def __init__(self, expression, factor, **extra):
+        super().__init__(expression, Value(factor), **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        if self.output_field.get_internal_type() in ('IntegerField', 'BigIntegerField', 'SmallIntegerField',
+                                                     'PositiveIntegerField', 'PositiveSmallIntegerField'):
+            extra_context['template'] = 'CAST(ROUND(%(expressions)s) AS BIGINT)'
+        return super().as_sql(compiler, connection, **extra_context)
+
+
+class SampledTable(BaseTable):
+    """
+    The base table of a query, reading only about `percent` of its rows. PostgreSQL uses
+    `TABLESAMPLE` with `method` (SYSTEM picks whole pages, BERNOULLI every row), SQLite
+    and MySQL read from a subquery that keeps each row by chance.
+    """
+
+    def __init__(self, table_name, alias, percent, method='SYSTEM'):
+        super().__init__(table_name, alias)
+        self.percent = percent
+        self.method = method
+
+    def as_sql(self, compiler, connection):
+        raise NotSupportedError("Interrogations can't be sampled on %s databases" % connection.vendor)
+
+    def as_postgresql(self, compiler, connection):
+        sql, params = super().as_sql(compiler, connection)
+        return '%s TABLESAMPLE %s (%%s)' % (sql, self.method), [self.percent]
+
+    def subquery(self, compiler, condition):
+        return '(SELECT * FROM %s WHERE %s) %s' % (
+            compiler.quote_name_unless_alias(self.table_name), condition,
+            compiler.connection.ops.quote_name(self.table_alias)
+        )
+
+    def as_sqlite(self, compiler, connection):
+        return self.subquery(compiler, 'ABS(RANDOM()) %% 1000000 < %s'), [int(self.percent * 10000)]
+
+    def as_mysql(self, compiler, connection):
+        return self.subquery(compiler, 'RAND() * 100 < %s'), [self.percent]
+
+    def relabeled_clone(self, change_map):
+        return self.__class__(
+            self.table_name, change_map.get(self.table_alias, self.table_alias), self.percent, self.method
+        )
+
+
 class NotEqual(Lookup):
     lookup_name = 'ne'
 
@@ -96,3 +158,195 @@ Field.register_lookup(NotEqual)
 RelatedField.register_lookup(NotEqual)
 ForeignObject.register_lookup(NotEqual)
 ManyToManyField.register_lookup(NotEqual)
+
+
+def postgres_plan(cursor, sql, params) -> dict:
+    """Return the top node of PostgreSQL's plan for some SQL"""
+    cursor.execute('EXPLAIN (FORMAT JSON) %s' % sql, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+def estimate_count(connection, sql, params, table, filtered=True):
+    """
+    Ask the database how many rows it expects a query to return without running it.
+    Returns None when the database can't give a useful estimate.
+    """
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                return int(postgres_plan(cursor, sql, params)['Plan Rows'])
+            if connection.vendor == 'sqlite' and not filtered:
+                # SQLite has no row estimates for a query, but `ANALYZE` records the size of each table
+                cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+                stat = cursor.fetchone()
+                if stat:
+                    return int(stat[0].split(' ')[0])
+    except DatabaseError:
+        # eg. sqlite_stat1 doesn't exist until the database has been analyzed
+        pass
+    return None
+
+
+def table_size(connection, table) -> int:
+    """Return about how many rows a table has, from the statistics PostgreSQL keeps or by counting them"""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [table])
+            row = cursor.fetchone()
+            if row and row[0] > 0:
+                return int(row[0])
+        cursor.execute('SELECT COUNT(*) FROM %s' % connection.ops.quote_name(table))
+        return cursor.fetchone()[0]
+
+
+def estimate_cost(connection, sql, params):
+    """
+    Ask the database how expensive it expects a query to be without running it, in the units of its
+    query planner. Returns None when the database doesn't give estimates, as SQLite doesn't.
+    """
+    if connection.vendor != 'postgresql':
+        return None
+    try:
+        with connection.cursor() as cursor:
+            return float(postgres_plan(cursor, sql, params)['Total Cost'])
+    except DatabaseError:
+        return None
+
+
+@contextmanager
+def statement_timeout(connection, seconds):
+    """
+    Stop any statement run inside the block that runs for longer than `seconds`, raising
+    QueryTimeoutError. PostgreSQL sets `statement_timeout` for a transaction around the block,
+    SQLite checks the time from a progress handler. Other databases aren't limited.
+
+    The block is given a function that restarts the clock, for callers that fetch rows in chunks
+    and only want to limit each fetch rather than the time spent between them.
+    """
+    if not seconds:
+        yield lambda: None
+        return
+
+    if connection.vendor == 'postgresql':
+        try:
+            with transaction.atomic(using=connection.alias):
+                with connection.cursor() as cursor:
+                    cursor.execute('SHOW statement_timeout')
+                    previous = cursor.fetchone()[0]
+                    cursor.execute('SET LOCAL statement_timeout = %s', [max(1, int(seconds * 1000))])
+                # Every statement is timed on its own
+                yield lambda: None
+                # Inside an outer transaction SET LOCAL lasts until that ends, not this block. If the block
+                # fails, rolling back its savepoint undoes the setting instead.
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL statement_timeout = %s', [previous])
+        except DatabaseError as e:
+            # 57014 is query_canceled
+            cause = e.__cause__
+            if getattr(cause, 'pgcode', None) == '57014' or getattr(cause, 'sqlstate', None) == '57014':
+                raise QueryTimeoutError(seconds) from e
+            raise
+
+    elif connection.vendor == 'sqlite':
+        connection.ensure_connection()
+        deadline = [time.monotonic() + seconds]
+
+        def restart():
+            deadline[0] = time.monotonic() + seconds
+
+        connection.connection.set_progress_handler(lambda: time.monotonic() > deadline[0], 1000)
+        try:
+            yield restart
+        except DatabaseError as e:
+            if time.monotonic() > deadline[0]:
+                raise QueryTimeoutError(seconds) from e
+            raise
+        finally:
+            connection.connection.set_progress_handler(None, 0)
+
+    else:
+        yield lambda: None
+
+
+def explain(connection, sql, params) -> str:
+    """Return the database's query plan for some SQL as text"""
+    prefix = connection.ops.explain_query_prefix()
+    with connection.cursor() as cursor:
+        cursor.execute('%s %s' % (prefix, sql), params)
+        return '\n'.join(
+            row[0] if len(row) == 1 else ' '.join(str(value) for value in row)
+            for row in cursor.fetchall()
+        )
+
+
+def scanned_tables(connection, sql, params) -> list:
+    """
+    Return the tables (or their aliases) that the database's plan for some SQL reads in full,
+    rather than through an index. Raises NotSupportedError for databases other than PostgreSQL and SQLite.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            tables = []
+            nodes = [postgres_plan(cursor, sql, params)]
+            while nodes:
+                node = nodes.pop()
+                if node['Node Type'] == 'Seq Scan':
+                    tables.append(node.get('Alias') or node['Relation Name'])
+                nodes.extend(node.get('Plans', []))
+            return tables
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+            tables = []
+            for row in cursor.fetchall():
+                # eg. "SCAN shop_sale", "SCAN TABLE shop_sale AS T3" or "SCAN shop_sale USING INDEX ..."
+                match = re.match(r'SCAN (?:TABLE )?(\S+)(?: AS (\S+))?(.*)$', row[-1])
+                if match and 'USING' not in match.group(3) and match.group(1) not in ('CONSTANT', 'SUBQUERY'):
+                    tables.append(match.group(2) or match.group(1))
+            return tables
+    raise NotSupportedError("Query plans can't be read from %s databases" % connection.vendor)
+
+
+def interrupt(connection) -> bool:
+    """
+    Ask the database to abandon whatever statement a connection is running. This is called from a
+    different thread to the one running the statement, which then fails with a database error.
+    Returns False if the database can't be interrupted.
+    """
+    raw_connection = connection.connection
+    if raw_connection is None:
+        return False
+    if connection.vendor == 'sqlite':
+        raw_connection.interrupt()
+    elif connection.vendor == 'postgresql':
+        raw_connection.cancel()
+    else:
+        return False
+    return True
+
+
+def replication_lag(connection):
+    """
+    Return how many seconds a replica is behind its primary, 0 for a primary, or None if the database
+    can't say. Raises a DatabaseError if the database can't be reached.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT CASE WHEN pg_is_in_recovery() "
+                "THEN COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) ELSE 0 END"
+            )
+            return float(cursor.fetchone()[0])
+        if connection.vendor == 'mysql':
+            cursor.execute('SHOW SLAVE STATUS')
+            row = cursor.fetchone()
+            if row is None:
+                return 0
+            status = dict(zip([c[0] for c in cursor.description], row))
+            lag = status.get('Seconds_Behind_Master')
+            # NULL means replication has stopped
+            return float('inf') if lag is None else float(lag)
+        cursor.execute('SELECT 1')
+        return None
@@ -4,3 +4,30 @@ class ModelNotAllowedException(Exception):
 
 class InvalidAnnotationError(Exception):
     pass
+
+
+class PaginationError(Exception):
+    pass
+
+
+class QueryTimeoutError(Exception):
+    def __init__(self, seconds):
+        super().__init__(
+            "This interrogation took longer than %s seconds and was stopped, try adding filters." % seconds
+        )
+        self.seconds = seconds
+
+
+class QueryCostError(Exception):
+    pass
+
+
+class SamplingError(Exception):
+    pass
+
+
+class ParseError(Exception):
+    def __init__(self, message, text, position):
+        super().__init__("%s at character %d of '%s'" % (message, position + 1, text))
+        self.text = text
+        self.position = position
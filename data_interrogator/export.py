@@ -0,0 +1,173 @@
+"""Writers that turn interrogation rows into downloadable formats, one row at a time"""
+import csv
+import json
+from itertools import islice
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+
+class Echo:
+    """A file-like object that hands back whatever is written to it, so csv.writer can be streamed"""
+
+    def write(self, value):
+        return value
+
+
+def csv_stream(rows, columns, fields=None, errors=None):
+    """
+    Yield a CSV header line, followed by a line for each row. Errors added while the rows were
+    read, such as the rows being cut short, follow as lines starting with '#'.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([row.get(column) for column in columns])
+    for error in errors or []:
+        yield writer.writerow(['# %s' % error])
+
+
+def ndjson_stream(rows, columns, fields=None, errors=None):
+    """
+    Yield a newline terminated JSON object for each row, followed by an object with just
+    the `errors` added while the rows were read, if there were any
+    """
+    encoder = DjangoJSONEncoder()
+    for row in rows:
+        yield encoder.encode({column: row.get(column) for column in columns}) + '\n'
+    if errors:
+        yield encoder.encode({'errors': [str(e) for e in errors]}) + '\n'
+
+
+class Drain:
+    """A file-like object that keeps what is written to it until it is drained, so Arrow writers can be streamed"""
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_type(field):
+    """Return the Arrow type to store the values of a Django field in, text for anything unknown"""
+    internal_type = field.get_internal_type() if field is not None else None
+    if internal_type in ('AutoField', 'BigAutoField', 'SmallAutoField', 'IntegerField', 'BigIntegerField',
+                         'SmallIntegerField', 'PositiveIntegerField', 'PositiveSmallIntegerField'):
+        return pyarrow.int64()
+    if internal_type == 'FloatField':
+        return pyarrow.float64()
+    if internal_type in ('BooleanField', 'NullBooleanField'):
+        return pyarrow.bool_()
+    if internal_type == 'DecimalField':
+        if field.decimal_places is None:
+            return pyarrow.float64()
+        # Sums can grow well past the size of the values being added up
+        return pyarrow.decimal128(38, field.decimal_places)
+    if internal_type == 'DateTimeField':
+        return pyarrow.timestamp('us', tz='UTC' if settings.USE_TZ else None)
+    if internal_type == 'DateField':
+        return pyarrow.date32()
+    if internal_type == 'TimeField':
+        return pyarrow.time64('us')
+    if internal_type == 'DurationField':
+        return pyarrow.duration('us')
+    return pyarrow.string()
+
+
+def arrow_schema(columns, fields=None):
+    fields = fields or {}
+    return pyarrow.schema([(column, arrow_type(fields.get(column))) for column in columns])
+
+
+def arrow_batches(rows, schema, batch_size):
+    """Yield a record batch for every `batch_size` rows, built a column at a time"""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            return
+        arrays = []
+        for field in schema:
+            values = [row.get(field.name) for row in chunk]
+            if pyarrow.types.is_string(field.type):
+                values = [v if v is None or isinstance(v, str) else str(v) for v in values]
+            arrays.append(pyarrow.array(values, type=field.type))
+        yield pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def errors_metadata(errors) -> dict:
+    return {'errors': json.dumps([str(e) for e in errors])}
+
+
+def arrow_stream(rows, columns, fields=None, errors=None, batch_size=2000):
+    """
+    Yield an Arrow IPC stream, a record batch at a time. Errors added while the rows were read
+    end the stream as an empty batch with the errors as JSON in its `errors` metadata.
+    """
+    schema = arrow_schema(columns, fields)
+    sink = Drain()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        yield sink.drain()
+        for batch in arrow_batches(rows, schema, batch_size):
+            writer.write_batch(batch)
+            yield sink.drain()
+        if errors:
+            writer.write_batch(
+                pyarrow.RecordBatch.from_pylist([], schema=schema), custom_metadata=errors_metadata(errors)
+            )
+    yield sink.drain()
+
+
+def parquet_stream(rows, columns, fields=None, errors=None, batch_size=64 * 1024):
+    """
+    Yield a Parquet file, written a row group at a time. Errors added while the rows were read
+    are kept as JSON in the `errors` key of the file's metadata.
+    """
+    schema = arrow_schema(columns, fields)
+    sink = Drain()
+    with pyarrow.parquet.ParquetWriter(sink, schema) as writer:
+        for batch in arrow_batches(rows, schema, batch_size):
+            writer.write_batch(batch)
+            yield sink.drain()
+        if errors:
+            writer.add_key_value_metadata(errors_metadata(errors))
+    yield sink.drain()
+
+
+# Maps the `format` requested to the writer, content type and file extension
+EXPORT_FORMATS = {
+    'csv': (csv_stream, 'text/csv', 'csv'),
+    'ndjson': (ndjson_stream, 'application/x-ndjson', 'ndjson'),
+}
+if pyarrow is not None:
+    EXPORT_FORMATS.update({
+        'arrow': (arrow_stream, 'application/vnd.apache.arrow.stream', 'arrows'),
+        'parquet': (parquet_stream, 'application/vnd.apache.parquet', 'parquet'),
+    })
@@ -0,0 +1,134 @@
+"""
+Aggregates over more than one to-many relation.
+
+Aggregating ``count(salesperson)`` and ``count(salesperson.sale)`` from a branch joins both tables,
+so every salesperson is counted once for each of their sales. When an interrogation aggregates over
+more than one to-many path, each of those aggregates is instead worked out for each base row by a
+correlated subquery, and the subqueries are added up for each group. The main query then only reads
+the base table (and anything it has a foreign key to), so it grows with the base table rather than
+with every combination of related rows.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Avg, Count, ExpressionWrapper, F, FloatField, Max, Min, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Cast, Coalesce, NullIf
+
+# How the value worked out for each base row is combined for each group of rows
+COMBINE = {
+    Count: Sum,
+    Sum: Sum,
+    Min: Min,
+    Max: Max,
+}
+
+
+def to_many_prefix(model, path) -> str:
+    """Return the part of a lookup path up to and including its last to-many relation, or ''"""
+    parts = path.split('__')
+    end = 0
+    for index, part in enumerate(parts):
+        if model is None:
+            break
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            break
+        if field.one_to_many or field.many_to_many:
+            end = index + 1
+        model = field.related_model
+    return '__'.join(parts[:end])
+
+
+def reverse_path(model, path):
+    """Return the model a relation path ends at, and the lookup path from it back to `model`"""
+    parts = []
+    for name in path.split('__'):
+        field = model._meta.get_field(name)
+        parts.insert(0, field.field.name if field.auto_created and not field.concrete else field.related_query_name())
+        model = field.related_model
+    return model, '__'.join(parts)
+
+
+def field_paths(expression) -> list:
+    """Return every lookup path an unresolved expression refers to, including in an aggregate's filter"""
+    if isinstance(expression, F):
+        return [expression.name]
+    if isinstance(expression, Q):
+        paths = []
+        for child in expression.children:
+            paths.extend(field_paths(child) if isinstance(child, Q) else [child[0]])
+        return paths
+    paths = []
+    for source in expression.get_source_expressions():
+        if source is not None:
+            paths.extend(field_paths(source))
+    if getattr(expression, 'filter', None) is not None:
+        paths.extend(field_paths(expression.filter))
+    return paths
+
+
+def relative_to(expression, prefix):
+    """Copy an unresolved expression with the paths it refers to starting after `prefix`"""
+    if isinstance(expression, F):
+        return F(expression.name[len(prefix) + 2:] or 'pk')
+    expression = expression.copy()
+    expression.set_source_expressions([
+        relative_to(source, prefix) if source is not None else None
+        for source in expression.get_source_expressions()
+    ])
+    return expression
+
+
+def per_row(aggregate, model, prefix):
+    """A subquery that works out an aggregate over the rows related to each base row through `prefix`"""
+    target, back = reverse_path(model, prefix)
+    rows = target._default_manager.filter(**{back: OuterRef('pk')}).order_by().values(back)
+    rows = rows.annotate(di_value=relative_to(aggregate, prefix))
+    return Subquery(rows.values('di_value')), rows.query.annotations['di_value'].output_field
+
+
+def is_rewritable(annotation) -> bool:
+    return (
+        type(annotation) in COMBINE or type(annotation) is Avg
+    ) and not getattr(annotation, 'distinct', False) and annotation.filter is None
+
+
+def rewrite(annotation, model, prefix):
+    """Turn an aggregate over the to-many path `prefix` into a combination of per row subqueries"""
+    if type(annotation) is Avg:
+        # Averages of each row's values can't be averaged again, so divide the total by the count,
+        # as a float so that totals of whole numbers aren't divided as integers
+        sources = annotation.get_source_expressions()
+        total, _ = per_row(Sum(*sources), model, prefix)
+        count, _ = per_row(Count(*sources), model, prefix)
+        _, output_field = per_row(annotation, model, prefix)
+        return ExpressionWrapper(Cast(Sum(total), FloatField()) / NullIf(Sum(count), 0), output_field=output_field)
+    subquery, output_field = per_row(annotation, model, prefix)
+    if type(annotation) is Count:
+        subquery = Coalesce(subquery, 0)
+    return COMBINE[type(annotation)](subquery, output_field=output_field)
+
+
+def rewrite_fanout(model, annotations, query_columns, filter_paths):
+    """
+    If the aggregates in `annotations` use more than one to-many path, return the annotations with
+    each of those aggregates made into per row subqueries. Otherwise, or if the grouped columns,
+    filters or other annotations also join to-many relations, the annotations are returned as they are.
+    """
+    prefixes = {}
+    for name, annotation in annotations.items():
+        paths = {to_many_prefix(model, path) for path in field_paths(annotation)} - {''}
+        if not paths:
+            continue
+        if len(paths) > 1 or not is_rewritable(annotation):
+            return annotations
+        prefixes[name] = paths.pop()
+
+    if len(set(prefixes.values())) < 2:
+        return annotations
+    if any(to_many_prefix(model, path) for path in [*query_columns, *filter_paths]):
+        return annotations
+
+    rewritten = dict(annotations)
+    for name, prefix in prefixes.items():
+        rewritten[name] = rewrite(annotations[name], model, prefix)
+    return rewritten
@@ -0,0 +1,124 @@
+"""
+Incremental interrogations of tables that are only ever added to.
+
+A report over sales grouped by state doesn't need to read every sale each time it is run. The groups
+are kept in the result cache, along with the highest value of a watermark column (such as
+``sale_date``) that was read. The next run only reads rows past the watermark and merges their groups
+in: sums and counts are added together, the smaller minimum and larger maximum are kept, and
+averages are worked out from a hidden sum and count. Rows added with a watermark lower than one
+already read, or changed after they were read, aren't seen until the report is refreshed.
+"""
+import hashlib
+from collections import OrderedDict
+
+from django.db.models.sql.datastructures import Join
+
+from data_interrogator.parser import Call, Condition, parse_column
+
+AVG = 'avg'
+
+
+def add(a, b):
+    return b if a is None else a if b is None else a + b
+
+
+def smallest(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def largest(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+# How the aggregate of the new rows of a group is merged into its previous value
+MERGE = {
+    'sum': add,
+    'count': add,
+    'min': smallest,
+    'max': largest,
+}
+
+
+def state_key(query_key) -> str:
+    digest = hashlib.sha1(repr(query_key).encode('utf-8')).hexdigest()
+    return 'data_interrogator:incremental:%s' % digest
+
+
+def plan_columns(columns, get_name):
+    """
+    Return the columns to query, how each aggregate is merged (by the name `get_name` gives its column)
+    and the hidden sum and count of each average. Averages are queried as their sum and count.
+    Returns (None, None, None) if any column can't be merged.
+    """
+    query_columns, merges, averages = [], OrderedDict(), OrderedDict()
+    for index, column in enumerate(c for c in columns if c):
+        parsed = parse_column(column)
+        expression = parsed.expression
+        if not isinstance(expression, Call):
+            query_columns.append(column)
+            continue
+        if any(isinstance(arg, Condition) for arg in expression.args):
+            return None, None, None
+        if expression.name in MERGE:
+            merges[get_name(column)] = expression.name
+            query_columns.append(column)
+        elif expression.name == AVG:
+            # The text after 'avg' is the same for the sum and count of the same values
+            arguments = parsed.text[len(AVG):]
+            total, count = 'di_sum_%d' % index, 'di_count_%d' % index
+            merges.update([(total, 'sum'), (count, 'count')])
+            averages[get_name(column)] = (total, count)
+            query_columns.extend(['%s:=sum%s' % (total, arguments), '%s:=count%s' % (count, arguments)])
+        else:
+            return None, None, None
+    return query_columns, merges, averages
+
+
+def joins_to_many(query) -> bool:
+    """Whether a query joins a relation that can have more than one row for each base row"""
+    return any(
+        getattr(join.join_field, 'one_to_many', False) or getattr(join.join_field, 'many_to_many', False)
+        for join in query.alias_map.values() if isinstance(join, Join)
+    )
+
+
+def is_mergeable(query) -> bool:
+    """Whether the groups of a query's rows can be worked out from those of some rows and then the rest"""
+    return not joins_to_many(query) and not query.where.contains_aggregate
+
+
+def merge_rows(groups, rows, group_names, merges):
+    """Merge rows of new aggregates into `groups`, which maps each group's values to its row"""
+    for row in rows:
+        key = tuple(row[name] for name in group_names)
+        previous = groups.get(key)
+        if previous is None:
+            groups[key] = row
+            continue
+        for name, merge in merges.items():
+            previous[name] = MERGE[merge](previous[name], row[name])
+    return groups
+
+
+def build_rows(groups, names, averages):
+    """Turn merged groups back into rows with `names`, working out averages from their hidden sum and count"""
+    rows = []
+    for group in groups.values():
+        row = {}
+        for name in names:
+            if name in averages:
+                total, count = averages[name]
+                row[name] = group[total] / group[count] if group[count] else None
+            else:
+                row[name] = group[name]
+        rows.append(row)
+    return rows
+
+
+def sort_rows(rows, order_by):
+    """Sort rows by column names, with a leading '-' for descending order and empty values first"""
+    for column in reversed(order_by):
+        descending = column.startswith('-')
+        column = column.lstrip('-')
+        rows.sort(key=lambda row: (row.get(column) is not None, row.get(column)), reverse=descending)
+    return rows
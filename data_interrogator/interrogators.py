@@ -1,15 +1,34 @@
-import re
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import timedelta
+from decimal import Decimal
 from enum import Enum
 from typing import Union, Tuple, Any, List
 
 from django.apps import apps
+from django.conf import settings
 from django.core import exceptions
-from django.db.models import F, Count, Min, Max, Sum, Value, Avg, ExpressionWrapper, DurationField, FloatField, Model
+from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Aggregate, F, Q, Count, Min, Max, Sum, Value, Avg, ExpressionWrapper, DurationField, FloatField, Model
 from django.db.models import functions as func
 
 from data_interrogator import exceptions as di_exceptions
-from data_interrogator.db import GroupConcat, DateDiff, ForceDate, SumIf
+from data_interrogator import cache as di_cache
+from data_interrogator import fanout
+from data_interrogator import incremental
+from data_interrogator import parser
+from data_interrogator.cache import CompiledQuery, freeze, get_query_cache
+from data_interrogator.db import GroupConcat, DateDiff, ForceDate, SampledTable, Scale, SumIf, statement_timeout, table_size
+from data_interrogator.fanout import rewrite_fanout, to_many_prefix
+from data_interrogator.parser import parse_column, parse_expression, parse_filter
+from data_interrogator.profiling import NULL_PROFILE, Profile, get_stats_hook
+from data_interrogator.rollups import find_rollup
+from data_interrogator.routing import ROUND_ROBIN, get_router
+from data_interrogator.schema import get_schema_index, related_model_help_text
 
 # Utility functions
 math_infix_symbols = {
@@ -49,40 +68,94 @@ def normalise_field(text) -> str:
 
 def normalise_math(expression):
     """Normalise math from UI """
-    if not any(s in expression for s in math_infix_symbols.keys()):
-        # we're aggregating some mathy things, these are tricky
-        return F(normalise_field(expression))
-
-    math_operator_re = '[\-\/\+\*]'
-
-    a, b = [v.strip() for v in re.split(math_operator_re, expression, 1)]
-    first_operator = re.findall(math_operator_re, expression)[0]
-
-    if first_operator == "-" and a.endswith('date') and b.endswith('date'):
-        expr = ExpressionWrapper(
-            DateDiff(
-                ForceDate(F(a)),
-                ForceDate(F(b))
-            ), output_field=DurationField()
-        )
-    else:
-        expr = ExpressionWrapper(
-            math_infix_symbols[first_operator](F(a), F(b)),
+    return build_expression(parse_expression(expression))
+
+
+def build_expression(node, build_call=None):
+    """Turn a parsed column into a Django expression, using `build_call` for any functions"""
+    if isinstance(node, (parser.Field, parser.FieldRef)):
+        return F(node.path)
+    if isinstance(node, (parser.Number, parser.String)):
+        return Value(node.value)
+    if isinstance(node, parser.Negate):
+        return ExpressionWrapper(-build_expression(node.operand, build_call), output_field=FloatField())
+    if isinstance(node, parser.BinOp):
+        a, b = node.left, node.right
+        if node.op == '-' and isinstance(a, parser.Field) and isinstance(b, parser.Field) \
+                and a.path.endswith('date') and b.path.endswith('date'):
+            return ExpressionWrapper(
+                DateDiff(
+                    ForceDate(F(a.path)),
+                    ForceDate(F(b.path))
+                ), output_field=DurationField()
+            )
+        return ExpressionWrapper(
+            math_infix_symbols[node.op](build_expression(a, build_call), build_expression(b, build_call)),
             output_field=FloatField()
         )
-    return expr
+    if isinstance(node, parser.Call) and build_call is not None:
+        return build_call(node)
+    raise di_exceptions.InvalidAnnotationError("%s can't be used here" % (getattr(node, 'name', None) or node))
 
 
 def clean_filter(text: str) -> Union[str, Tuple[str, str, str]]:
     """Return the (cleaned) filter for replacement"""
-    maps = [('<>', 'ne'), ('<=', 'lte'), ('<', 'lt'), ('>=', 'gte'), ('>', 'gt'), ('=', '')]
-    for interrogator_filter, django_filter in maps:
-        candidate = text.split(interrogator_filter)
-        if len(candidate) == 2:
-            if interrogator_filter is "=":
-                return candidate[0], django_filter, candidate[1]
-            return candidate[0], '__%s' % django_filter, candidate[1]
-    return text
+    try:
+        parsed = parse_filter(text)
+    except di_exceptions.ParseError:
+        return text
+    return parsed.field + ('!' if parsed.exclude else ''), parsed.lookup, parsed.value
+
+
+def canonical_path(model, path: str) -> str:
+    """
+    Spell a lookup path from a model the one way it joins, so ``sale__pk`` and ``sale__id``
+    are both ``sale``. Parts that aren't fields, such as lookups, are left as they are.
+    """
+    parts = path.split('__')
+    canonical = []
+    for index, part in enumerate(parts):
+        if model is None:
+            canonical.extend(parts[index:])
+            break
+        if part == 'pk':
+            part = model._meta.pk.name
+        try:
+            field = model._meta.get_field(part)
+        except exceptions.FieldDoesNotExist:
+            canonical.extend(parts[index:])
+            break
+        if field is model._meta.pk and canonical and index == len(parts) - 1:
+            break  # The key of a related model is the relation itself
+        canonical.append(field.name)
+        model = field.related_model if field.is_relation else None
+    return '__'.join(canonical)
+
+
+def canonical_node(model, node):
+    """Return a parsed column with every path made canonical, for comparing columns that compute the same thing"""
+    if isinstance(node, (parser.Field, parser.FieldRef, parser.Condition)):
+        return node._replace(path=canonical_path(model, node.path))
+    if isinstance(node, parser.Negate):
+        return node._replace(operand=canonical_node(model, node.operand))
+    if isinstance(node, parser.BinOp):
+        return node._replace(left=canonical_node(model, node.left), right=canonical_node(model, node.right))
+    if isinstance(node, parser.Call):
+        return node._replace(args=tuple(canonical_node(model, arg) for arg in node.args))
+    return node
+
+
+class PageTokenSerializer:
+    """
+    Serialises the sort key values of the last row of a page for `django.core.signing`.
+    Dates and decimals become strings, which Django converts back when filtering.
+    """
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':'), cls=DjangoJSONEncoder).encode('latin-1')
+
+    def loads(self, data):
+        return json.loads(data.decode('latin-1'))
 
 
 # Because of the risk of data leakage from User, Revision and Version tables,
@@ -118,6 +191,47 @@ class Interrogator:
     allowed = Allowable.ALL_MODELS
     excluded = []
 
+    # Whether to reuse the compiled SQL of previously seen interrogations
+    use_query_cache = True
+    # How many seconds to keep the rows of an interrogation for, 0 disables result caching.
+    # Cached rows are also dropped when any model the query reads from is saved or deleted.
+    result_cache_ttl = 0
+    # A callable (or dotted path to one) that is sent the stats of every interrogation,
+    # if this is None the ``INTERROGATOR_STATS_HOOK`` setting is used.
+    stats_hook = None
+    profile = NULL_PROFILE
+
+    # Seconds an interrogation's queries may run for before they are stopped, None for no limit.
+    # This is enforced with `statement_timeout` on PostgreSQL and a progress handler on SQLite.
+    max_execution_time = None
+    # The most rows an interrogation returns, any more are dropped with a warning in `errors`
+    max_rows = None
+    # Interrogations that the query planner estimates will cost more than this are rejected or, if
+    # `query_cost_action` is 'limit', cut down to `cost_limit_rows` rows. Only PostgreSQL gives estimates.
+    max_query_cost = None
+    query_cost_action = 'reject'
+    cost_limit_rows = 1000
+
+    # Database aliases to run interrogations against, such as read replicas. If this is None the
+    # ``INTERROGATOR_DATABASES`` setting is used, and if that isn't set the model's default database.
+    databases = None
+    # How to pick from several databases, 'round_robin' or 'least_latency'
+    database_choice = ROUND_ROBIN
+    # Skip replicas that are more than this many seconds behind, None to never check.
+    # If every replica is behind, interrogations use `fallback_database`.
+    max_replication_lag = None
+    fallback_database = 'default'
+    # The database chosen for the interrogation in progress
+    database = None
+    # Whether to read from the summary tables declared in ``INTERROGATOR_ROLLUPS`` where they match
+    use_rollups = True
+    # The rollup found for the interrogation being compiled, so its state is only read once
+    rollup_lookup = None
+    # Whether aggregates over more than one to-many relation are worked out with a subquery each,
+    # rather than joining every relation at once and counting rows more than once
+    rewrite_fanout = True
+    # How PostgreSQL samples tables for interrogations run with `sample`, 'SYSTEM' or 'BERNOULLI'
+    sample_method = 'SYSTEM'
 
     def __init__(self, report_models=None, allowed=None, excluded=None):
         if report_models is not None:
@@ -157,9 +271,40 @@ class Interrogator:
         """Returns whether a field begins with an underscore and so is hidden"""
         return field.name.startswith('_')
 
+    def related_model_help_text(self, text, field) -> str:
+        """Generate help text for the fields from a related model, from the related model's docstring"""
+        return related_model_help_text(text, field)
+
     def get_model_queryset(self):
+        if self.database:
+            return self.base_model.objects.using(self.database)
         return self.base_model.objects.all()
 
+    @contextmanager
+    def routed(self):
+        """Run everything inside the block against one database, chosen unless an outer block already has"""
+        if self.database is not None:
+            yield self.database
+            return
+        self.database = self.choose_database()
+        try:
+            yield self.database
+        finally:
+            self.database = None
+
+    def choose_database(self):
+        """Pick the database alias the next interrogation runs against, or None for the model's default"""
+        aliases = self.databases or getattr(settings, 'INTERROGATOR_DATABASES', None)
+        if not aliases:
+            return None
+        if isinstance(aliases, str):
+            return aliases
+        if len(aliases) == 1 and self.max_replication_lag is None:
+            return aliases[0]
+        return get_router(aliases).choose(
+            strategy=self.database_choice, max_lag=self.max_replication_lag, fallback=self.fallback_database
+        )
+
     def process_annotation_concat(self, column):
         pass
 
@@ -194,55 +339,60 @@ class Interrogator:
         return app_label in self.excluded or (app_label, model_name) in self.excluded
 
     def has_forbidden_join(self, column, base_model=None) -> bool:
-        """Return whether a forbidden join exists in the query"""
+        """
+        Return whether a forbidden join exists in the query. Verdicts are remembered for every
+        interrogator with the same permission rules, so each path is only walked once.
+        """
         checking_model = base_model or self.base_model
-
-        joins = column.split('__')
-        for _, relation in enumerate(joins):
-            if checking_model:
-                try:
-                    attr = self.get_field_by_name(checking_model, relation)
-                    if attr.related_model:
-                        if self.is_excluded_model(attr.related_model):
-                            # Despite the join/field being named differently, this column is forbidden!
-                            return True
-                    checking_model = attr.related_model
-                except exceptions.FieldDoesNotExist:
-                    pass
-
-        return False
+        with self.profile.stage('permissions'):
+            return get_schema_index(self).has_forbidden_join(checking_model, column)
 
     def get_base_annotations(self):
         return {}
 
     def get_annotation(self, column):
-        agg, field = column.split('::', 1)
+        node = parse_expression(column)
+        if not isinstance(node, parser.Call):
+            raise di_exceptions.InvalidAnnotationError("[%s] isn't an aggregate" % column)
+        return self.build_call(node)
+
+    def build_expression(self, node):
+        return build_expression(node, build_call=self.build_call)
+
+    def build_call(self, node):
+        """Turn a parsed function call into an aggregate or database function"""
+        agg = node.name
+        if agg not in self.available_aggregations:
+            raise di_exceptions.InvalidAnnotationError("[%s] isn't a known function" % agg)
+        args = list(node.args)
+        conditions = [a for a in args if isinstance(a, parser.Condition)]
+        args = [a for a in args if not isinstance(a, parser.Condition)]
+        if conditions and agg != 'sumif':
+            raise di_exceptions.InvalidAnnotationError("Only SUMIF can have conditions")
+        if not args:
+            raise di_exceptions.InvalidAnnotationError("%s needs a column" % agg.upper())
+
         if agg == 'sumif':
-            try:
-                field, cond = field.split(',', 1)
-            except:
+            if not conditions:
                 raise di_exceptions.InvalidAnnotationError("SUMIF must have a condition")
-            field = normalise_math(field)
-            conditions = {}
-            for condition in cond.split(','):
-                condition_key, condition_val = condition.split('=', 1)
-                conditions[normalise_field(condition_key)] = normalise_field(condition_val)
-            annotation = self.available_aggregations[agg](field=field, **conditions)
+            field = self.build_expression(args[0])
+            condition = Q()
+            for c in conditions:
+                q = Q(**{c.path + parser.COMPARISONS[c.op]: normalise_field(c.value)})
+                condition &= ~q if c.op == '!=' else q
+            annotation = self.available_aggregations[agg](field=field, condition=condition)
         elif agg == 'join':
-            fields = []
-            for f in field.split(','):
-                if f.startswith(('"', "'")):
-                    # its a string!
-                    fields.append(Value(f.strip('"').strip("'")))
-                else:
-                    fields.append(f)
+            fields = [Value(a.value) if isinstance(a, parser.String) else a.path for a in args]
             annotation = self.available_aggregations[agg](*fields)
         elif agg == "substr":
-            field, i, j = (field.split(',') + [None])[0:3]
-            annotation = self.available_aggregations[agg](field, i, j)
+            field, i, j = (args + [None])[0:3]
+            annotation = self.available_aggregations[agg](
+                self.build_expression(field), *[a.value for a in (i, j) if a is not None]
+            )
         else:
-            field = normalise_math(field)
-            annotation = self.available_aggregations[agg](field, distinct=False)
+            annotation = self.available_aggregations[agg](
+                *[self.build_expression(a) for a in args], distinct=False
+            )
         return annotation
 
     def validate_report_model(self, base_model):
@@ -260,22 +410,43 @@ class Interrogator:
         self.base_model = None
         raise di_exceptions.ModelNotAllowedException()
 
-    def check_for_forbidden_column(self, column) -> List[str]:
+    def is_report_model(self, model) -> bool:
+        """Return whether interrogations can start from the given model"""
+        if self.report_models == Allowable.ALL_MODELS:
+            return True
+        app_label, model_name = model._meta.app_label, model._meta.model_name
+        for opts in self.report_models:
+            if type(opts) is str:
+                opts = (opts,)
+            if len(opts) == 1 and opts[0].lower() == app_label:
+                return True
+            if len(opts) > 1 and (opts[0].lower(), opts[1].lower()) == (app_label, model_name):
+                return True
+        return False
+
+    def has_forbidden_expression(self, node) -> bool:
+        """Return whether any field in a parsed column or filter joins to a forbidden model"""
+        return any(self.has_forbidden_join(path) for path in parser.field_paths(node))
+
+    def check_for_forbidden_column(self, column, expression=None) -> List[str]:
         """Check if column is forbidden for whatever reason, and return the value of it"""
         errors: List[str] = []
+        if expression is None:
+            try:
+                expression = parse_expression(column)
+            except di_exceptions.ParseError:
+                expression = parser.Field(column)
 
-        # Check if the column has permission
-        if self.has_forbidden_join(column):
-            errors.append(
-                "Joining tables with the column [{}] is forbidden, this column is removed from the output.".format(
-                    column))
-        # Check aggregation includes a forbidden column
-        if '::' in column:
-            check_col = column.split('::', 1)[-1]
-            if self.has_forbidden_join(check_col):
+        # Check if the column, or any field in its math or aggregates, has permission
+        if self.has_forbidden_expression(expression):
+            if isinstance(expression, parser.Call):
                 errors.append(
                     "Aggregating tables using the column [{}] is forbidden, this column is removed from the output.".format(
                         column))
+            else:
+                errors.append(
+                    "Joining tables with the column [{}] is forbidden, this column is removed from the output.".format(
+                        column))
         return errors
 
     def generate_filters(self, filters, annotations, expression_columns):
@@ -286,19 +457,25 @@ class Interrogator:
         filters_all = {}
 
         for index, expression in enumerate(filters):
-            field, exp, val = clean_filter(normalise_field(expression))
+            parsed = parse_filter(expression)
+            field, exp, val = normalise_field(parsed.field), parsed.lookup, parsed.value
 
-            if self.has_forbidden_join(field):
+            val = val.strip()
+            # Fields referred to with ~ on the other side of the comparison are joined too
+            reference = normalise_field(val[1:]) if val.startswith('~') else None
+            if self.has_forbidden_expression(parsed.expression) or \
+                    reference is not None and self.has_forbidden_join(reference):
                 errors.append(
                     f"Filtering with the column [{field}] is forbidden, this filter is removed from the output."
                 )
                 continue
 
             key = '%s%s' % (field.strip(), exp)
-            val = val.strip()
+            # Filters on annotations are applied in one HAVING clause, so != becomes its lookup there
+            negate = '__ne' if parsed.exclude else ''
 
-            if val.startswith('~'):
-                val = F(val[1:])
+            if reference is not None:
+                val = F(reference)
             elif key.endswith('date'):
                 val = (val + '-01-01')[:10]  # If we are filtering by a date, make sure its 'date-like'
             elif key.endswith('__isnull'):
@@ -308,14 +485,15 @@ class Interrogator:
                     val = bool(val)
 
             if '::' in field:
-                # We've got an annotated filter
-                agg, f = field.split('::', 1)
-                field = 'f%s%s' % (index, field)
-                key = 'f%s%s' % (index, key)
-                annotations[field] = self.available_aggregations[agg](f, distinct=True)
-                annotation_filters[key] = val
+                # We've got an annotated filter, which reuses a column or earlier filter that aggregates the same way
+                aggregate = canonical_node(self.base_model, parsed.expression)
+                name = self.annotation_keys.get(aggregate)
+                if name is None:
+                    name = self.annotation_keys[aggregate] = 'f%s%s' % (index, field)
+                    annotations[name] = self.build_expression(parsed.expression)
+                annotation_filters[name + exp + negate] = val
             elif key in annotations.keys():
-                annotation_filters[key] = val
+                annotation_filters[key + negate] = val
             elif key.split('__')[0] in expression_columns:
                 k = key.split('__')[0]
                 if 'date' in k and key.endswith('date') or 'date' in str(annotations[k]):
@@ -329,19 +507,17 @@ class Interrogator:
                     elif LITTLE_MULTIPLIERS.get(period, None):
                         kwargs['seconds'] = int(val) * LITTLE_MULTIPLIERS[period]
 
-                    annotation_filters[key] = timedelta(**kwargs)
+                    annotation_filters[key + negate] = timedelta(**kwargs)
 
                 else:
-                    annotation_filters[key] = val
+                    annotation_filters[key + negate] = val
 
             elif key.endswith('__all'):
                 key = key.rstrip('_all')
                 val = [v for v in val.split(',')]
                 filters_all[key] = val
             else:
-                exclude = key.endswith('!')
-                if exclude:
-                    key = key[:-1]
+                exclude = parsed.exclude
                 if key.endswith('__in'):
                     val = [v for v in val.split(',')]
                 if exclude:
@@ -349,11 +525,15 @@ class Interrogator:
                 else:
                     _filters[key] = val
 
-        return filters_all, _filters,  annotations, expression_columns, excludes
+        return filters_all, _filters, annotations, annotation_filters, expression_columns, excludes, errors
 
-    def generate_queryset(self, base_model, columns=None, filters=None, order_by=None, limit=None, offset=0):
+    def generate_queryset(self, base_model, columns=None, filters=None, order_by=None, limit=None, offset=0,
+                          page_size=None, page_token=None, sample=None):
         errors = []
-        annotation_filters = {}
+        self.page_keys = []
+        self.annotation_keys = {}
+        self.scaled_columns = []
+        self.rollup_models = None
 
         self.base_model, base_model_data = self.validate_report_model(base_model)
         wrap_sheets = base_model_data.get('wrap_sheets', {})
@@ -370,29 +550,36 @@ class Interrogator:
                 # If the field is empty, don't do anything
                 continue
 
-            if ':=' in column:
-                var_name, column = column.split(':=', 1)
+            parsed = parse_column(column)
+            var_name = parsed.alias
 
             # Map names in UI to django functions
-            column = normalise_field(column)
+            column = normalise_field(parsed.text)
 
             if var_name is None:
                 var_name = column
 
             # Check if the column has permission
-            column_permission_errors = self.check_for_forbidden_column(column)
+            column_permission_errors = self.check_for_forbidden_column(column, parsed.expression)
             if column_permission_errors:
                 # If there are permission errors, add to error list, and don't continue
                 errors.extend(column_permission_errors)
                 continue
 
             # Build columns
-            if column.startswith(tuple([a + '::' for a in self.available_aggregations.keys()])):
-                annotations[var_name] = self.get_annotation(column)
-
-            elif any(s in column for s in math_infix_symbols.keys()):
-                annotations[var_name] = self.normalise_math(column)
-                expression_columns.append(var_name)
+            expression = parsed.expression
+            if not isinstance(expression, parser.Field):
+                key = canonical_node(self.base_model, expression)
+                if key in self.annotation_keys:
+                    # The same thing is already worked out for another column, so use that
+                    annotations[var_name] = F(self.annotation_keys[key])
+                elif isinstance(expression, parser.Call):
+                    annotations[var_name] = self.build_call(expression)
+                else:
+                    annotations[var_name] = self.build_expression(expression)
+                self.annotation_keys.setdefault(key, var_name)
+                if not isinstance(expression, parser.Call):
+                    expression_columns.append(var_name)
             else:
                 if column in wrap_sheets.keys():
                     cols = wrap_sheets.get(column).get('columns', [])
@@ -405,35 +592,326 @@ class Interrogator:
             output_columns.append(var_name)
 
         rows = self.get_model_queryset()
+        if sample:
+            rows = self.sample_queryset(rows, sample)
 
         # Generate filters
-        filters_all, _filters, annotations, expression_columns, excludes = self.generate_filters(
-            filters=filters,
-            annotations=annotations,
-            expression_columns=expression_columns
-        )
+        filters_all, _filters, annotations, annotation_filters, expression_columns, excludes, filter_errors = \
+            self.generate_filters(
+                filters=filters,
+                annotations=annotations,
+                expression_columns=expression_columns
+            )
+        errors.extend(filter_errors)
+        if sample:
+            annotations = self.scale_annotations(annotations, sample)
+        if self.rewrite_fanout:
+            annotations = rewrite_fanout(
+                self.base_model, annotations, query_columns, [*_filters, *filters_all, *excludes]
+            )
 
-        rows = rows.filter(**_filters)
-        for key, val in filters_all.items():
-            for v in val:
-                rows = rows.filter(**{key: v})
-        rows = rows.exclude(**excludes)
-        rows = rows.values(*query_columns)
 
-        if annotations:
-            rows = rows.annotate(**annotations)
-            rows = rows.filter(**annotation_filters)
+        rollup, state = None, None
+        if not errors and not page_size and not sample:
+            rollup, state = self.get_rollup(base_model, columns, filters)
+        if rollup is not None and rollup.get_state_names(state) == [*query_columns, *annotations]:
+            # The same rows have already been summarised in a table of their own
+            rows = rollup.get_queryset(state, using=rows.db)
+            self.rollup_models = state['models']
+        else:
+            rows = rows.filter(**_filters)
+            for key, val in filters_all.items():
+                for v in val:
+                    rows = rows.filter(**{key: v})
+            rows = rows.exclude(**excludes)
+            rows = rows.values(*query_columns)
+
+            if annotations:
+                rows = rows.annotate(**annotations)
+                rows = rows.filter(**annotation_filters)
         if order_by:
             ordering = map(normalise_field, order_by)
             rows = rows.order_by(*ordering)
 
-        if limit:
+        if page_size:
+            rows = self.seek(rows, order_by, query_columns, annotations, page_token)
+            rows = rows[:page_size + 1]  # One extra row tells us if there is another page
+
+        elif limit:
             lim = abs(int(limit))
             rows = rows[offset:lim]
 
         return rows, errors, output_columns, base_model_data
 
-    def interrogate(self, base_model, columns=None, filters=None, order_by=None, limit=None, offset=0):
+    def seek(self, rows, order_by, query_columns, annotations, page_token=None):
+        """
+        Order rows so that every row has a unique position, and if given a page token only return
+        rows after the row it was made from. This lets the database seek straight to the start of
+        the page using an index, rather than counting through all the rows before it like OFFSET does.
+
+        Rows are ordered by the requested `order_by` columns, then by the grouped columns (for
+        aggregated interrogations) or the primary key, so that ties are broken consistently.
+        Sorting on columns with empty (NULL) values is not supported when paging.
+        """
+        grouped = any(getattr(a, 'contains_aggregate', False) for a in annotations.values())
+        keys = []
+        extra_annotations = {}
+        for index, column in enumerate(map(normalise_field, order_by or [])):
+            descending = column.startswith('-')
+            column = column.lstrip('-')
+            if column not in query_columns and column not in annotations:
+                # We need the value of each key in the rows to make the next token
+                extra_annotations['di_seek_%s' % index] = F(column)
+                column = 'di_seek_%s' % index
+            keys.append((column, descending))
+
+        key_names = [k for k, _ in keys]
+        if grouped:
+            keys.extend((column, False) for column in query_columns if column not in key_names)
+        elif not {'pk', self.base_model._meta.pk.name} & set(key_names):
+            extra_annotations['di_seek_pk'] = F('pk')
+            keys.append(('di_seek_pk', False))
+
+        if extra_annotations:
+            rows = rows.annotate(**extra_annotations)
+        rows = rows.order_by(*[('-' if descending else '') + column for column, descending in keys])
+
+        if page_token:
+            try:
+                values = signing.loads(page_token, salt='data_interrogator.page', serializer=PageTokenSerializer)
+            except signing.BadSignature:
+                raise di_exceptions.PaginationError("The page token is invalid, please start again from the first page.")
+            if len(values) != len(keys):
+                raise di_exceptions.PaginationError("The page token doesn't match this interrogation.")
+            if None in values:
+                raise di_exceptions.PaginationError("Can't page through a sorted column with empty values.")
+
+            # (a > x) or (a = x and b > y) or ...
+            after = Q()
+            for index, (column, descending) in enumerate(keys):
+                condition = Q(**{'%s__%s' % (column, 'lt' if descending else 'gt'): values[index]})
+                for (prior, _), value in zip(keys[:index], values[:index]):
+                    condition &= Q(**{prior: value})
+                after |= condition
+            rows = rows.filter(after)
+
+        self.page_keys = [column for column, _ in keys]
+        return rows
+
+    def sample_queryset(self, rows, percent):
+        """Read about `percent` of the base table's rows, chosen at random"""
+        rows = rows.all()
+        alias = rows.query.get_initial_alias()
+        table = rows.query.alias_map[alias]
+        rows.query.alias_map[alias] = SampledTable(table.table_name, alias, percent, method=self.sample_method)
+        return rows
+
+    def scale_annotations(self, annotations, percent):
+        """
+        Scale up sums and counts of the sampled rows to estimates for the whole table. Aggregates over the
+        related rows of each sampled row, such as a salesperson's sales, are exact for that row so aren't scaled.
+        """
+        factor = Decimal(100) / Decimal(str(percent))
+        scaled = dict(annotations)
+        for name, annotation in annotations.items():
+            if isinstance(annotation, (Sum, Count)) and not any(
+                to_many_prefix(self.base_model, path) for path in fanout.field_paths(annotation)
+            ):
+                scaled[name] = Scale(annotation, factor)
+                self.scaled_columns.append(name)
+        return scaled
+
+    def get_sample_percent(self, base_model, sample=None, sample_rows=None):
+        """
+        Return the percentage of the base table to sample, either as given or enough to read about
+        `sample_rows` rows. Returns None if the whole table would be read anyway.
+        """
+        try:
+            if sample_rows:
+                sample_rows = int(sample_rows)
+                if sample_rows < 1:
+                    raise ValueError
+                model, _ = self.validate_report_model(base_model)
+                rows = table_size(connections[self.database or model._default_manager.db], model._meta.db_table)
+                sample = round(100.0 * sample_rows / rows, 4) if rows else 100
+            sample = float(sample)
+        except ValueError:
+            raise di_exceptions.SamplingError("Sample must be a percentage, or a number of rows, greater than zero")
+        if not 0 < sample:
+            raise di_exceptions.SamplingError("Sample must be a percentage, or a number of rows, greater than zero")
+        return max(sample, 0.0001) if sample < 100 else None
+
+    def make_page_token(self, row, keys) -> str:
+        """Make an opaque token that points to the position after the given row"""
+        return signing.dumps([row[k] for k in keys], salt='data_interrogator.page', serializer=PageTokenSerializer)
+
+    def get_query_cache_key(self, base_model, columns, filters, order_by, **options) -> tuple:
+        """
+        Everything that can change the SQL of an interrogation, this includes the permission
+        rules and settings of the interrogator as two identical requests may produce different
+        queries for different interrogators.
+        """
+        rollup, state = self.get_rollup(base_model, columns, filters)
+        return (
+            type(self), freeze(self.report_models), freeze(self.allowed), freeze(self.excluded), self.database,
+            freeze(self.available_aggregations), self.use_rollups, self.rewrite_fanout, self.sample_method,
+            base_model, freeze(columns), freeze(filters), freeze(order_by), freeze(options),
+            state and state['version']
+        )
+
+    def get_rollup(self, base_model, columns, filters):
+        """Return an up to date rollup of an interrogation and its state, or (None, None) if there isn't one"""
+        if not self.use_rollups or type(self).get_model_queryset is not Interrogator.get_model_queryset:
+            # Rollups are built from every row, so can't be used by interrogators that only see some
+            return None, None
+        lookup = (base_model, freeze(columns or []), freeze(filters or []))
+        if self.rollup_lookup and self.rollup_lookup[0] == lookup:
+            return self.rollup_lookup[1]
+        found = find_rollup(
+            base_model, columns or [], filters or [], using=self.database or 'default', interrogator_class=type(self)
+        )
+        if self.rollup_lookup is not None:
+            self.rollup_lookup = (lookup, found)
+        return found
+
+    def build_compiled_query(self, key, base_model, columns, filters, order_by, **options) -> CompiledQuery:
+        with self.profile.stage('parse'):
+            generated = self.generate_queryset(base_model, columns, filters, order_by, **options)
+        with self.profile.stage('compile'):
+            compiled = CompiledQuery(*generated)
+        compiled.key = key
+        compiled.page_keys = self.page_keys
+        compiled.scaled_columns = self.scaled_columns
+        if self.rollup_models:
+            # Summary tables change along with the models they are built from, so cached results must too
+            compiled.models = self.rollup_models
+        return compiled
+
+    def compile_query(self, base_model, columns, filters, order_by, **options) -> CompiledQuery:
+        """Return the compiled SQL for an interrogation, reusing a cached copy where possible"""
+        self.rollup_lookup = ()
+        try:
+            key = self.get_query_cache_key(base_model, columns, filters, order_by, **options)
+            if not self.use_query_cache:
+                return self.build_compiled_query(key, base_model, columns, filters, order_by, **options)
+
+            cache = get_query_cache()
+            compiled = cache.get(key)
+            self.profile.record(query_cache='miss' if compiled is None else 'hit')
+            if compiled is None:
+                compiled = self.build_compiled_query(key, base_model, columns, filters, order_by, **options)
+                cache.set(key, compiled)
+            else:
+                # generate_queryset would normally have set this
+                self.base_model, _ = self.validate_report_model(base_model)
+            return compiled
+        finally:
+            self.rollup_lookup = None
+
+    def execute(self, compiled, columnar=False) -> list:
+        """Run a compiled interrogation, returning rows as dictionaries or, for columnar results, tuples"""
+        with self.profile.stage('execute'):
+            results = compiled.fetch(timeout=self.max_execution_time)
+        with self.profile.stage('materialise'):
+            if columnar:
+                return compiled.build_tuples(results)
+            return compiled.build_rows(results)
+
+    def fetch_rows(self, compiled, columnar=False) -> list:
+        """Execute a compiled interrogation, going via the result cache if it is turned on"""
+        if not self.result_cache_ttl or compiled.sql is None:
+            return self.execute(compiled, columnar=columnar)
+
+        cache = di_cache.get_result_cache()
+        key = di_cache.result_cache_key((compiled.key, columnar), di_cache.get_generations(compiled.models))
+        rows = cache.get(key)
+        self.profile.record(result_cache='miss' if rows is None else 'hit')
+        if rows is None:
+            rows = self.execute(compiled, columnar=columnar)
+            cache.set(key, rows, self.result_cache_ttl)
+        return rows
+
+    def check_query_cost(self, compiled, base_model, columns, filters, order_by, can_limit=True,
+                         **options) -> Tuple[CompiledQuery, str]:
+        """
+        Check the planner's estimate of an interrogation's cost against `max_query_cost`. Returns the query
+        to run, which may have been limited, and a warning if it was. Raises QueryCostError if it is too
+        expensive, or if it can't be limited because every row is needed (`can_limit` is False).
+        """
+        if not self.max_query_cost or compiled.sql is None:
+            return compiled, None
+        with self.profile.stage('cost'):
+            cost = compiled.estimate_cost()
+        self.profile.record(estimated_cost=cost)
+        if cost is None or cost <= self.max_query_cost:
+            return compiled, None
+
+        if can_limit and self.query_cost_action == 'limit' and not options.get('page_size'):
+            offset = options.get('offset') or 0
+            limit = offset + self.cost_limit_rows
+            if not options.get('limit') or int(options['limit']) > limit:
+                limited = self.compile_query(
+                    base_model, columns, filters, order_by, **dict(options, limit=limit, offset=offset)
+                )
+                with self.profile.stage('cost'):
+                    cost = limited.estimate_cost()
+                self.profile.record(estimated_cost=cost)
+                if cost is None or cost <= self.max_query_cost:
+                    warning = "This interrogation is too expensive to run in full, only the first %d rows are shown." % (
+                        self.cost_limit_rows
+                    )
+                    return limited, warning
+
+        raise di_exceptions.QueryCostError(
+            "This interrogation is estimated to cost %d, more than the limit of %d, try adding filters." % (
+                cost, self.max_query_cost
+            )
+        )
+
+    def report_stats(self, compiled, stats, explain=False):
+        """Add details of the query to an interrogation's stats and send them to the stats hook"""
+        if compiled is not None and compiled.sql is not None:
+            stats['sql'] = compiled.sql
+            stats['params'] = list(compiled.params)
+            if explain:
+                stats['explain'] = compiled.explain()
+        hook = get_stats_hook(self.stats_hook)
+        if hook:
+            hook(stats)
+        return stats
+
+    def get_error_message(self, error, limit=None):
+        """Turn an exception raised while interrogating into something that can be shown to a user"""
+        if isinstance(error, (
+            di_exceptions.InvalidAnnotationError, di_exceptions.PaginationError, di_exceptions.QueryTimeoutError, di_exceptions.QueryCostError,
+            di_exceptions.ParseError, di_exceptions.SamplingError,
+        )):
+            return str(error)
+        if isinstance(error, ValueError):
+            if limit is None:
+                return "Limit must be a number"
+            elif limit < 1:
+                return "Limit must be a number greater than zero"
+            return "Something went wrong - %s" % error
+        if isinstance(error, IndexError):
+            return "No rows returned for your query, try broadening your search."
+        if isinstance(error, exceptions.FieldError):
+            if str(error).startswith('Cannot resolve keyword'):
+                field = str(error).split("'")[1]
+                return "The requested field '%s' was not found in the database." % field
+            return "An error was found with your query:\n%s" % error
+        return "Something went wrong - %s" % error
+
+    def stream(self, base_model, columns=None, filters=None, order_by=None, chunk_size=2000):
+        """
+        Like `interrogate`, but `rows` is an iterator that fetches from the database in chunks
+        (using a server-side cursor where the database supports it) so that large results
+        never need to be held in memory at once. `fields` has the output field of each column.
+
+        The same guard rails apply: every fetch is stopped after `max_execution_time` seconds, and as
+        every row is wanted, interrogations costing more than `max_query_cost` are rejected rather than
+        limited. Rows stop after `max_rows`, adding a warning to `errors` once they have been read.
+        """
         if order_by is None: order_by = []
         if filters is None: filters = []
         if columns is None: columns = []
@@ -441,85 +919,540 @@ class Interrogator:
         errors = []
         base_model_data = {}
         output_columns = []
-        count = 0
-        rows = []
+        fields = OrderedDict()
+        rows = iter([])
 
         try:
-            rows, errors, output_columns, base_model_data = self.generate_queryset(
-                base_model, columns, filters, order_by, limit, offset
-            )
-            if errors:
-                rows = rows.none()
-            rows = list(rows)  # Force a database hit to check the in database state
-            count = len(rows)
+            with self.routed():
+                options = {}
+                if self.max_rows:
+                    # Fetch one row too many, to tell if the result was cut short
+                    options['limit'] = self.max_rows + 1
+                compiled = self.compile_query(base_model, columns, filters, order_by, **options)
+                errors = list(compiled.errors)
+                output_columns = compiled.output_columns
+                base_model_data = compiled.base_model_data
+                if not errors:
+                    compiled, _ = self.check_query_cost(
+                        compiled, base_model, columns, filters, order_by, can_limit=False, **options
+                    )
+                    fields = compiled.fields
+                    rows = self.iterate_rows(compiled, chunk_size, errors)
+        except Exception as e:
+            errors.append(self.get_error_message(e))
 
-        except di_exceptions.InvalidAnnotationError as e:
-            errors.append(e)
+        return {
+            'rows': rows, 'columns': output_columns, 'fields': fields, 'errors': errors,
+            'base_model': base_model_data
+        }
 
-        except ValueError as e:
-            rows = []
-            if limit is None:
-                errors.append("Limit must be a number")
-            elif limit < 1:
-                errors.append("Limit must be a number greater than zero")
-            else:
-                errors.append("Something went wrong - %s" % e)
+    def iterate_rows(self, compiled, chunk_size, errors):
+        """Yield the rows of a compiled interrogation, stopping after `max_rows` with a warning added to `errors`"""
+        for count, row in enumerate(compiled.iterate(chunk_size, timeout=self.max_execution_time)):
+            if self.max_rows and count == self.max_rows:
+                errors.append(self.max_rows_warning())
+                return
+            yield row
+
+    def max_rows_warning(self) -> str:
+        return "This interrogation returned more than %d rows, only the first %d are shown." % (
+            self.max_rows, self.max_rows
+        )
 
-        except IndexError as e:
-            rows = []
-            errors.append("No rows returned for your query, try broadening your search.")
+    def count(self, base_model, columns, filters, order_by, approximate=False) -> Tuple[int, bool]:
+        """
+        Count every row an interrogation would return, ignoring any limit or paging.
+        Returns the total and whether it is only an estimate from the query planner.
+        """
+        compiled = self.compile_query(base_model, columns, filters, order_by)
+        if approximate:
+            estimate = compiled.estimate_count()
+            if estimate is not None:
+                return estimate, True
+        return compiled.count(timeout=self.max_execution_time), False
+
+    def interrogate(self, base_model, columns=None, filters=None, order_by=None, limit=None, offset=0,
+                    page_size=None, page_token=None, total=None, profile=False, explain=False, columnar=False,
+                    sample=None, sample_rows=None):
+        """
+        Run an interrogation and return the rows along with any errors.
+
+        With `columnar`, the result has `data` instead of `rows`: an ordered mapping of each
+        row key to an array of that column's values, which is smaller and faster to serialise.
+
+        Passing a `page_size` returns that many rows, along with a `next_page` token that can be
+        passed back as `page_token` to get the rows that follow. Paging like this costs the
+        same for every page, unlike `limit` and `offset`.
+
+        With `sample`, only about that percentage of the base table's rows are read (or with `sample_rows`,
+        enough of them to read about that many rows). Sums and counts are scaled up to estimates for
+        the whole table, and the result has `sample` with the percentage read and the scaled columns.
+
+        `count` is the number of rows returned. To also get the number of rows across all pages,
+        pass `total='exact'` to run a separate count query, or `total='approximate'` to use the
+        database's estimate where one is available.
+
+        Queries are stopped after `max_execution_time` seconds, results are cut to `max_rows` rows
+        and expensive queries are checked against `max_query_cost` before they run.
+
+        With `profile` (or `explain`, which also adds the query plan) the result includes `stats`:
+        the time spent in each stage, the SQL run and the number of rows. Stats are also sent to
+        the stats hook, if there is one, for every interrogation. `profile` can also be a `Profile`
+        instance to collect the timings in.
+        """
+        if order_by is None: order_by = []
+        if filters is None: filters = []
+        if columns is None: columns = []
+
+        errors = []
+        base_model_data = {}
+        output_columns = []
+        count = 0
+        rows = []
+        data = OrderedDict()
+        hidden = []
+        next_page = None
+        total_count, total_is_approximate = 0, False
+        compiled = None
+        sampled = None
+
+        if isinstance(profile, Profile):
+            self.profile = profile
+        elif profile or explain or get_stats_hook(self.stats_hook):
+            self.profile = Profile()
+        started = time.perf_counter()
+
+        try:
+            with self.routed():
+                options = {'limit': limit, 'offset': offset}
+                if page_size:
+                    try:
+                        page_size = int(page_size)
+                    except ValueError:
+                        page_size = 0
+                    if page_size < 1:
+                        raise di_exceptions.PaginationError("Page size must be a number greater than zero")
+                    if self.max_rows:
+                        page_size = min(page_size, self.max_rows)
+                    options = {'page_size': page_size, 'page_token': page_token or None}
+                elif self.max_rows:
+                    # Fetch one row too many, to tell if the result was cut short
+                    offset = int(offset or 0)
+                    if not limit or int(limit) - offset > self.max_rows:
+                        options['limit'] = offset + self.max_rows + 1
+                if sample or sample_rows:
+                    sampled = self.get_sample_percent(base_model, sample, sample_rows)
+                    if sampled:
+                        options['sample'] = sampled
+
+                compiled = self.compile_query(base_model, columns, filters, order_by, **options)
+                self.profile.record(database=compiled.using)
+                errors = list(compiled.errors)
+                output_columns = compiled.output_columns
+                base_model_data = compiled.base_model_data
+                if not errors:
+                    compiled, warning = self.check_query_cost(compiled, base_model, columns, filters, order_by, **options)
+                    if warning:
+                        errors.append(warning)
+                rows = self.fetch_rows(compiled, columnar=columnar)  # Force a database hit to check the in database state
+
+                if self.max_rows and not page_size and len(rows) > self.max_rows:
+                    rows = rows[:self.max_rows]
+                    errors.append(self.max_rows_warning())
+
+                if page_size:
+                    if len(rows) > page_size:
+                        rows = rows[:page_size]
+                        last = dict(zip(compiled.names, rows[-1])) if columnar else rows[-1]
+                        next_page = self.make_page_token(last, compiled.page_keys)
+                    hidden = [k for k in compiled.page_keys if k.startswith('di_seek_')]
+                    if hidden and not columnar:
+                        rows = [{k: v for k, v in row.items() if k not in hidden} for row in rows]
+                count = len(rows)
+                if columnar:
+                    with self.profile.stage('materialise'):
+                        data = compiled.build_columns(rows, exclude=hidden)
+
+                if total and not errors:
+                    with self.profile.stage('count'):
+                        total_count, total_is_approximate = self.count(
+                            base_model, columns, filters, order_by, approximate=(total == 'approximate')
+                        )
 
-        except exceptions.FieldError as e:
-            rows = []
-            if str(e).startswith('Cannot resolve keyword'):
-                field = str(e).split("'")[1]
-                errors.append("The requested field '%s' was not found in the database." % field)
-            else:
-                errors.append("An error was found with your query:\n%s" % e)
         except Exception as e:
             rows = []
-            errors.append("Something went wrong - %s" % e)
+            errors.append(self.get_error_message(e, limit))
 
-        return {
+        result = {
             'rows': rows, 'count': count, 'columns': output_columns, 'errors': errors,
             'base_model': base_model_data
         }
+        if sampled:
+            result['sample'] = {'percent': sampled, 'scaled': compiled.scaled_columns if compiled else []}
+        if columnar:
+            result['data'] = data
+            del result['rows']
+        if page_size:
+            result['next_page'] = next_page
+        if total:
+            result['total'] = total_count
+            result['total_is_approximate'] = total_is_approximate
+
+        if self.profile.enabled:
+            self.profile.record(
+                base_model=base_model, columns=columns, filters=filters, order_by=order_by,
+                rows=count, errors=[str(e) for e in errors], total_time=round(time.perf_counter() - started, 6)
+            )
+            stats = self.report_stats(compiled, self.profile.as_dict(), explain=explain)
+            if profile or explain:
+                result['stats'] = stats
+            self.profile = NULL_PROFILE
+        return result
+
+    def interrogate_incremental(self, base_model, columns, watermark, filters=None, order_by=None, refresh=False):
+        """
+        Run an aggregate interrogation of a table that is only added to, reading only the rows with a
+        `watermark` (a column of the base model that only goes up, such as a date) past those read last time
+        and merging them into the groups kept from then. `refresh` starts again from every row.
+
+        The result has `incremental` with the watermark read up to and whether every row was read. Columns
+        other than sum, count, min, max and avg, filters on aggregates and to-many joins can't be merged, so
+        these interrogations are run in full with `incremental` set to None.
+
+        New rows are read within `max_execution_time` and checked against `max_query_cost`, but never cut
+        down, and the merged rows are cut to `max_rows` like those of `interrogate`.
+        """
+        filters = [f for f in filters or [] if f]
+        order_by = [normalise_field(o) for o in order_by or [] if o]
+        watermark = normalise_field(watermark)
+        query_columns, merges, averages = incremental.plan_columns(columns, self.get_column_name)
+
+        with self.routed():
+            rows, errors = None, True
+            if query_columns is not None:
+                try:
+                    rows, errors, output_columns, base_model_data = self.generate_queryset(
+                        base_model, query_columns, filters
+                    )
+                except Exception:
+                    pass  # Running the interrogation in full reports what was wrong
+            watermark_error = None
+            if not errors and not self.is_watermark(watermark):
+                watermark_error = "The watermark [%s] isn't a column of the base model" % watermark
+            # Rows already summarised in a rollup are quicker to read in full
+            if errors or watermark_error or rows.model is not self.base_model \
+                    or not incremental.is_mergeable(rows.query):
+                result = self.interrogate(base_model, columns, filters, order_by)
+                if watermark_error:
+                    result['errors'].append(watermark_error)
+                result['incremental'] = None
+                return result
+
+            key = incremental.state_key(
+                self.get_query_cache_key(base_model, columns, filters, [], watermark=watermark)
+            )
+            cache = di_cache.get_result_cache()
+            state = None if refresh else cache.get(key)
+            last = state['watermark'] if state else None
+            groups = OrderedDict((k, dict(row)) for k, row in state['groups'].items()) if state else OrderedDict()
+
+            # Averages take the place of their hidden sums
+            hidden = {name for total, count in averages.values() for name in (total, count)}
+            average_of = {total: name for name, (total, count) in averages.items()}
+
+            def shown(names):
+                return [average_of.get(name, name) for name in names if name not in hidden or name in average_of]
+
+            new_rows = self.get_model_queryset()
+            if last is not None:
+                new_rows = new_rows.filter(**{watermark + '__gt': last})
+            try:
+                # Rows added while this runs are left for next time
+                with statement_timeout(connections[new_rows.db], self.max_execution_time):
+                    high = new_rows.aggregate(di_watermark=Max(watermark))['di_watermark']
+                if high is not None:
+                    if last is not None:
+                        rows = rows.filter(**{watermark + '__gt': last})
+                    rows = rows.filter(**{watermark + '__lte': high})
+                    compiled = CompiledQuery(rows, [], output_columns, base_model_data)
+                    # Merging only some of the new rows would lose the rest for good
+                    compiled, _ = self.check_query_cost(compiled, base_model, query_columns, filters, [], can_limit=False)
+                    group_names = [name for name in compiled.names if name not in merges]
+                    new_groups = compiled.build_rows(compiled.fetch(timeout=self.max_execution_time))
+                    incremental.merge_rows(groups, new_groups, group_names, merges)
+                    cache.set(key, {'watermark': high, 'groups': groups}, None)
+            except Exception as e:
+                return {
+                    'rows': [], 'count': 0, 'columns': shown(output_columns), 'errors': [self.get_error_message(e)],
+                    'base_model': base_model_data, 'incremental': None,
+                }
+
+        names = shown([*rows.query.values_select, *rows.query.annotation_select])
+        result_rows = incremental.sort_rows(incremental.build_rows(groups, names, averages), order_by)
+        errors = []
+        if self.max_rows and len(result_rows) > self.max_rows:
+            result_rows = result_rows[:self.max_rows]
+            errors.append(self.max_rows_warning())
+        return {
+            'rows': result_rows, 'count': len(result_rows), 'columns': shown(output_columns), 'errors': errors,
+            'base_model': base_model_data,
+            'incremental': {'watermark': high if high is not None else last, 'full': last is None},
+        }
+
+    def is_watermark(self, name) -> bool:
+        try:
+            field = self.base_model._meta.get_field(name)
+        except exceptions.FieldDoesNotExist:
+            return False
+        return field.concrete and not field.is_relation
+
+    def get_column_name(self, column) -> str:
+        """The name a column is given in the rows of an interrogation"""
+        if ':=' in column:
+            return column.split(':=', 1)[0].strip()
+        return normalise_field(column)
+
+    def is_aggregate_column(self, column) -> bool:
+        if ':=' in column:
+            column = column.split(':=', 1)[1]
+        column = normalise_field(column)
+        return any(
+            column.startswith(name + '::') and issubclass(aggregation, Aggregate)
+            for name, aggregation in self.available_aggregations.items()
+        )
+
+    def can_merge_aggregates(self, model, columns) -> bool:
+        """
+        Whether aggregate columns from separate interrogations can share a query. Each aggregate's
+        to-many joins are added to the others', so only merge if no count, sum or other aggregate
+        that changes with repeated rows would be joined to more rows than it is on its own.
+        """
+        joined, chains = set(), []
+        for column in columns:
+            if not self.is_aggregate_column(column):
+                continue
+            try:
+                expression = parse_column(column).expression
+            except di_exceptions.ParseError:
+                return False
+            prefixes = {to_many_prefix(model, path) for path in parser.field_paths(expression)} or {''}
+            joined |= prefixes
+            if not (isinstance(expression, parser.Call) and expression.name in ('min', 'max')):
+                # Every relation on the way to one of the aggregate's own to-many relations is already joined
+                chains.append({
+                    '__'.join(prefix.split('__')[:i]) for prefix in prefixes for i in range(len(prefix.split('__')) + 1)
+                })
+        return all(joined <= chain for chain in chains)
+
+    def get_batch_key(self, base_model, columns=None, filters=None, order_by=None, limit=None, offset=0, **options):
+        """
+        Interrogations with the same key can be merged into one query, as they only differ in the
+        aggregates they add to the same groups. Returns None for interrogations that can't be merged.
+        """
+        columns = [c for c in columns or [] if c]
+        if any(options.values()) or not any(self.is_aggregate_column(c) for c in columns):
+            return None
+        return (
+            base_model.lower(),
+            tuple(sorted(f for f in filters or [] if f)),
+            tuple(sorted(c for c in columns if not self.is_aggregate_column(c))),
+            tuple(order_by or []), limit, offset,
+        )
+
+    def interrogate_batch(self, interrogations) -> list:
+        """
+        Run several interrogations, each a dictionary of arguments to `interrogate`, returning their
+        results in the same order. Interrogations that only differ in their aggregates are merged into
+        a single query, and everything runs on one database connection inside one transaction.
+        """
+        results = [None] * len(interrogations)
+        batches = OrderedDict()
+        for i, interrogation in enumerate(interrogations):
+            key = self.get_batch_key(**interrogation)
+            batches.setdefault(key if key is not None else ('single', i), []).append(i)
+
+        with self.routed():
+            with transaction.atomic(using=self.database or DEFAULT_DB_ALIAS):
+                for indexes in batches.values():
+                    merged = None
+                    if len(indexes) > 1:
+                        merged = self.interrogate_merged([interrogations[i] for i in indexes])
+                    for n, i in enumerate(indexes):
+                        results[i] = merged[n] if merged else self.interrogate_in_savepoint(interrogations[i])
+        return results
+
+    def interrogate_merged(self, interrogations):
+        """
+        Run interrogations with the same batch key as one query over all of their columns, then split the
+        rows back up. Returns None if they can't be merged after all.
+        """
+        columns, names = [], {}
+        for interrogation in interrogations:
+            for column in interrogation['columns']:
+                if not column or column in columns:
+                    continue
+                name = self.get_column_name(column)
+                if name in names:
+                    # Two different columns would be given the same name
+                    return None
+                names[name] = column
+                columns.append(column)
+
+        model, _ = self.validate_report_model(interrogations[0]['base_model'])
+        if not self.can_merge_aggregates(model, columns):
+            return None
+
+        data = self.interrogate_in_savepoint(dict(interrogations[0], columns=columns))
+        if data['errors']:
+            # Run them separately so that each only gets its own errors
+            return None
+
+        results = []
+        for interrogation in interrogations:
+            own_columns = [c for c in interrogation['columns'] if c]
+            # Match the order of a single interrogation, where plain fields come before annotations
+            keys = [self.get_column_name(c) for c in own_columns]
+            fields = [
+                k for k, c in zip(keys, own_columns) if k == normalise_field(c) and not self.is_aggregate_column(c)
+            ]
+            row_keys = fields + [k for k in keys if k not in fields]
+            results.append(dict(
+                data,
+                rows=[{k: row[k] for k in row_keys} for row in data['rows']],
+                columns=keys,
+            ))
+        return results
+
+    def interrogate_in_savepoint(self, interrogation) -> dict:
+        """Interrogate inside a savepoint, so that a failed query doesn't break the rest of the transaction"""
+        savepoint = transaction.savepoint(using=self.database or DEFAULT_DB_ALIAS)
+        result = self.interrogate(**interrogation)
+        if result['errors']:
+            transaction.savepoint_rollback(savepoint, using=self.database or DEFAULT_DB_ALIAS)
+        else:
+            transaction.savepoint_commit(savepoint, using=self.database or DEFAULT_DB_ALIAS)
+        return result
 
 
 class PivotInterrogator(Interrogator):
+    # Pivots with up to this many column headers are cross-tabulated by the database, using
+    # one conditional aggregate per header. Wider pivots are grouped by the database and
+    # arranged into a grid in Python instead.
+    max_sql_pivot_columns = 50
+
     def __init__(self, aggregators, **kwargs):
         super().__init__(**kwargs)
         self.aggregators = aggregators
+        self.pivot_headers = None
 
-    def get_base_annotations(self):
-        aggs = {
+    def get_aggregators(self):
+        return {
             x: self.get_annotation(normalise_field(x)) for x in self.aggregators
-            if not self.has_forbidden_join(column=x)
+            if not self.check_for_forbidden_column(normalise_field(x))
         }
-        aggs.update({"cell": Count(1)})
-        return aggs
 
-    def pivot(self):
-        # Only accept the first two valid columns
-        self.columns = [normalise_field(c) for c in self.columns if not self.has_forbidden_join(column=c)][:2]
+    def get_base_annotations(self):
+        aggs = self.get_aggregators()
+        if self.pivot_headers is None:
+            aggs.update({"cell": Count(1)})
+            return aggs
+
+        # Cross-tabulate in the database with one conditional aggregate for each header and aggregator
+        x, headers = self.pivot_headers
+        pivoted = {}
+        for i, header in enumerate(headers):
+            condition = Q(**{x: header}) if header is not None else Q(**{'%s__isnull' % x: True})
+            pivoted['pivot_%d_cell' % i] = Count(1, filter=condition)
+            for j, aggregate in enumerate(aggs.values()):
+                aggregate = aggregate.copy()
+                aggregate.filter = condition
+                pivoted['pivot_%d_%d' % (i, j)] = aggregate
+        return pivoted
+
+    def get_query_cache_key(self, *args, **kwargs) -> tuple:
+        return super().get_query_cache_key(*args, **kwargs) + (
+            freeze(self.aggregators), freeze(self.pivot_headers), self.max_sql_pivot_columns
+        )
 
-        data = self.interrogate()
-        out_rows = {}
+    def can_pivot_in_database(self) -> bool:
+        return all(isinstance(a, Aggregate) for a in self.get_aggregators().values())
 
-        col_head = self.base_model.objects.values(self.columns[0]).order_by(self.columns[0]).distinct()
+    def pivot(self, base_model, columns, filters=None):
+        self.base_model, _ = self.validate_report_model(base_model)
 
-        x, y = self.columns[:2]
+        # Only accept the first two valid columns
+        columns = [normalise_field(c) for c in columns if not self.has_forbidden_join(column=normalise_field(c))][:2]
+        if len(columns) < 2:
+            return {
+                'rows': {}, 'col_head': [], 'errors': ["Pivot tables need two columns that can be shown."],
+                'base_model': {}
+            }
+        x, y = columns
+
+        with self.routed():
+            headers = None
+            if self.can_pivot_in_database():
+                # The headers are the values of `x` left by the same filters, as they are in Python
+                rows, errors, _, _ = self.generate_queryset(base_model, columns=[x], filters=filters or [], order_by=[x])
+                if not errors:
+                    headers = [r[x] for r in rows[:self.max_sql_pivot_columns + 1]]
+            if headers is not None and len(headers) <= self.max_sql_pivot_columns:
+                return self.pivot_in_database(base_model, x, y, headers, filters)
+            return self.pivot_in_python(base_model, x, y, filters)
+
+    def pivot_in_database(self, base_model, x, y, headers, filters):
+        """One row per `y` value, with a conditional aggregate for each `x` header"""
+        self.pivot_headers = (x, headers)
+        try:
+            data = self.interrogate(base_model, columns=[y], filters=filters or [], order_by=[y])
+        finally:
+            self.pivot_headers = None
 
-        from collections import OrderedDict
-        default = OrderedDict([(c[x], {'count': 0}) for c in col_head])
+        names = list(self.get_aggregators().keys())
+        out_rows = OrderedDict()
         for r in data['rows']:
-            this_row = out_rows.get(r[y], default.copy())
-            this_row[r[x]] = {'count': r['cell'],
-                              'aggs': [(k, v) for k, v in r.items() if k not in ['cell', x, y]]
-                              }
-            out_rows[r[y]] = this_row
+            cells = OrderedDict()
+            for i, header in enumerate(headers):
+                count = r['pivot_%d_cell' % i]
+                if count:
+                    cells[header] = {'count': count, 'aggs': [(n, r['pivot_%d_%d' % (i, j)]) for j, n in enumerate(names)]}
+                else:
+                    cells[header] = {'count': 0}
+            out_rows[r[y]] = cells
 
         return {
-            'rows': out_rows, 'col_head': col_head, 'errors': data['errors'],
-            'base_model': data['base_model'], 'headers': data['headers']
+            'rows': out_rows, 'col_head': [{x: header} for header in headers], 'errors': data['errors'],
+            'base_model': data['base_model']
+        }
+
+    def pivot_in_python(self, base_model, x, y, filters):
+        """
+        Group by both columns in the database, then lay the cells out in a grid. The headers come
+        from the rows themselves, so only one query is needed, and each row of the grid is
+        allocated once at its final size.
+        """
+        data = self.interrogate(base_model, columns=[x, y], filters=filters or [])
+        rows = data['rows']
+
+        headers = sorted({r[x] for r in rows}, key=lambda v: (v is not None, v))
+        positions = {header: i for i, header in enumerate(headers)}
+        grid = OrderedDict()
+        for r in rows:
+            cells = grid.get(r[y])
+            if cells is None:
+                cells = grid[r[y]] = [None] * len(headers)
+            cells[positions[r[x]]] = {
+                'count': r['cell'],
+                'aggs': [(k, v) for k, v in r.items() if k not in ['cell', x, y]]
+            }
+
+        out_rows = OrderedDict(
+            (key, OrderedDict(
+                (header, cell if cell is not None else {'count': 0}) for header, cell in zip(headers, cells)
+            ))
+            for key, cells in grid.items()
+        )
+        return {
+            'rows': out_rows, 'col_head': [{x: header} for header in headers], 'errors': data['errors'],
+            'base_model': data['base_model']
         }
@@ -0,0 +1,157 @@
+"""
+Interrogations run in the background. Each job is queued in a local pool of worker threads,
+and its progress and result are kept in a cache until the retention period runs out.
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+
+from data_interrogator.cache import LocalResultCache
+from data_interrogator.profiling import Profile
+from data_interrogator.workers import WorkerCall
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+DONE = (FINISHED, FAILED, CANCELLED)
+
+
+class JobProfile(Profile):
+    """Profiles a job's interrogation, recording each stage as the job's progress as it starts"""
+
+    def __init__(self, manager, job_id):
+        super().__init__()
+        self.manager = manager
+        self.job_id = job_id
+        # The stage last written to the job, so repeated stages don't write it again
+        self.current_stage = None
+
+    @contextmanager
+    def stage(self, name):
+        if name != self.current_stage:
+            self.current_stage = name
+            self.manager.update(self.job_id, stage=name)
+        with super().stage(name):
+            yield
+
+
+class JobManager:
+    """
+    Queues interrogations and keeps track of them. Job state lives in the store (a Django cache),
+    so any process sharing the store can report on a job, but only the process that
+    queued a job can interrupt it once it is running.
+    """
+
+    def __init__(self, store=None, max_workers=None, retention=None):
+        self.store = store
+        self.max_workers = max_workers or getattr(settings, 'INTERROGATOR_JOB_WORKERS', 2)
+        self.retention = retention or getattr(settings, 'INTERROGATOR_JOB_RETENTION', 60 * 60)
+        self._executor = None
+        self._calls = {}
+        self._lock = threading.RLock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix='data_interrogator_job'
+                )
+        return self._executor
+
+    def job_key(self, job_id) -> str:
+        return 'data_interrogator:job:%s' % job_id
+
+    def result_key(self, job_id) -> str:
+        return 'data_interrogator:job_result:%s' % job_id
+
+    def get(self, job_id):
+        return self.store.get(self.job_key(job_id))
+
+    def update(self, job_id, **changes):
+        with self._lock:
+            job = self.get(job_id)
+            if job is None:
+                return None
+            job.update(changes)
+            self.store.set(self.job_key(job_id), job, self.retention)
+            return job
+
+    def submit(self, interrogator, owner=None, **params) -> dict:
+        """Queue an interrogation, taking the same arguments as `Interrogator.interrogate`"""
+        job = {
+            'id': uuid.uuid4().hex, 'status': QUEUED, 'stage': None, 'owner': owner,
+            'submitted': time.time(), 'started': None, 'finished': None, 'rows': None, 'errors': [],
+        }
+        self.store.set(self.job_key(job['id']), job, self.retention)
+        call = WorkerCall(self.run, job['id'], interrogator, params)
+        with self._lock:
+            self._calls[job['id']] = call
+        self.executor.submit(call.run)
+        return job
+
+    def run(self, job_id, interrogator, params):
+        try:
+            job = self.get(job_id)
+            if job is None or job['status'] != QUEUED:
+                return
+            self.update(job_id, status=RUNNING, started=time.time())
+            try:
+                result = interrogator.interrogate(profile=JobProfile(self, job_id), **params)
+                stats = result.pop('stats', {})
+            except Exception as e:
+                self.update(job_id, status=FAILED, finished=time.time(), errors=[str(e)])
+                return
+            with self._lock:
+                job = self.get(job_id)
+                if job is None or job['status'] == CANCELLED:
+                    return
+                self.store.set(self.result_key(job_id), result, self.retention)
+                errors = [str(e) for e in result['errors']]
+                self.update(
+                    job_id, status=FAILED if errors else FINISHED, stage=None, finished=time.time(),
+                    timings=stats.get('timings'), rows=result['count'], errors=errors
+                )
+        finally:
+            with self._lock:
+                self._calls.pop(job_id, None)
+
+    def cancel(self, job_id):
+        """Stop a job, interrupting its query if it is already running"""
+        with self._lock:
+            job = self.get(job_id)
+            if job is None or job['status'] in DONE:
+                return job
+            job = self.update(job_id, status=CANCELLED, finished=time.time())
+            call = self._calls.pop(job_id, None)
+        if call is not None:
+            call.cancel()
+        return job
+
+    def result(self, job_id):
+        return self.store.get(self.result_key(job_id))
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager() -> JobManager:
+    """
+    Return the process wide job manager. Jobs are stored in the Django cache named by
+    ``INTERROGATOR_JOB_CACHE``, or in memory if that isn't set.
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            alias = getattr(settings, 'INTERROGATOR_JOB_CACHE', None)
+            store = caches[alias] if alias else LocalResultCache(maxsize=1024)
+            _manager = JobManager(store=store)
+    return _manager
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from data_interrogator.rollups import get_rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuild the summary tables declared in INTERROGATOR_ROLLUPS. Only stale rollups are rebuilt unless --force is given."
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help="Rollups to refresh, defaults to all of them")
+        parser.add_argument('--database', default='default', help="Database alias to build the rollups in")
+        parser.add_argument('--force', action='store_true', help="Refresh rollups that are already up to date")
+        parser.add_argument(
+            '--interrogator', default=None,
+            help="Dotted path of the interrogator class used to build the rollups, instead of the one each declares"
+        )
+
+    def handle(self, *args, **options):
+        rollups = get_rollups()
+        names = options['names'] or list(rollups.keys())
+        unknown = [name for name in names if name not in rollups]
+        if unknown:
+            raise CommandError("Unknown rollups: %s" % ', '.join(unknown))
+        interrogator_class = import_string(options['interrogator']) if options['interrogator'] else None
+        using = options['database']
+
+        for name in names:
+            rollup = rollups[name]
+            if not options['force'] and rollup.is_fresh(rollup.get_state(using)):
+                self.stdout.write("%s is up to date" % name)
+                continue
+            rollup.refresh(interrogator_class, using=using)
+            self.stdout.write("Refreshed %s" % name)
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import NotSupportedError
+from django.utils.module_loading import import_string
+
+from data_interrogator.advisor import advise_from_log
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay interrogations logged by data_interrogator.profiling.log_stats, check the query plan of each "
+        "and suggest indexes for the tables they read in full."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'log', nargs='?', default=getattr(settings, 'INTERROGATOR_STATS_LOG', None),
+            help="File of logged interrogations, defaults to INTERROGATOR_STATS_LOG"
+        )
+        parser.add_argument('--database', default='default', help="Database alias to check query plans against")
+        parser.add_argument('--limit', type=int, default=1000, help="Number of recent interrogations to replay")
+        parser.add_argument(
+            '--min-count', type=int, default=1, help="Only suggest indexes wanted by at least this many interrogations"
+        )
+        parser.add_argument(
+            '--interrogator', default='data_interrogator.interrogators.Interrogator',
+            help="Dotted path of the interrogator class used to rebuild the interrogations"
+        )
+
+    def handle(self, *args, **options):
+        if not options['log']:
+            raise CommandError("Give the file interrogations are logged to, or set INTERROGATOR_STATS_LOG")
+        try:
+            advisor = advise_from_log(
+                options['log'], import_string(options['interrogator']),
+                using=options['database'], limit=options['limit']
+            )
+        except OSError as e:
+            raise CommandError("Can't read the interrogation log: %s" % e)
+        except NotSupportedError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write("Replayed %d interrogations (%d couldn't be rebuilt)" % (advisor.interrogations, advisor.failed))
+        for table, count in advisor.table_scans.most_common():
+            self.stdout.write("  %s was read in full by %d" % (table, count))
+
+        suggestions = advisor.suggestions(min_count=options['min_count'])
+        if not suggestions:
+            self.stdout.write("No indexes to suggest")
+        for suggestion in suggestions:
+            self.stdout.write("\n%s, wanted by %d interrogations:" % (suggestion.label, suggestion.count))
+            for reason, count in suggestion.reasons.most_common(5):
+                self.stdout.write("  %s (%d)" % (reason, count))
+            self.stdout.write("  " + suggestion.as_code(suggestion.index()))
+            partial = suggestion.partial_index()
+            if partial is not None:
+                self.stdout.write("  or, as a partial index: " + suggestion.as_code(partial))
@@ -0,0 +1,274 @@
+"""
+A parser for the columns and filters of an interrogation.
+
+Columns are parsed into a small syntax tree, for example ``profit:=sum(sale.sale_price - sale.product.cost_price)``:
+
+    Column(alias='profit', expression=Call('sum', (BinOp('-', Field('sale__sale_price'), Field('sale__product__cost_price')),)))
+
+The language has fields (``sale.product.name``, or with Django's ``__``), numbers, quoted strings,
+infix math with the usual precedence and brackets, ``~`` references to other fields, and functions
+called either as ``sum(...)`` or, as the forms send them, ``sum::...`` which takes the rest of the text.
+Arguments can be conditions (``sale.state.iexact=VIC``) whose values are taken as written.
+
+Filters are a field or aggregate, a comparison and a value. Only the left hand side is parsed, the value
+is everything after the comparison. Input is read once from left to right, and parsed columns and filters
+are cached for every interrogator in the process.
+"""
+import re
+from collections import namedtuple
+
+from django.conf import settings
+
+from data_interrogator.cache import LRUCache
+from data_interrogator.exceptions import ParseError
+
+Token = namedtuple('Token', ['kind', 'value', 'start', 'end'])
+
+Field = namedtuple('Field', ['path'])
+FieldRef = namedtuple('FieldRef', ['path'])
+Number = namedtuple('Number', ['value'])
+String = namedtuple('String', ['value'])
+Negate = namedtuple('Negate', ['operand'])
+BinOp = namedtuple('BinOp', ['op', 'left', 'right'])
+Call = namedtuple('Call', ['name', 'args'])
+Condition = namedtuple('Condition', ['path', 'op', 'value'])
+Column = namedtuple('Column', ['alias', 'expression', 'text'])
+Filter = namedtuple('Filter', ['field', 'lookup', 'value', 'exclude', 'expression'])
+
+TOKEN_RE = re.compile(r'''
+    \s*(?:
+        (?P<number>\d+(?:\.\d+)?)
+      | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+      | (?P<op>:=|::|<>|<=|>=|!=|[-+*/(),.~<>=])
+    )
+''', re.VERBOSE)
+SPACE_RE = re.compile(r'\s*')
+VALUE_END_RE = re.compile(r'[,)]')
+
+# Binding power of the infix operators, higher binds tighter
+PRECEDENCE = {'+': 1, '-': 1, '*': 2, '/': 2}
+
+# Comparisons in filters, and the Django lookup each becomes
+COMPARISONS = {'<>': '__ne', '<=': '__lte', '<': '__lt', '>=': '__gte', '>': '__gt', '=': '', '!=': ''}
+
+
+class Parser:
+    """Reads tokens on demand, so that text after a comparison never has to be valid tokens"""
+
+    def __init__(self, text, filtering=False):
+        self.text = text
+        self.filtering = filtering
+        self.position = 0
+        self.token = None
+        self.advance()
+
+    def advance(self) -> Token:
+        """Move on to the next token, returning the current one"""
+        current = self.token
+        match = TOKEN_RE.match(self.text, self.position)
+        if match is None or not match.lastgroup:
+            end = SPACE_RE.match(self.text, self.position).end()
+            if end < len(self.text):
+                self.error("Unexpected character '%s'" % self.text[end], end)
+            self.token = Token('end', '', len(self.text), len(self.text))
+        else:
+            self.token = Token(match.lastgroup, match.group(match.lastgroup), match.start(match.lastgroup), match.end())
+            self.position = match.end()
+        return current
+
+    def seek(self, position):
+        self.position = position
+        self.advance()
+
+    def error(self, message, position=None):
+        raise ParseError(message, self.text, self.token.start if position is None else position)
+
+    def is_op(self, *values) -> bool:
+        return self.token.kind == 'op' and self.token.value in values
+
+    def expect(self, value):
+        if not self.is_op(value):
+            self.unexpected("expected '%s'" % value)
+        return self.advance()
+
+    def unexpected(self, hint=None):
+        found = "end of input" if self.token.kind == 'end' else "'%s'" % self.token.value
+        self.error("Unexpected %s%s" % (found, ', %s' % hint if hint else ''))
+
+    def expression(self, min_precedence=1):
+        """Precedence climbing over the infix operators, which all associate to the left"""
+        left = self.unary()
+        while self.token.kind == 'op' and PRECEDENCE.get(self.token.value, 0) >= min_precedence:
+            op = self.advance().value
+            left = BinOp(op, left, self.expression(PRECEDENCE[op] + 1))
+        return left
+
+    def unary(self):
+        if self.is_op('-'):
+            self.advance()
+            return Negate(self.unary())
+        if self.is_op('+'):
+            self.advance()
+            return self.unary()
+        return self.primary()
+
+    def primary(self):
+        token = self.token
+        if token.kind == 'number':
+            self.advance()
+            return Number(float(token.value) if '.' in token.value else int(token.value))
+        if token.kind == 'string':
+            self.advance()
+            return String(re.sub(r'\\(.)', r'\1', token.value[1:-1]))
+        if self.is_op('~'):
+            self.advance()
+            return FieldRef(self.path())
+        if self.is_op('('):
+            self.advance()
+            expression = self.expression()
+            self.expect(')')
+            return expression
+        if token.kind == 'name':
+            path = self.path()
+            if '__' not in path and self.is_op('('):
+                self.advance()
+                args = self.arguments()
+                self.expect(')')
+                return Call(path.lower(), args)
+            if '__' not in path and self.is_op('::'):
+                # The rest of the text, or of the surrounding brackets, are the arguments. In a
+                # filter they end at the comparison, so they can't have conditions of their own.
+                self.advance()
+                return Call(path.lower(), self.arguments(conditions=not self.filtering))
+            return Field(path)
+        self.unexpected()
+
+    def path(self) -> str:
+        if self.token.kind != 'name':
+            self.unexpected("expected a field name")
+        parts = [self.advance().value]
+        while self.is_op('.'):
+            self.advance()
+            if self.token.kind != 'name':
+                self.unexpected("expected a field name")
+            parts.append(self.advance().value)
+        return '__'.join(parts)
+
+    def arguments(self, conditions=True) -> tuple:
+        args = []
+        if self.is_op(')') or self.token.kind == 'end':
+            return ()
+        while True:
+            args.append(self.argument() if conditions else self.expression())
+            if not self.is_op(','):
+                return tuple(args)
+            self.advance()
+
+    def argument(self):
+        expression = self.expression()
+        if self.token.kind == 'op' and self.token.value in COMPARISONS:
+            if not isinstance(expression, Field):
+                self.unexpected("only fields can be compared in a condition")
+            # Values are taken as written, up to the next argument, without reading them as tokens
+            op = self.token
+            end = VALUE_END_RE.search(self.text, op.end)
+            end = end.start() if end else len(self.text)
+            value = self.text[op.end:end].strip()
+            self.seek(end)
+            return Condition(expression.path, op.value, value)
+        return expression
+
+    def finish(self):
+        if self.token.kind != 'end':
+            self.unexpected()
+
+
+def field_paths(node) -> list:
+    """Return the path of every field a parsed column or filter refers to, including in conditions"""
+    if isinstance(node, (Field, FieldRef, Condition)):
+        return [node.path]
+    if isinstance(node, Negate):
+        return field_paths(node.operand)
+    if isinstance(node, BinOp):
+        return field_paths(node.left) + field_paths(node.right)
+    if isinstance(node, Call):
+        return [path for arg in node.args for path in field_paths(arg)]
+    return []
+
+
+def _parse_expression(text):
+    parser = Parser(text)
+    if parser.token.kind == 'end':
+        parser.error("Expected a column")
+    expression = parser.expression()
+    parser.finish()
+    return expression
+
+
+def _parse_column(text) -> Column:
+    alias, start = None, 0
+    match = re.search(r':=', text)
+    if match:
+        alias, start = text[:match.start()].strip(), match.end()
+        if not alias:
+            raise ParseError("Expected a name before ':='", text, 0)
+    parser = Parser(text)
+    parser.seek(start)
+    if parser.token.kind == 'end':
+        parser.error("Expected a column")
+    expression = parser.expression()
+    parser.finish()
+    return Column(alias, expression, text[start:].strip())
+
+
+def _parse_filter(text) -> Filter:
+    parser = Parser(text, filtering=True)
+    if parser.token.kind == 'end':
+        parser.error("Expected a filter")
+    if parser.is_op('~'):
+        parser.unexpected()
+    expression = parser.expression()
+    if not (parser.token.kind == 'op' and parser.token.value in COMPARISONS):
+        parser.unexpected("expected a comparison such as '=' or '<'")
+    op = parser.token
+    return Filter(
+        field=text[:op.start].strip(), lookup=COMPARISONS[op.value], value=text[op.end:],
+        exclude=op.value == '!=', expression=expression,
+    )
+
+
+_cache = None
+
+
+def get_parse_cache() -> LRUCache:
+    """Return the cache of parsed columns and filters, sized by ``INTERROGATOR_PARSE_CACHE_SIZE``"""
+    global _cache
+    if _cache is None:
+        _cache = LRUCache(maxsize=getattr(settings, 'INTERROGATOR_PARSE_CACHE_SIZE', 1024))
+    return _cache
+
+
+def cached(kind, parse, text):
+    cache = get_parse_cache()
+    key = (kind, text)
+    result = cache.get(key)
+    if result is None:
+        result = parse(text)
+        cache.set(key, result)
+    return result
+
+
+def parse_expression(text):
+    """Parse a column without an alias. Raises ParseError for anything that can't be parsed"""
+    return cached('expression', _parse_expression, text)
+
+
+def parse_column(text) -> Column:
+    """Parse a column, with an optional ``name:=`` alias"""
+    return cached('column', _parse_column, text)
+
+
+def parse_filter(text) -> Filter:
+    """Parse a filter into the field (as written), the Django lookup for the comparison and the value"""
+    return cached('filter', _parse_filter, text)
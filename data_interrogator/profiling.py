@@ -0,0 +1,69 @@
+"""Optional timing of each stage of an interrogation, and hooks to send those timings elsewhere"""
+import json
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger('data_interrogator.stats')
+
+
+class Profile:
+    """Collects how long each stage of an interrogation takes, along with any other details worth reporting"""
+    enabled = True
+
+    def __init__(self):
+        self.timings = OrderedDict()
+        self.details = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.perf_counter() - start
+
+    def record(self, **details):
+        self.details.update(details)
+
+    def as_dict(self) -> dict:
+        stats = dict(self.details)
+        stats['timings'] = OrderedDict((stage, round(seconds, 6)) for stage, seconds in self.timings.items())
+        return stats
+
+
+class NullProfile:
+    """Stands in for a Profile when profiling is off, doing as little as possible"""
+    enabled = False
+    _stage = nullcontext()
+
+    def stage(self, name):
+        return self._stage
+
+    def record(self, **details):
+        pass
+
+
+NULL_PROFILE = NullProfile()
+
+
+def get_stats_hook(hook=None):
+    """
+    Return the callable that interrogation stats are sent to, either the one given
+    or the one named by the ``INTERROGATOR_STATS_HOOK`` setting.
+    """
+    if hook is None:
+        hook = getattr(settings, 'INTERROGATOR_STATS_HOOK', None)
+    if isinstance(hook, str):
+        hook = import_string(hook)
+    return hook
+
+
+def log_stats(stats):
+    """A stats hook that writes each interrogation as a line of JSON to the `data_interrogator.stats` logger"""
+    logger.info(json.dumps(stats, cls=DjangoJSONEncoder, default=str))
@@ -0,0 +1,400 @@
+"""
+Summary tables for frequently run aggregate interrogations.
+
+Rollups are declared in the ``INTERROGATOR_ROLLUPS`` setting, mapping a name to an interrogation::
+
+    INTERROGATOR_ROLLUPS = {
+        'sales_by_state': {
+            'base_model': 'shop:Sale',
+            'columns': ['seller.branch.state', 'total:=sum(sale_price)', 'sales:=count(id)'],
+            'filters': [],
+        },
+    }
+
+``refresh_rollups`` runs each interrogation into its own table with a single ``INSERT ... SELECT``.
+Interrogations asking for exactly the same columns and filters then read the summary table instead.
+
+Rows added to the base model are merged into the summary table as they are saved, in the same
+transaction, when every column is a group or a sum, count, min or max and nothing is joined more than
+once for each base row. Any other change to a model the rollup reads from marks it as stale, and
+interrogations go back to the base tables until it is rebuilt. The state of each rollup is kept in a
+table next to its summary table, so every process sees the same state.
+"""
+import json
+import re
+import threading
+import time
+import uuid
+
+from django.apps.registry import Apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, models, transaction
+from django.db.models import F
+from django.db.models.sql.datastructures import Join
+from django.utils.module_loading import import_string
+
+from data_interrogator import incremental
+from data_interrogator.cache import CompiledQuery, get_query_models
+
+# Internal types of the columns rollups can store, anything else is stored as text
+ROLLUP_FIELD_TYPES = {
+    'AutoField': models.IntegerField,
+    'BigAutoField': models.BigIntegerField,
+    'SmallAutoField': models.SmallIntegerField,
+    'PositiveIntegerField': models.IntegerField,
+    'PositiveSmallIntegerField': models.SmallIntegerField,
+    'BigIntegerField': models.BigIntegerField,
+    'IntegerField': models.IntegerField,
+    'SmallIntegerField': models.SmallIntegerField,
+    'BooleanField': models.BooleanField,
+    'NullBooleanField': models.BooleanField,
+    'FloatField': models.FloatField,
+    'DecimalField': models.DecimalField,
+    'DateField': models.DateField,
+    'DateTimeField': models.DateTimeField,
+    'TimeField': models.TimeField,
+    'DurationField': models.DurationField,
+    'CharField': models.CharField,
+    'TextField': models.TextField,
+}
+
+
+def rollup_field(field):
+    """Describe a nullable column that can hold the values of a query's output field, as (dotted path, kwargs)"""
+    if field.is_relation:
+        field = field.target_field
+    field_class = ROLLUP_FIELD_TYPES.get(field.get_internal_type(), models.TextField)
+    kwargs = {'null': True}
+    if field_class is models.CharField:
+        if not getattr(field, 'max_length', None):
+            field_class = models.TextField
+        else:
+            kwargs['max_length'] = field.max_length
+    elif field_class is models.DecimalField:
+        # Leave room for sums to grow past the size of the values being added up
+        kwargs['max_digits'] = min((field.max_digits or 20) + 10, 65)
+        kwargs['decimal_places'] = field.decimal_places or 0
+    return '%s.%s' % (field_class.__module__, field_class.__name__), kwargs
+
+
+class RollupStates:
+    """The table that every rollup's state is kept in, one row for each rollup built in that database"""
+
+    db_table = 'data_interrogator_rollup_state'
+
+    def __init__(self):
+        self._model = None
+        self._exists = set()
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = type('RollupState', (models.Model,), {
+                '__module__': __name__,
+                'Meta': type('Meta', (), {
+                    'apps': Apps(), 'app_label': 'data_interrogator_rollups', 'db_table': self.db_table,
+                    'managed': False,
+                }),
+                'name': models.CharField(max_length=100, primary_key=True),
+                'state': models.TextField(),
+                # Bumped for every change that the summary table doesn't include
+                'changes': models.BigIntegerField(default=0),
+            })
+        return self._model
+
+    def exists(self, using) -> bool:
+        if using not in self._exists:
+            if self.db_table not in connections[using].introspection.table_names():
+                return False
+            self._exists.add(using)
+        return True
+
+    def create(self, editor, using):
+        if self.db_table not in connections[using].introspection.table_names():
+            editor.create_model(self.model)
+        self._exists.add(using)
+
+    def get(self, name, using):
+        if not self.exists(using):
+            return None
+        row = self.model._default_manager.using(using).filter(name=name).values('state', 'changes').first()
+        if row is None or row['state'] == '':
+            return None
+        state = json.loads(row['state'])
+        state['stale'] = row['changes'] != state['changes']
+        return state
+
+    def get_changes(self, name, using) -> int:
+        row, _ = self.model._default_manager.using(using).get_or_create(name=name, defaults={'state': ''})
+        return row.changes
+
+    def save(self, name, state, using):
+        self.model._default_manager.using(using).filter(name=name).update(
+            state=json.dumps(state, cls=DjangoJSONEncoder)
+        )
+
+    def mark_stale(self, name, using):
+        if self.exists(using):
+            self.model._default_manager.using(using).filter(name=name).update(changes=F('changes') + 1)
+
+
+states = RollupStates()
+
+
+class Rollup:
+    """An interrogation kept up to date in a summary table"""
+
+    def __init__(self, name, base_model, columns, filters=None,
+                 interrogator='data_interrogator.interrogators.Interrogator'):
+        if not re.match(r'^[a-z][a-z0-9_]*$', name):
+            raise ImproperlyConfigured("Rollup names must be lower case identifiers, not '%s'" % name)
+        self.name = name
+        self.base_model = base_model
+        self.columns = [c for c in columns if c]
+        self.filters = [f for f in filters or [] if f]
+        # Only interrogators of this class read the rollup, as other classes may see different rows
+        self.interrogator = interrogator
+        self.db_table = 'data_interrogator_rollup_%s' % name
+        self._models = {}
+        self._sources = {}
+        self._source_models = None
+
+    @property
+    def match_key(self) -> tuple:
+        return rollup_match_key(self.base_model, self.columns, self.filters)
+
+    def get_state(self, using='default'):
+        return states.get(self.name, using)
+
+    def is_fresh(self, state) -> bool:
+        """Whether nothing the summary table doesn't include has changed since it was refreshed"""
+        return state is not None and not state['stale']
+
+    def get_state_names(self, state) -> list:
+        return [name for name, path, kwargs in state['fields']]
+
+    def get_model(self, state):
+        """Build (once for each refresh) a model for the summary table, in a registry of its own"""
+        model = self._models.get(state['version'])
+        if model is None:
+            attrs = {
+                '__module__': __name__,
+                'Meta': type('Meta', (), {
+                    'apps': Apps(), 'app_label': 'data_interrogator_rollups', 'db_table': self.db_table,
+                    'managed': False,
+                }),
+            }
+            for i, (name, path, kwargs) in enumerate(state['fields']):
+                attrs['di_col_%d' % i] = import_string(path)(db_column='c%d' % i, **kwargs)
+            model = type('Rollup_%s' % state['version'], (models.Model,), attrs)
+            self._models = {state['version']: model}
+        return model
+
+    def get_queryset(self, state, using='default'):
+        """Read the summary table, with rows named the same as the interrogation's"""
+        model = self.get_model(state)
+        return model._default_manager.using(using).values(**{
+            name: F('di_col_%d' % i) for i, (name, path, kwargs) in enumerate(state['fields'])
+        })
+
+    def get_interrogator(self, interrogator_class, using='default'):
+        from data_interrogator.interrogators import Allowable
+
+        interrogator = interrogator_class(
+            report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[]
+        )
+        interrogator.use_rollups = False
+        interrogator.database = using
+        return interrogator
+
+    def get_source_queryset(self, interrogator_class, using='default'):
+        """The interrogation of the base tables that the summary table is built from"""
+        key = (interrogator_class, using)
+        queryset = self._sources.get(key)
+        if queryset is None:
+            queryset, errors, output_columns, base_model_data = self.get_interrogator(
+                interrogator_class, using
+            ).generate_queryset(self.base_model, self.columns, self.filters)
+            if errors:
+                raise ImproperlyConfigured("Rollup '%s' can't be built: %s" % (self.name, errors))
+            self._sources[key] = queryset
+        return queryset
+
+    def get_source_models(self) -> list:
+        """The label of every model the rollup reads from"""
+        if self._source_models is None:
+            from data_interrogator.interrogators import Interrogator
+            self._source_models = get_query_models(self.get_source_queryset(Interrogator).query)
+        return self._source_models
+
+    def get_merges(self, queryset, interrogator):
+        """How each aggregate is merged when a base row is added, or None if added rows can't be merged"""
+        query_columns, merges, averages = incremental.plan_columns(self.columns, interrogator.get_column_name)
+        if query_columns != self.columns or not incremental.is_mergeable(queryset.query):
+            return None
+        return merges
+
+    @property
+    def interrogator_class(self):
+        return import_string(self.interrogator)
+
+    def refresh(self, interrogator_class=None, using='default'):
+        """Rebuild the summary table from the base tables"""
+        interrogator_class = interrogator_class or self.interrogator_class
+        queryset = self.get_source_queryset(interrogator_class, using)
+        compiled = CompiledQuery(queryset, [], [], {})
+        fields = [
+            (name, *rollup_field(expression.output_field))
+            for name, (expression, sql, alias) in zip(compiled.names, compiled.compiler.select)
+        ]
+
+        model = None
+        connection = connections[using]
+        # The new table is swapped in inside one transaction, where the database can roll back DDL
+        with connection.schema_editor() as editor:
+            states.create(editor, using)
+            state = {
+                'version': uuid.uuid4().hex, 'fields': fields, 'models': compiled.models,
+                'merges': self.get_merges(queryset, self.get_interrogator(interrogator_class, using)),
+                'referenced': referenced_models(queryset.query),
+                'refreshed': time.time(),
+                'interrogator': class_path(interrogator_class),
+                # Anything that changes from here on makes the new rollup stale straight away
+                'changes': states.get_changes(self.name, using),
+            }
+            model = self.get_model(state)
+            if self.db_table in connection.introspection.table_names():
+                editor.execute(editor.sql_delete_table % {'table': editor.quote_name(self.db_table)})
+            editor.create_model(model)
+            if compiled.sql is not None:
+                with connection.cursor() as cursor:
+                    cursor.execute('INSERT INTO %s (%s) %s' % (
+                        editor.quote_name(self.db_table),
+                        ', '.join(editor.quote_name('c%d' % i) for i in range(len(fields))),
+                        compiled.sql,
+                    ), compiled.params)
+            states.save(self.name, state, using)
+        state['stale'] = False
+        return state
+
+    def add_row(self, instance, state, using='default'):
+        """Merge the aggregates of a newly added base row into the summary table"""
+        model = self.get_model(state)
+        manager = model._default_manager.using(using)
+        columns = {name: 'di_col_%d' % i for i, (name, path, kwargs) in enumerate(state['fields'])}
+        merges = state['merges']
+        queryset = self.get_source_queryset(import_string(state['interrogator']), using)
+        for row in queryset.filter(pk=instance.pk):
+            group = {columns[name]: value for name, value in row.items() if name not in merges}
+            summary = manager.select_for_update().filter(**group).first()
+            if summary is None:
+                manager.create(**{columns[name]: value for name, value in row.items()})
+                continue
+            for name, merge in merges.items():
+                setattr(summary, columns[name], incremental.MERGE[merge](getattr(summary, columns[name]), row[name]))
+            summary.save(using=using, update_fields=[columns[name] for name in merges])
+
+    def track_change(self, sender, using, created=False, raw=False, instance=None):
+        """Keep the summary table up to date with a change to a model the rollup reads from"""
+        if created and not raw:
+            state = self.get_state(using)
+            if not self.is_fresh(state):
+                return  # It will be rebuilt anyway
+            if sender._meta.label_lower in state['referenced']:
+                return  # Nothing already summarised can refer to a new row
+            if sender._meta.label_lower == self.get_base_label() and state['merges'] is not None:
+                try:
+                    with transaction.atomic(using=using):
+                        self.add_row(instance, state, using)
+                    return
+                except Exception:
+                    pass  # Never stop the row being saved, rebuilding the rollup puts things right
+        states.mark_stale(self.name, using)
+
+    def get_base_label(self) -> str:
+        app_label, model = self.base_model.split(':', 1)
+        return '%s.%s' % (app_label.lower(), model.lower())
+
+
+def referenced_models(query) -> list:
+    """The label of every model a query only joins to through a foreign key of the rows before it"""
+    forward, reverse = set(), set()
+    for join in query.alias_map.values():
+        if isinstance(join, Join):
+            field = join.join_field
+            if getattr(field, 'concrete', False):
+                forward.add(field.related_model._meta.label_lower)
+            else:
+                reverse.add(field.related_model._meta.label_lower)
+    return sorted(forward - reverse)
+
+
+def class_path(cls) -> str:
+    return '%s.%s' % (cls.__module__, cls.__qualname__)
+
+
+def rollup_match_key(base_model, columns, filters) -> tuple:
+    return (
+        base_model.lower(),
+        tuple(sorted(c for c in columns if c)),
+        tuple(sorted(f for f in filters or [] if f)),
+    )
+
+
+_rollups = None
+_rollups_lock = threading.Lock()
+
+
+def get_rollups() -> dict:
+    """Return the rollups declared in ``INTERROGATOR_ROLLUPS``, by name"""
+    global _rollups
+    if _rollups is None:
+        with _rollups_lock:
+            _rollups = {
+                name: Rollup(name, **definition)
+                for name, definition in getattr(settings, 'INTERROGATOR_ROLLUPS', {}).items()
+            }
+    return _rollups
+
+
+def find_rollup(base_model, columns, filters, using='default', interrogator_class=None):
+    """
+    Return a fresh rollup of exactly this interrogation, built by the same interrogator class,
+    and its state, or (None, None). The state is only read for rollups that match.
+    """
+    rollups = get_rollups()
+    if not rollups:
+        return None, None
+    key = rollup_match_key(base_model, columns, filters)
+    for rollup in rollups.values():
+        if rollup.match_key == key and rollup.interrogator_class is interrogator_class:
+            state = rollup.get_state(using)
+            if rollup.is_fresh(state) and state['interrogator'] == class_path(interrogator_class):
+                return rollup, state
+    return None, None
+
+
+def track_change(sender, using='default', **kwargs):
+    """
+    Signal receiver for post_save, post_delete and m2m_changed, that merges new base rows into
+    rollups or marks them as stale. Does nothing if no rollups are declared.
+    """
+    rollups = get_rollups()
+    if not rollups or kwargs.get('action', 'post').startswith('pre'):
+        return
+    label = sender._meta.concrete_model._meta.label_lower
+    for rollup in rollups.values():
+        if label in rollup.get_source_models():
+            rollup.track_change(
+                sender, using, created=kwargs.get('created', False), raw=kwargs.get('raw', False),
+                instance=kwargs.get('instance')
+            )
+
+
+def clear_rollups(setting=None, **kwargs):
+    """Forget the declared rollups, used as a signal receiver when settings change"""
+    global _rollups
+    if setting == 'INTERROGATOR_ROLLUPS':
+        _rollups = None
@@ -0,0 +1,81 @@
+"""Choosing which database, such as a read replica, an interrogation runs against"""
+import itertools
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+from data_interrogator.db import replication_lag
+
+ROUND_ROBIN = 'round_robin'
+LEAST_LATENCY = 'least_latency'
+
+DatabaseHealth = namedtuple('DatabaseHealth', ['available', 'lag', 'latency', 'checked'])
+
+
+class DatabaseRouter:
+    """
+    Chooses between a set of database aliases. When choosing by latency, or when replicas that
+    are too far behind should be skipped, each database is checked at most once every
+    ``INTERROGATOR_DATABASE_CHECK_INTERVAL`` seconds (default 5).
+    """
+
+    def __init__(self, aliases, check_interval=None):
+        self.aliases = list(aliases)
+        if check_interval is None:
+            check_interval = getattr(settings, 'INTERROGATOR_DATABASE_CHECK_INTERVAL', 5)
+        self.check_interval = check_interval
+        self._counter = itertools.count()
+        self._health = {}
+        self._lock = threading.Lock()
+
+    def check(self, alias) -> DatabaseHealth:
+        """Return how far behind a database is and how long it takes to answer, checking again if it's been a while"""
+        health = self._health.get(alias)
+        now = time.monotonic()
+        if health is not None and now - health.checked < self.check_interval:
+            return health
+
+        started = time.perf_counter()
+        try:
+            lag = replication_lag(connections[alias])
+            health = DatabaseHealth(True, lag, time.perf_counter() - started, now)
+        except DatabaseError:
+            health = DatabaseHealth(False, None, None, now)
+        with self._lock:
+            self._health[alias] = health
+        return health
+
+    def choose(self, strategy=ROUND_ROBIN, max_lag=None, fallback='default') -> str:
+        """
+        Pick a database, leaving out any that can't be reached or are more than `max_lag` seconds
+        behind their primary. If none are left, the fallback is used.
+        """
+        candidates = self.aliases
+        if max_lag is not None or strategy == LEAST_LATENCY:
+            health = {alias: self.check(alias) for alias in self.aliases}
+            candidates = [
+                alias for alias in self.aliases
+                if health[alias].available and (max_lag is None or health[alias].lag is None or health[alias].lag <= max_lag)
+            ]
+        if not candidates:
+            return fallback
+        if strategy == LEAST_LATENCY:
+            return min(candidates, key=lambda alias: health[alias].latency)
+        return candidates[next(self._counter) % len(candidates)]
+
+
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(aliases) -> DatabaseRouter:
+    """Return the shared router for a list of database aliases"""
+    key = tuple(aliases)
+    router = _routers.get(key)
+    if router is None:
+        with _routers_lock:
+            router = _routers.setdefault(key, DatabaseRouter(key))
+    return router
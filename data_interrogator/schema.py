@@ -0,0 +1,190 @@
+"""A precomputed index of the models and fields an interrogator can see, used for autocompletion"""
+import string
+import threading
+from bisect import bisect_left
+from collections import namedtuple
+
+from django.apps import apps
+from django.core import exceptions
+
+from data_interrogator.cache import LRUCache, freeze
+
+FieldEntry = namedtuple('FieldEntry', ['name', 'related_model', 'is_relation', 'help', 'datatype'])
+
+
+def related_model_help_text(text, field) -> str:
+    """Generate help text for the fields from a related model"""
+    if not text:
+        help_text = f"Related model - {field.related_model._meta.get_verbose_name}"
+    else:
+        help_text = text.lstrip('\n').split('\n')[0]
+        remove = string.whitespace.replace(' ', '')
+        help_text = str(help_text).translate(remove)
+        help_text = ' '.join([c for c in help_text.split(' ') if c])
+
+    return help_text
+
+
+class ModelIndex:
+    """
+    The visible fields of a single model, along with a sorted array of every suffix of every
+    field name. Any substring of a field name is a prefix of one of its suffixes, so finding
+    the fields containing some text is a binary search rather than a scan of every field.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.fields = {entry.name: entry for entry in entries}
+        self._order = {entry.name: i for i, entry in enumerate(entries)}
+        self._suffixes = sorted(
+            (entry.name[i:], entry.name) for entry in entries for i in range(len(entry.name))
+        )
+
+    def search(self, text):
+        """Return the fields whose name contains the text, in model order"""
+        if not text:
+            return list(self.entries)
+        matches = set()
+        position = bisect_left(self._suffixes, (text,))
+        while position < len(self._suffixes) and self._suffixes[position][0].startswith(text):
+            matches.add(self._suffixes[position][1])
+            position += 1
+        return [self.fields[name] for name in sorted(matches, key=self._order.get)]
+
+
+class SchemaIndex:
+    """
+    Every model an interrogator can reach, mapped to the fields that it is allowed to see.
+    Models are indexed on first use (or all at once with `warm`) and never re-walked after that.
+    """
+
+    def __init__(self, interrogator):
+        self.interrogator = interrogator
+        self._models = {}
+        self._lock = threading.Lock()
+        self._excluded_models = None
+        self._forbidden_joins = LRUCache(maxsize=4096)
+
+    @property
+    def excluded_models(self) -> frozenset:
+        """Every installed model the interrogator may not join to"""
+        if self._excluded_models is None:
+            self._excluded_models = frozenset(
+                model for model in apps.get_models(include_auto_created=True)
+                if self.interrogator.is_excluded_model(model)
+            )
+        return self._excluded_models
+
+    def has_forbidden_join(self, base_model, column) -> bool:
+        """Return whether following a dundered path from a model joins to an excluded model"""
+        key = (base_model, column)
+        verdict = self._forbidden_joins.get(key)
+        if verdict is None:
+            verdict = self.find_forbidden_join(base_model, column)
+            self._forbidden_joins.set(key, verdict)
+        return verdict
+
+    def find_forbidden_join(self, base_model, column) -> bool:
+        excluded_models = self.excluded_models
+        checking_model = base_model
+        for relation in column.split('__'):
+            if checking_model:
+                try:
+                    attr = self.interrogator.get_field_by_name(checking_model, relation)
+                    if attr.related_model and attr.related_model in excluded_models:
+                        # Despite the join/field being named differently, this column is forbidden!
+                        return True
+                    checking_model = attr.related_model
+                except exceptions.FieldDoesNotExist:
+                    pass
+        return False
+
+    def build_model_index(self, model) -> ModelIndex:
+        interrogator = self.interrogator
+        entries = []
+        for field in model._meta.get_fields():
+            excluded_field = (
+                interrogator.is_excluded_field(model, field.name) or
+                interrogator.is_hidden_field(field)
+            )
+            excluded_model = field.related_model and interrogator.is_excluded_model(field.related_model)
+            if excluded_field or excluded_model:
+                continue
+
+            if field.is_relation:
+                help_text = interrogator.related_model_help_text(field.related_model.__doc__, field)
+            else:
+                help_text = str(field.help_text)
+
+            if hasattr(field, 'get_internal_type'):
+                datatype = field.get_internal_type()
+            else:
+                datatype = "Many to many relationship"
+
+            entries.append(FieldEntry(
+                name=field.name,
+                related_model=field.related_model,
+                is_relation=field.is_relation,
+                help=help_text,
+                datatype=str(datatype),
+            ))
+        return ModelIndex(entries)
+
+    def model(self, model) -> ModelIndex:
+        index = self._models.get(model)
+        if index is None:
+            index = self.build_model_index(model)
+            with self._lock:
+                self._models[model] = index
+        return index
+
+    def resolve(self, model, path):
+        """Follow a list of relation names from a model, returning None if any step isn't visible"""
+        for name in path:
+            entry = self.model(model).fields.get(name)
+            if entry is None or entry.related_model is None:
+                return None
+            model = entry.related_model
+        return model
+
+    def warm(self):
+        """Index every model the interrogator can report on, and every model reachable from them"""
+        pending = [
+            model for model in apps.get_models()
+            if self.interrogator.is_report_model(model)
+        ]
+        seen = set()
+        while pending:
+            model = pending.pop()
+            if model in seen:
+                continue
+            seen.add(model)
+            pending.extend(
+                entry.related_model for entry in self.model(model).entries if entry.related_model is not None
+            )
+        return self
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_schema_index(interrogator) -> SchemaIndex:
+    """Return the shared index for interrogators with the same class and permission rules"""
+    key = (
+        type(interrogator), freeze(interrogator.report_models),
+        freeze(interrogator.allowed), freeze(interrogator.excluded)
+    )
+    index = _indexes.get(key)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.setdefault(key, SchemaIndex(interrogator))
+    return index
+
+
+def clear_schema_indexes(setting='INSTALLED_APPS', **kwargs):
+    """Throw away every index, used as a signal receiver when models or apps change"""
+    if setting != 'INSTALLED_APPS':
+        return
+    with _indexes_lock:
+        _indexes.clear()
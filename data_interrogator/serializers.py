@@ -0,0 +1,146 @@
+"""
+JSON serialisers for interrogation results.
+
+Results are mostly long lists of rows holding decimals and dates, which the standard library
+encoder hands one at a time to `DjangoJSONEncoder.default`. These serialisers write the same
+JSON as `DjangoJSONEncoder` but look converters up by type, and can use orjson or ujson if chosen.
+"""
+import datetime
+import decimal
+import json
+import uuid
+from array import array
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.duration import duration_iso_string
+from django.utils.timezone import is_aware
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+def encode_datetime(o):
+    r = o.isoformat()
+    if o.microsecond:
+        r = r[:23] + r[26:]
+    if r.endswith('+00:00'):
+        r = r[:-6] + 'Z'
+    return r
+
+
+def encode_time(o):
+    if is_aware(o):
+        raise ValueError("JSON can't represent timezone-aware times.")
+    r = o.isoformat()
+    if o.microsecond:
+        r = r[:12]
+    return r
+
+
+django_encoder = DjangoJSONEncoder()
+
+# Converters for the values interrogations return, by exact type, matching DjangoJSONEncoder
+ENCODERS = {
+    datetime.datetime: encode_datetime,
+    datetime.date: datetime.date.isoformat,
+    datetime.time: encode_time,
+    datetime.timedelta: duration_iso_string,
+    decimal.Decimal: str,
+    uuid.UUID: str,
+    array: array.tolist,
+}
+
+
+def default(o):
+    """Convert a value the JSON backends don't handle themselves"""
+    encoder = ENCODERS.get(type(o))
+    if encoder is not None:
+        return encoder(o)
+    if numpy is not None and isinstance(o, (numpy.ndarray, numpy.generic)):
+        return o.tolist()
+    return django_encoder.default(o)
+
+
+class JSONSerializer:
+    """Serialises with the standard library's C encoder"""
+    name = 'json'
+
+    def __init__(self):
+        self.encoder = json.JSONEncoder(separators=(',', ':'), default=default)
+
+    def dumps(self, obj) -> bytes:
+        return self.encoder.encode(obj).encode('utf-8')
+
+    def iter_dumps(self, result, chunk_size=1000):
+        """Yield an interrogation result as JSON, encoding `chunk_size` rows at a time"""
+        rows = result.get('rows')
+        if not isinstance(rows, list) or not rows:
+            yield self.dumps(result)
+            return
+        rest = self.dumps({key: value for key, value in result.items() if key != 'rows'})
+        yield b'{"rows":['
+        for start in range(0, len(rows), chunk_size):
+            if start:
+                yield b','
+            yield self.dumps(rows[start:start + chunk_size])[1:-1]
+        yield b']}' if rest == b'{}' else b'],' + rest[1:]
+
+
+class OrjsonSerializer(JSONSerializer):
+    """Serialises with orjson, formatting dates the same way Django does"""
+    name = 'orjson'
+
+    def __init__(self):
+        self.options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj) -> bytes:
+        return orjson.dumps(obj, default=default, option=self.options)
+
+
+class UjsonSerializer(JSONSerializer):
+    """Serialises with ujson, which writes decimals as numbers rather than strings"""
+    name = 'ujson'
+
+    def dumps(self, obj) -> bytes:
+        return ujson.dumps(obj, default=default).encode('utf-8')
+
+
+JSON_SERIALIZERS = {
+    'json': JSONSerializer,
+    'orjson': OrjsonSerializer,
+    'ujson': UjsonSerializer,
+}
+AVAILABLE = {'json': True, 'orjson': orjson is not None, 'ujson': ujson is not None}
+
+_serializers = {}
+
+
+def get_json_serializer(name=None) -> JSONSerializer:
+    """
+    Return the serialiser named, or by ``INTERROGATOR_JSON_SERIALIZER``, the standard library by default.
+    ``'auto'`` uses orjson if it is installed and the standard library otherwise.
+    """
+    if name is None:
+        name = getattr(settings, 'INTERROGATOR_JSON_SERIALIZER', 'json')
+    if name == 'auto':
+        name = 'orjson' if AVAILABLE['orjson'] else 'json'
+    serializer = _serializers.get(name)
+    if serializer is None:
+        if not AVAILABLE.get(name):
+            raise ImproperlyConfigured("The '%s' JSON serializer isn't available" % name)
+        serializer = _serializers[name] = JSON_SERIALIZERS[name]()
+    return serializer
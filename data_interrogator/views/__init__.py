@@ -2,6 +2,8 @@
 # from .pivot import PivotTable, AdminPivotTable, pivot_table
 # from . import lookups
 
-from .views import InterrogationView, InterrogationAutocompleteUrls, InterrogationAutoComplete
+from .views import InterrogationView, InterrogationAutocompleteUrls, InterrogationAutoComplete, ExportInterrogationView, \
+    BatchInterrogationView
+from .asynchronous import AsyncInterrogationView, AsyncApiInterrogationView, AsyncInterrogationAutoComplete
 from .pivot import PivotTableView
 from . import lookups
@@ -0,0 +1,66 @@
+"""
+Async versions of the interrogation views, for sites served over ASGI (Django 4.1 or later).
+Interrogations run in a bounded pool of worker threads, so long reports can't take over every
+thread and many of them can be awaited by a single process.
+"""
+import django
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ImproperlyConfigured
+from django.views.generic import View
+
+from data_interrogator.views.views import (
+    ApiInterrogationView, InterrogationAPIAutocompleteUrls, InterrogationAutoComplete,
+    InterrogationAutocompleteUrls, InterrogationView
+)
+from data_interrogator.workers import run_in_worker
+
+
+class AsyncPermissionMixin:
+    """Run the permission test outside the event loop, as loading the user touches the database"""
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Older versions of Django would call the view and never await the coroutine it returns
+        if django.VERSION < (4, 1):
+            raise ImproperlyConfigured("%s needs Django 4.1 or later" % cls.__name__)
+        return super().as_view(**initkwargs)
+
+    async def dispatch(self, request, *args, **kwargs):
+        if not await sync_to_async(self.get_test_func())():
+            return await sync_to_async(self.handle_no_permission)()
+        return await View.dispatch(self, request, *args, **kwargs)
+
+
+class AsyncInterrogationMixin(AsyncPermissionMixin):
+    """
+    Run the synchronous view in the worker pool. If the request is cancelled, for example when
+    Django sees the client disconnect, the query the worker is running is interrupted.
+    """
+
+    async def get(self, request):
+        return await run_in_worker(super().get, request)
+
+
+class AsyncInterrogationView(AsyncInterrogationMixin, InterrogationView):
+    pass
+
+
+class AsyncApiInterrogationView(AsyncInterrogationMixin, ApiInterrogationView):
+    pass
+
+
+class AsyncInterrogationAutoComplete(AsyncPermissionMixin, InterrogationAutoComplete):
+    async def get(self, request):
+        # Suggestions come from the in-memory schema index without any queries, so answer
+        # straight away rather than waiting for a worker behind long running reports
+        return super().get(request)
+
+
+class AsyncInterrogationAutocompleteUrls(InterrogationAutocompleteUrls):
+    interrogator_view_class = AsyncInterrogationView
+    interrogator_autocomplete_class = AsyncInterrogationAutoComplete
+
+
+class AsyncInterrogationAPIAutocompleteUrls(InterrogationAPIAutocompleteUrls):
+    interrogator_view_class = AsyncApiInterrogationView
+    interrogator_autocomplete_class = AsyncInterrogationAutoComplete
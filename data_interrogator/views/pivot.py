@@ -23,6 +23,6 @@ class PivotTableView(View):
             base_model = form.cleaned_data['lead_base_model']
             filters = form.cleaned_data.get('filter_by',[])
 
-            data = PivotInterrogator(base_model=base_model,columns=columns,filters=filters,aggregators=aggregators).pivot()
+            data = PivotInterrogator(aggregators=aggregators).pivot(base_model, columns, filters)
         data['form']=form
         return render(request, self.template_name, data)
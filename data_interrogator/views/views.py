@@ -1,15 +1,19 @@
 import json
-import string
 from typing import Tuple, Union, Any, Callable
 
 from django import http
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.views.generic import View
 from django.contrib.auth.mixins import UserPassesTestMixin
 
+from data_interrogator.columnar import ColumnarJSONEncoder
+from data_interrogator.export import EXPORT_FORMATS
 from data_interrogator.forms import InvestigationForm
-from data_interrogator.interrogators import Interrogator, Allowable, normalise_field
+from data_interrogator.interrogators import Interrogator, Allowable
+from data_interrogator.jobs import FINISHED, get_job_manager
+from data_interrogator.schema import get_schema_index
+from data_interrogator.serializers import get_json_serializer
 from data_interrogator.utils import get_all_base_models
 
 
@@ -90,7 +94,13 @@ class InterrogationView(UserHasPermissionMixin, View, InterrogationMixin):
                 data = self.interrogate(request_params['base_model'],
                                         columns=request_params['columns'],
                                         filters=request_params['filters'],
-                                        order_by=request_params['order_by'])
+                                        order_by=request_params['order_by'],
+                                        page_size=request_params.get('page_size'),
+                                        page_token=request_params.get('page_token'),
+                                        total=request_params.get('total'),
+                                        columnar=request_params.get('columnar', False),
+                                        sample=request_params.get('sample'),
+                                        sample_rows=request_params.get('sample_rows'))
                 if form:
                     # Update form to use the bound form
                     form = request_params['form']
@@ -109,7 +119,12 @@ class BaseModelOptionsApi(UserHasPermissionMixin, InterrogationMixin, View):
 
 
 class ApiInterrogationView(InterrogationView):
-    """The interrogation view as a JSON view """
+    """
+    The interrogation view as a JSON view. `json_serializer` picks the JSON backend, see
+    `data_interrogator.serializers`, and `stream_json` writes the rows out a chunk at a time.
+    """
+    json_serializer = None
+    stream_json = False
 
     def get_form(self):
         return None  # This is an API, there's no form
@@ -119,12 +134,18 @@ class ApiInterrogationView(InterrogationView):
         request_data = {'filters': self.request.GET.getlist('filter_by', []),
                         'order_by': self.request.GET.getlist('sort_by', []),
                         'columns': self.request.GET.getlist('columns', []),
-                        'base_model': self.request.GET.get('lead_base_model')}
+                        'base_model': self.request.GET.get('lead_base_model'),
+                        'page_size': self.request.GET.get('page_size'),
+                        'page_token': self.request.GET.get('page_token'),
+                        'total': self.request.GET.get('total'),
+                        'columnar': self.request.GET.get('columnar') in ('1', 'true'),
+                        'sample': self.request.GET.get('sample'),
+                        'sample_rows': self.request.GET.get('sample_rows')}
 
         transformed_request = {}
 
         for param, selection in request_data.items():
-            if selection == ['']:
+            if selection in ([''], []):
                 transformed_request[param] = []
             else:
                 if type(selection) == list:
@@ -135,7 +156,159 @@ class ApiInterrogationView(InterrogationView):
         return transformed_request
 
     def render_to_response(self, data):
-        return JsonResponse(data)
+        serializer = get_json_serializer(self.json_serializer)
+        if self.stream_json:
+            return StreamingHttpResponse(serializer.iter_dumps(data), content_type='application/json')
+        return HttpResponse(serializer.dumps(data), content_type='application/json')
+
+    def get(self, request):
+        if request.GET.get('mode') == 'job':
+            return self.submit_job()
+        return super().get(request)
+
+    def submit_job(self):
+        """Queue the interrogation to run in the background, returning the job for polling"""
+        request_params = self.get_request_data()
+        if not any(c for c in request_params.get('columns', []) if c != ''):
+            return JsonResponse({'errors': ["No columns were requested"]}, status=400)
+
+        job = get_job_manager().submit(
+            self.get_interrogator(),
+            owner=get_job_owner(self.request),
+            base_model=request_params['base_model'],
+            columns=request_params['columns'],
+            filters=request_params['filters'],
+            order_by=request_params['order_by'],
+            page_size=request_params.get('page_size'),
+            page_token=request_params.get('page_token'),
+            total=request_params.get('total'),
+            columnar=request_params.get('columnar', False),
+            sample=request_params.get('sample'),
+            sample_rows=request_params.get('sample_rows')
+        )
+        return JsonResponse(describe_job(job), status=202)
+
+
+def get_job_owner(request):
+    user = getattr(request, 'user', None)
+    return user.pk if user is not None and user.is_authenticated else None
+
+
+def describe_job(job) -> dict:
+    return {k: v for k, v in job.items() if k != 'owner'}
+
+
+class InterrogationJobView(UserHasPermissionMixin, InterrogationMixin, View):
+    """
+    Reports the progress of a background interrogation, or with `action='result'` returns its rows.
+    POSTing with `action='cancel'` stops it. Jobs can only be seen by the user that started them.
+    """
+    action = 'status'
+
+    def get_job(self, job_id):
+        job = get_job_manager().get(job_id)
+        if job is None or job['owner'] != get_job_owner(self.request):
+            return None
+        return job
+
+    def get(self, request, job_id):
+        job = self.get_job(job_id)
+        if job is None:
+            return JsonResponse({'errors': ["Unknown job"]}, status=404)
+        if self.action != 'result':
+            return JsonResponse(describe_job(job))
+
+        if job['status'] != FINISHED:
+            return JsonResponse(describe_job(job), status=409)
+        result = get_job_manager().result(job_id)
+        if result is None:
+            return JsonResponse({'errors': ["The results of this job have expired"]}, status=404)
+        return JsonResponse(result, encoder=ColumnarJSONEncoder)
+
+    def post(self, request, job_id):
+        if self.action != 'cancel' or self.get_job(job_id) is None:
+            return JsonResponse({'errors': ["Unknown job"]}, status=404)
+        return JsonResponse(describe_job(get_job_manager().cancel(job_id)))
+
+
+class BatchInterrogationView(ApiInterrogationView):
+    """
+    Runs a batch of interrogations POSTed as JSON, in the form
+    `{"interrogations": [{"lead_base_model": ..., "columns": [...], "filter_by": [...], "sort_by": [...]}, ...]}`,
+    returning `{"results": [...]}` in the same order. Interrogations of the same rows that only
+    differ in their aggregates are answered with a single query.
+    """
+    http_method_names = ['post', 'options']
+    max_batch_size = 50
+    batch_params = {
+        'lead_base_model': 'base_model', 'columns': 'columns', 'filter_by': 'filters', 'sort_by': 'order_by',
+        'page_size': 'page_size', 'page_token': 'page_token', 'total': 'total',
+        'sample': 'sample', 'sample_rows': 'sample_rows',
+    }
+
+    def get_batch_item(self, item) -> dict:
+        interrogation = {}
+        for param, argument in self.batch_params.items():
+            value = item.get(param)
+            if argument in ['columns', 'filters', 'order_by']:
+                if isinstance(value, str):
+                    value = value.split(',')
+                value = [v for v in value or [] if v != '']
+            interrogation[argument] = value
+        return interrogation
+
+    def post(self, request):
+        try:
+            items = json.loads(request.body.decode('utf-8'))['interrogations']
+            interrogations = [self.get_batch_item(item) for item in items]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return JsonResponse({'errors': ["Send a JSON object with a list of interrogations"]}, status=400)
+        if len(interrogations) > self.max_batch_size:
+            return JsonResponse(
+                {'errors': ["No more than %d interrogations can be run at once" % self.max_batch_size]}, status=400
+            )
+        if not all(i['base_model'] and i['columns'] for i in interrogations):
+            return JsonResponse({'errors': ["Every interrogation needs a lead_base_model and columns"]}, status=400)
+
+        return self.render_to_response({'results': self.get_interrogator().interrogate_batch(interrogations)})
+
+
+class ExportInterrogationView(ApiInterrogationView):
+    """
+    Streams the full result of an interrogation as CSV or newline delimited JSON,
+    chosen with the `format` query parameter. Rows are read from the database in chunks
+    and written as they arrive, so memory use doesn't grow with the size of the export.
+    """
+    export_formats = EXPORT_FORMATS
+    default_format = 'csv'
+    chunk_size = 2000
+
+    def get(self, request):
+        export_format = request.GET.get('format', self.default_format)
+        if export_format not in self.export_formats:
+            return JsonResponse({'errors': ["Unknown export format '%s'" % export_format]}, status=400)
+
+        request_params = self.get_request_data()
+        if not any(c for c in request_params.get('columns', []) if c != ''):
+            return JsonResponse({'errors': ["No columns were requested"]}, status=400)
+
+        data = self.get_interrogator().stream(
+            request_params['base_model'],
+            columns=request_params['columns'],
+            filters=request_params['filters'],
+            order_by=request_params['order_by'],
+            chunk_size=self.chunk_size
+        )
+        if data['errors']:
+            return JsonResponse({'errors': [str(e) for e in data['errors']]}, status=400)
+
+        writer, content_type, extension = self.export_formats[export_format]
+        # Rows cut short by max_rows only add their warning once read, so writers end the file with it
+        response = StreamingHttpResponse(
+            writer(data['rows'], data['columns'], data['fields'], errors=data['errors']), content_type=content_type
+        )
+        response['Content-Disposition'] = 'attachment; filename="interrogation.%s"' % extension
+        return response
 
 
 class InterrogationAutoComplete(UserHasPermissionMixin, View, InterrogationMixin):
@@ -171,18 +344,6 @@ class InterrogationAutoComplete(UserHasPermissionMixin, View, InterrogationMixin
 
         return prefix, query.split('.')
 
-    def build_related_model_help_text(self, text, field) -> str:
-        """Generate help text for the fields from a related model"""
-        if not text:
-            help_text = f"Related model - {field.related_model._meta.get_verbose_name}"
-        else:
-            help_text = text.lstrip('\n').split('\n')[0]
-            remove = string.whitespace.replace(' ', '')
-            help_text = str(help_text).translate(remove)
-            help_text = ' '.join([c for c in help_text.split(' ') if c])
-
-        return help_text
-
     def get(self, request):
         interrogator = self.get_interrogator()
         model_name = request.GET.get('model', "")
@@ -200,48 +361,25 @@ class InterrogationAutoComplete(UserHasPermissionMixin, View, InterrogationMixin
 
         prefix, args = self.split_query(query)
 
-        if len(args) > 1:
-            # Jump across the dots to iteratively determine the 2nd to last field, which is the model
-            for arg in args[:-1]:
-                model = [field for field in model._meta.get_fields() if field.name == arg][0].related_model
-
-        fields = [f for f in model._meta.get_fields() if args[-1].lower() in f.name]
+        # Jump across the dots to determine the 2nd to last field, which is the model
+        index = get_schema_index(interrogator)
+        model = index.resolve(model, args[:-1])
+        if model is None:
+            return self.blank_response()
 
-        # Build list of allowed suggestions
+        # Build list of allowed suggestions, excluded fields and models are already left out of the index
         suggestions = []
-        for field in fields:
-            excluded_field = (
-                interrogator.is_excluded_field(model, normalise_field(field.name)) or
-                interrogator.is_hidden_field(field)
-            )
-            excluded_model = field.related_model and interrogator.is_excluded_model(field.related_model)
-            if excluded_field or excluded_model:
-                # If it's an excluded field or an excluded model, don't include it as suggestion
-                continue
-
+        for field in index.model(model).search(args[-1].lower()):
             field_name = '.'.join(args[:-1] + [field.name])
-
-            if field.is_relation:
-                help_text = self.build_related_model_help_text(field.related_model.__doc__, field)
-            else:
-                help_text = str(field.help_text)
-            is_relation = field.is_relation
-
-            if hasattr(field, 'get_internal_type'):
-                datatype = field.get_internal_type()
-            else:
-                datatype = "Many to many relationship"
-
-            data = {
+            suggestions.append({
                 'value': prefix + field_name,
                 'field_name': field.name,
                 'lookup': args[-1],
                 'name': field_name,
-                'is_relation': is_relation,
-                'help': help_text,
-                'datatype': str(datatype),
-            }
-            suggestions.append(data)
+                'is_relation': field.is_relation,
+                'help': field.help,
+                'datatype': field.datatype,
+            })
 
         return http.HttpResponse(
             json.dumps(suggestions),
@@ -267,6 +405,15 @@ class InterrogationAutocompleteUrls:
         self.template_name = kwargs.get('template_name', self.interrogator_view_class.template_name)
         self.test_func = kwargs.get('test_func', None)
 
+    def warm_schema_index(self):
+        """Index the fields used for autocompletion up front, rather than on the first request"""
+        from django.conf import settings
+        if getattr(settings, 'INTERROGATOR_WARM_SCHEMA_INDEX', True):
+            view = self.interrogator_autocomplete_class(
+                report_models=self.report_models, allowed=self.allowed, excluded=self.excluded
+            )
+            get_schema_index(view.get_interrogator()).warm()
+
     @property
     def urls(self):
         from django.urls import path
@@ -276,6 +423,7 @@ class InterrogationAutocompleteUrls:
             'excluded': self.excluded,
             'test_func': self.test_func
         }
+        self.warm_schema_index()
 
         return [
             path('', view=self.interrogator_view_class.as_view(template_name=self.template_name, **kwargs),
@@ -290,9 +438,13 @@ class InterrogationAPIAutocompleteUrls(InterrogationAutocompleteUrls):
         A list of URLs for an url configuration for:
             - The main interrogator view (.. as an API)
             - An autocomplete url
+            - Export, batch, base model option and background job urls
     """
     interrogator_view_class = ApiInterrogationView
     interrogator_base_model_options_class = BaseModelOptionsApi
+    interrogator_export_class = ExportInterrogationView
+    interrogator_job_class = InterrogationJobView
+    interrogator_batch_class = BatchInterrogationView
 
     @property
     def urls(self):
@@ -310,4 +462,23 @@ class InterrogationAPIAutocompleteUrls(InterrogationAutocompleteUrls):
                  view=self.interrogator_base_model_options_class.as_view(test_func=self.test_func, **kwargs),
                  name="options")
         )
+        urls.append(
+            path('export',
+                 view=self.interrogator_export_class.as_view(test_func=self.test_func, **kwargs),
+                 name="export")
+        )
+        urls += [
+            path('batch',
+                 view=self.interrogator_batch_class.as_view(test_func=self.test_func, **kwargs),
+                 name="batch"),
+            path('jobs/<job_id>',
+                 view=self.interrogator_job_class.as_view(test_func=self.test_func, **kwargs),
+                 name="job"),
+            path('jobs/<job_id>/result',
+                 view=self.interrogator_job_class.as_view(test_func=self.test_func, action='result', **kwargs),
+                 name="job_result"),
+            path('jobs/<job_id>/cancel',
+                 view=self.interrogator_job_class.as_view(test_func=self.test_func, action='cancel', **kwargs),
+                 name="job_cancel"),
+        ]
         return urls
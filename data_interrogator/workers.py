@@ -0,0 +1,80 @@
+"""A bounded pool of threads that interrogations are run in, away from the event loop or request thread"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connections
+
+from data_interrogator.db import interrupt
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Return the process wide worker pool, sized by ``INTERROGATOR_WORKERS``"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'INTERROGATOR_WORKERS', 4),
+                    thread_name_prefix='data_interrogator',
+                )
+    return _executor
+
+
+class WorkerCall:
+    """
+    A function to run in a worker thread, which can be cancelled from another thread.
+    Cancelling a call that is running interrupts the statement its database connections are running.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.connections = []
+        self._lock = threading.Lock()
+
+    def run(self):
+        with self._lock:
+            if self.cancelled:
+                return None
+            # Connections are per thread, so these are the ones this call will use
+            self.connections = [connections[alias] for alias in connections]
+
+        close_old_connections()
+        try:
+            return self.func(*self.args, **self.kwargs)
+        except DatabaseError:
+            if self.cancelled:
+                # The statement was interrupted, nobody is waiting for the result
+                return None
+            raise
+        finally:
+            with self._lock:
+                self.connections = []
+            close_old_connections()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for connection in self.connections:
+                interrupt(connection)
+
+
+async def run_in_worker(func, *args, **kwargs):
+    """
+    Await a synchronous function run in the worker pool. If the awaiting task is cancelled,
+    for example because the client disconnected, any query the function is running is interrupted.
+    """
+    call = WorkerCall(func, *args, **kwargs)
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(get_executor(), call.run)
+    except asyncio.CancelledError:
+        call.cancel()
+        raise
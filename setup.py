@@ -41,6 +41,10 @@ setup(
         'django',  # I mean obviously you'll have django installed if you want to use this.
         'django-model-utils',
     ],
+    extras_require={
+        'arrow': ['pyarrow'],
+        'fast_json': ['orjson'],
+    },
     develop_requires=[
         'pandas'
     ]
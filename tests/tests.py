@@ -1,11 +1,20 @@
+from io import StringIO
+from unittest import skipUnless
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+import django
 from django.urls import reverse
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.test.utils import setup_test_environment
 from django.utils.encoding import smart_text
 
 
 from django.db.models import F, Count, Min, Max, Sum, Value, Avg
-from data_interrogator.interrogators import Interrogator, Allowable
+from data_interrogator.interrogators import Interrogator, Allowable, PivotInterrogator
 from django.apps import apps
 from django.db.models import Case, Lookup, Sum, Transform, Q, When, F, FloatField, ExpressionWrapper
 from data_interrogator import exceptions
@@ -212,3 +221,1658 @@ class TestInterrogators(TestCase):
         self.assertTrue(results['count'] == q.count())
         self.assertEqual(results['rows'], list(q))
         self.assertTrue(results['count'] == unique_names.filter(name__icontains='Wiffle').count())
+
+
+class TestQueryCache(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        from data_interrogator.cache import clear_query_cache
+        clear_query_cache()
+
+    def test_repeat_interrogation_uses_cache(self):
+        from data_interrogator.cache import get_query_cache
+
+        report = Interrogator(
+            report_models=[('shop','SalesPerson'),],
+            allowed=Allowable.ALL_MODELS,
+            excluded=[]
+        )
+        kwargs = dict(base_model='shop:SalesPerson', columns=['name','num:=count(sale)'], filters=['name.icontains = Wiffle'])
+        first = report.interrogate(**kwargs)
+        self.assertEqual(get_query_cache().info().misses, 1)
+
+        second = Interrogator(
+            report_models=[('shop','SalesPerson'),],
+            allowed=Allowable.ALL_MODELS,
+            excluded=[]
+        ).interrogate(**kwargs)
+        self.assertEqual(get_query_cache().info().hits, 1)
+        self.assertEqual(first, second)
+        self.assertTrue(second['count'] > 0)
+
+    def test_permission_rules_are_part_of_the_key(self):
+        from data_interrogator.cache import get_query_cache
+
+        kwargs = dict(base_model='shop:Sale', columns=['product__name', 'seller__name'])
+        open_report = Interrogator(report_models=[('shop','Sale'),], allowed=Allowable.ALL_MODELS, excluded=[])
+        closed_report = Interrogator(report_models=[('shop','Sale'),], allowed=[('shop',)], excluded=[('shop','SalesPerson')])
+
+        self.assertEqual(open_report.interrogate(**kwargs)['errors'], [])
+        self.assertEqual(len(closed_report.interrogate(**kwargs)['errors']), 1)
+        self.assertEqual(get_query_cache().info().hits, 0)
+
+    def test_settings_are_part_of_the_key(self):
+        kwargs = dict(
+            base_model='shop:Branch', columns=['name', 'count(salesperson)', 'count(salesperson.sale)'], profile=True
+        )
+        rewritten = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+        joined = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+        joined.rewrite_fanout = False
+        self.assertNotEqual(
+            rewritten.interrogate(**kwargs)['stats']['sql'], joined.interrogate(**kwargs)['stats']['sql']
+        )
+
+    def test_registry_changes_clear_cache(self):
+        from django.db import models
+        from django.test.utils import isolate_apps
+        from data_interrogator.cache import get_query_cache
+
+        report = Interrogator(report_models=[('shop','SalesPerson'),], allowed=Allowable.ALL_MODELS, excluded=[])
+        report.interrogate('shop:SalesPerson', columns=['name'])
+        self.assertEqual(len(get_query_cache()), 1)
+
+        with isolate_apps('tests'):
+            class NewModel(models.Model):
+                pass
+        self.assertEqual(len(get_query_cache()), 0)
+
+
+class TestResultCache(TestCase):
+    fixtures = ['data.json',]
+
+    class CachingInterrogator(Interrogator):
+        result_cache_ttl = 60
+
+    def setUp(self):
+        from data_interrogator.cache import get_result_cache
+        get_result_cache().clear()
+        self.report = self.CachingInterrogator(
+            report_models=[('shop','SalesPerson'),],
+            allowed=Allowable.ALL_MODELS,
+            excluded=[]
+        )
+
+    def interrogate(self):
+        return self.report.interrogate('shop:SalesPerson', columns=['name','num:=count(sale)'], order_by=['name'])
+
+    def test_repeat_results_come_from_cache(self):
+        first = self.interrogate()
+        with self.assertNumQueries(0):
+            second = self.interrogate()
+        self.assertEqual(first['rows'], second['rows'])
+
+    def test_saving_a_joined_model_invalidates(self):
+        Sale = apps.get_model('shop', 'Sale')
+        first = self.interrogate()
+
+        sale = Sale.objects.filter(seller__name=first['rows'][0]['name']).first()
+        sale.delete()
+
+        second = self.interrogate()
+        self.assertEqual(second['rows'][0]['num'], first['rows'][0]['num'] - 1)
+
+    def test_writes_invalidate_without_interrogating(self):
+        from django.db.models.signals import post_save
+        from data_interrogator.cache import get_generations
+
+        def connected():
+            return any(key[0] == 'data_interrogator_invalidate_results' for key, receiver in post_save.receivers)
+
+        Sale = apps.get_model('shop', 'Sale')
+        self.assertTrue(connected())
+        before = get_generations(['shop.sale'])
+        Sale.objects.first().save()
+        self.assertNotEqual(get_generations(['shop.sale']), before)
+
+        with override_settings(INTERROGATOR_RESULT_CACHE_INVALIDATION=False):
+            self.assertFalse(connected())
+        self.assertTrue(connected())
+
+    def test_local_increments_are_not_lost(self):
+        import threading
+        from data_interrogator.cache import LocalResultCache
+
+        local = LocalResultCache()
+        local.set('count', 0)
+
+        def bump():
+            for i in range(1000):
+                local.incr('count')
+
+        threads = [threading.Thread(target=bump) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(local.get('count'), 4000)
+        with self.assertRaises(ValueError):
+            local.incr('missing')
+
+
+class TestExport(TestCase):
+    fixtures = ['data.json',]
+
+    def test_csv_export(self):
+        import csv
+        Sale = apps.get_model('shop', 'Sale')
+        response = self.client.get("/api/export?format=csv&lead_base_model=shop:Sale&columns=id,sale_price&sort_by=id")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        lines = list(csv.reader(smart_text(b''.join(response.streaming_content)).splitlines()))
+        self.assertEqual(lines[0], ['id', 'sale_price'])
+        self.assertEqual(len(lines) - 1, Sale.objects.count())
+        first = Sale.objects.order_by('id').first()
+        self.assertEqual(lines[1], [str(first.id), str(first.sale_price)])
+
+    def test_ndjson_export(self):
+        import json
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        response = self.client.get("/api/export?format=ndjson&lead_base_model=shop:SalesPerson&columns=name,count(sale)&sort_by=name")
+        self.assertEqual(response.status_code, 200)
+        rows = [json.loads(line) for line in smart_text(b''.join(response.streaming_content)).splitlines()]
+        q = SalesPerson.objects.order_by('name').values("name").annotate(num=Count('sale'))
+        self.assertEqual([(r['name'], r['count::sale']) for r in rows], [(r['name'], r['num']) for r in q])
+
+    @skipUnless(pyarrow, "Arrow exports need pyarrow")
+    def test_arrow_export(self):
+        Sale = apps.get_model('shop', 'Sale')
+        response = self.client.get(
+            "/api/export?format=arrow&lead_base_model=shop:Sale&columns=id,sale_price,sale_date,state&sort_by=id"
+        )
+        self.assertEqual(response.status_code, 200)
+        table = pyarrow.ipc.open_stream(b''.join(response.streaming_content)).read_all()
+        self.assertEqual(table.num_rows, Sale.objects.count())
+        self.assertEqual(str(table.schema.field('id').type), 'int64')
+        self.assertEqual(str(table.schema.field('sale_price').type), 'decimal128(38, 2)')
+        self.assertEqual(str(table.schema.field('sale_date').type), 'timestamp[us, tz=UTC]')
+        first = Sale.objects.order_by('id').first()
+        row = table.slice(0, 1).to_pylist()[0]
+        self.assertEqual(row['sale_price'], first.sale_price)
+        self.assertEqual(row['sale_date'], first.sale_date)
+        self.assertEqual(row['state'], first.state)
+
+    @skipUnless(pyarrow, "Parquet exports need pyarrow")
+    def test_parquet_export(self):
+        import io
+        import pyarrow.parquet
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        response = self.client.get(
+            "/api/export?format=parquet&lead_base_model=shop:SalesPerson&columns=name,num:=count(sale)&sort_by=name"
+        )
+        self.assertEqual(response.status_code, 200)
+        table = pyarrow.parquet.read_table(io.BytesIO(b''.join(response.streaming_content)))
+        q = SalesPerson.objects.order_by('name').values("name").annotate(num=Count('sale'))
+        self.assertEqual(table.to_pylist(), list(q))
+
+    def test_bad_export_format(self):
+        response = self.client.get("/api/export?format=xls&lead_base_model=shop:Sale&columns=id")
+        self.assertEqual(response.status_code, 400)
+
+    def test_cut_short_exports_say_so(self):
+        import csv
+        import io
+        import json
+        from data_interrogator.export import EXPORT_FORMATS
+
+        class LimitedInterrogator(Interrogator):
+            max_rows = 3
+
+        report = LimitedInterrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+
+        def export(export_format):
+            data = report.stream('shop:Sale', columns=['id', 'sale_price'], order_by=['id'])
+            self.assertEqual(data['errors'], [])
+            writer = EXPORT_FORMATS[export_format][0]
+            content = b''.join(
+                chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+                for chunk in writer(data['rows'], data['columns'], data['fields'], errors=data['errors'])
+            )
+            self.assertEqual(data['errors'], [report.max_rows_warning()])
+            return content
+
+        lines = list(csv.reader(export('csv').decode('utf-8').splitlines()))
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[-1], ['# ' + report.max_rows_warning()])
+
+        lines = [json.loads(line) for line in export('ndjson').decode('utf-8').splitlines()]
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[-1], {'errors': [report.max_rows_warning()]})
+
+        if pyarrow is not None:
+            from pyarrow.parquet import ParquetFile
+            reader = pyarrow.ipc.open_stream(export('arrow'))
+            batches = []
+            while True:
+                try:
+                    batches.append(reader.read_next_batch_with_custom_metadata())
+                except StopIteration:
+                    break
+            self.assertEqual(sum(batch.num_rows for batch, metadata in batches), 3)
+            self.assertEqual(json.loads(batches[-1][1][b'errors']), [report.max_rows_warning()])
+
+            parquet = ParquetFile(io.BytesIO(export('parquet')))
+            self.assertEqual(parquet.metadata.num_rows, 3)
+            self.assertEqual(json.loads(parquet.metadata.metadata[b'errors']), [report.max_rows_warning()])
+
+
+class TestKeysetPagination(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        self.report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+
+    def all_pages(self, **kwargs):
+        rows = []
+        token = None
+        while True:
+            results = self.report.interrogate(page_size=7, page_token=token, **kwargs)
+            self.assertEqual(results['errors'], [])
+            self.assertTrue(len(results['rows']) <= 7)
+            rows.extend(results['rows'])
+            token = results['next_page']
+            if token is None:
+                return rows
+
+    def test_paging_rows(self):
+        Sale = apps.get_model('shop', 'Sale')
+        rows = self.all_pages(base_model='shop:Sale', columns=['state', 'sale_price'], order_by=['-state', 'sale_price'])
+        q = Sale.objects.order_by('-state', 'sale_price', 'pk').values('state', 'sale_price')
+        self.assertEqual(rows, list(q))
+
+    def test_paging_aggregates(self):
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        rows = self.all_pages(base_model='shop:SalesPerson', columns=['name', 'num:=count(sale)'], order_by=['-num'])
+        q = SalesPerson.objects.values("name").annotate(num=Count('sale')).order_by('-num', 'name')
+        self.assertEqual(rows, list(q))
+
+    def test_bad_token(self):
+        results = self.report.interrogate('shop:Sale', columns=['state'], page_size=5, page_token='nonsense')
+        self.assertEqual(results['rows'], [])
+        self.assertEqual(results['errors'], ["The page token is invalid, please start again from the first page."])
+
+    def test_api_paging(self):
+        response = self.client.get("/api/?lead_base_model=shop:Branch&columns=name&sort_by=name&page_size=5")
+        data = response.json()
+        self.assertEqual(len(data['rows']), 5)
+        response = self.client.get("/api/", {
+            'lead_base_model': 'shop:Branch', 'columns': 'name', 'sort_by': 'name', 'page_size': 5,
+            'page_token': data['next_page']
+        })
+        Branch = apps.get_model('shop', 'Branch')
+        self.assertEqual(
+            [r['name'] for r in data['rows'] + response.json()['rows']],
+            list(Branch.objects.order_by('name', 'pk').values_list('name', flat=True))
+        )
+        self.assertIsNone(response.json()['next_page'])
+
+
+class TestTotals(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        self.report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+
+    def test_exact_total_ignores_limit(self):
+        Sale = apps.get_model('shop', 'Sale')
+        results = self.report.interrogate('shop:Sale', columns=['state', 'num:=count(id)'], limit=2, total='exact')
+        self.assertEqual(results['count'], 2)
+        self.assertEqual(results['total'], Sale.objects.values('state').distinct().count())
+        self.assertFalse(results['total_is_approximate'])
+
+    def test_exact_total_with_paging_and_filters(self):
+        Sale = apps.get_model('shop', 'Sale')
+        results = self.report.interrogate(
+            'shop:Sale', columns=['id'], filters=['state = VIC'], order_by=['id'], page_size=10, total='exact'
+        )
+        self.assertEqual(results['count'], 10)
+        self.assertEqual(results['total'], Sale.objects.filter(state='VIC').count())
+
+    def test_total_not_run_unless_asked(self):
+        results = self.report.interrogate('shop:Sale', columns=['id'], limit=2)
+        self.assertNotIn('total', results)
+
+    def test_approximate_total(self):
+        from django.db import connection
+        Sale = apps.get_model('shop', 'Sale')
+
+        # Without statistics we fall back to an exact count
+        results = self.report.interrogate('shop:Sale', columns=['id'], limit=2, total='approximate')
+        self.assertEqual(results['total'], Sale.objects.count())
+
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+            results = self.report.interrogate('shop:Sale', columns=['id'], limit=2, total='approximate')
+            self.assertTrue(results['total_is_approximate'])
+            self.assertEqual(results['total'], Sale.objects.count())
+
+
+class TestAutocomplete(TestCase):
+
+    def suggest(self, q, model='shop:SalesPerson'):
+        response = self.client.get("/api/ac", {'model': model, 'q': q})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_substring_suggestions(self):
+        names = [s['name'] for s in self.suggest('a')]
+        self.assertEqual(names, ['sale', 'name', 'branch', 'age'])
+        self.assertEqual([s['name'] for s in self.suggest('ran')], ['branch'])
+
+    def test_dotted_suggestions(self):
+        suggestions = self.suggest('count(branch.sta')
+        self.assertEqual(len(suggestions), 1)
+        self.assertEqual(suggestions[0]['value'], 'count(branch.state')
+        self.assertEqual(suggestions[0]['datatype'], 'CharField')
+        self.assertFalse(suggestions[0]['is_relation'])
+
+    def test_unknown_path(self):
+        self.assertEqual(self.suggest('nothing.here'), [])
+
+    def test_excluded_models_are_not_suggested(self):
+        from data_interrogator.schema import get_schema_index
+
+        Sale = apps.get_model('shop', 'Sale')
+        report = Interrogator(report_models=[('shop', 'Sale')], allowed=[('shop',)], excluded=[('shop', 'SalesPerson')])
+        index = get_schema_index(report).warm()
+        self.assertNotIn('seller', index.model(Sale).fields)
+        self.assertIsNone(index.resolve(Sale, ['seller']))
+        self.assertIs(index, get_schema_index(
+            Interrogator(report_models=[('shop', 'Sale')], allowed=[('shop',)], excluded=[('shop', 'SalesPerson')])
+        ))
+
+    def test_related_model_help_text_can_be_overridden(self):
+        from data_interrogator.schema import get_schema_index
+
+        class HelpfulInterrogator(Interrogator):
+            def related_model_help_text(self, text, field):
+                return 'Go to %s' % field.related_model._meta.model_name
+
+        Sale = apps.get_model('shop', 'Sale')
+        report = HelpfulInterrogator(report_models=[('shop', 'Sale')], allowed=[('shop',)], excluded=[])
+        self.assertEqual(get_schema_index(report).model(Sale).fields['seller'].help, 'Go to salesperson')
+
+
+class TestPermissionMemo(TestCase):
+
+    def test_forbidden_join_verdicts_are_remembered(self):
+        from unittest import mock
+
+        Sale = apps.get_model('shop', 'Sale')
+        report = Interrogator(report_models=[('shop', 'Sale')], allowed=[('shop',)], excluded=[('shop', 'Branch')])
+        self.assertTrue(report.has_forbidden_join('seller__branch__name', base_model=Sale))
+        self.assertFalse(report.has_forbidden_join('seller__name', base_model=Sale))
+
+        again = Interrogator(report_models=[('shop', 'Sale')], allowed=[('shop',)], excluded=[('shop', 'Branch')])
+        with mock.patch.object(Interrogator, 'get_field_by_name') as get_field:
+            self.assertTrue(again.has_forbidden_join('seller__branch__name', base_model=Sale))
+            self.assertFalse(again.has_forbidden_join('seller__name', base_model=Sale))
+        get_field.assert_not_called()
+
+    def test_rules_are_not_shared(self):
+        Sale = apps.get_model('shop', 'Sale')
+        strict = Interrogator(report_models=[('shop', 'Sale')], allowed=[('shop',)], excluded=[('shop', 'Branch')])
+        relaxed = Interrogator(report_models=[('shop', 'Sale')], allowed=[('shop',)], excluded=[])
+        self.assertTrue(strict.has_forbidden_join('seller__branch__name', base_model=Sale))
+        self.assertFalse(relaxed.has_forbidden_join('seller__branch__name', base_model=Sale))
+
+
+class TestProfiling(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        from data_interrogator.cache import clear_query_cache
+        clear_query_cache()
+
+    def test_stats_are_optional(self):
+        report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+        results = report.interrogate('shop:SalesPerson', columns=['name', 'count(sale)'])
+        self.assertNotIn('stats', results)
+
+    def test_stage_timings(self):
+        report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+        results = report.interrogate('shop:SalesPerson', columns=['name', 'count(sale)'], profile=True, explain=True)
+        stats = results['stats']
+        for stage in ['parse', 'permissions', 'compile', 'execute', 'materialise']:
+            self.assertIn(stage, stats['timings'])
+        self.assertEqual(stats['rows'], results['count'])
+        self.assertEqual(stats['query_cache'], 'miss')
+        self.assertIn('SELECT', stats['sql'])
+        self.assertTrue(stats['explain'])
+
+        stats = report.interrogate('shop:SalesPerson', columns=['name', 'count(sale)'], profile=True)['stats']
+        self.assertEqual(stats['query_cache'], 'hit')
+        self.assertNotIn('parse', stats['timings'])
+
+    def test_stats_hook(self):
+        seen = []
+
+        class HookedInterrogator(Interrogator):
+            stats_hook = seen.append
+
+        report = HookedInterrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+        results = report.interrogate('shop:Branch', columns=['name'], filters=['state = VIC'])
+        self.assertNotIn('stats', results)
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(seen[0]['base_model'], 'shop:Branch')
+        self.assertEqual(seen[0]['filters'], ['state = VIC'])
+        self.assertEqual(seen[0]['rows'], results['count'])
+
+
+class TestPivot(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        from data_interrogator.cache import clear_query_cache
+        clear_query_cache()
+
+    def pivot(self, max_sql_pivot_columns, aggregators=['sum(sale_price)'], filters=None):
+        report = PivotInterrogator(
+            aggregators=aggregators, report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[]
+        )
+        report.max_sql_pivot_columns = max_sql_pivot_columns
+        return report.pivot('shop:Sale', ['state', 'product.category'], filters=filters)
+
+    def test_pivot_matches_grouping(self):
+        Sale = apps.get_model('shop', 'Sale')
+        expected = {
+            (r['product__category'], r['state']): (r['cell'], r['total'])
+            for r in Sale.objects.values('product__category', 'state').annotate(cell=Count(1), total=Sum('sale_price'))
+        }
+
+        for max_sql_pivot_columns in [50, 0]:
+            results = self.pivot(max_sql_pivot_columns)
+            self.assertEqual(results['errors'], [])
+            cells = {
+                (category, state): (cell['count'], dict(cell['aggs'])['sum(sale_price)'])
+                for category, row in results['rows'].items()
+                for state, cell in row.items() if cell['count']
+            }
+            self.assertEqual(cells, expected)
+            states = [list(c.values())[0] for c in results['col_head']]
+            self.assertEqual(states, sorted(states))
+            for row in results['rows'].values():
+                self.assertEqual(list(row.keys()), states)
+
+    def test_filtered_headers_match(self):
+        Sale = apps.get_model('shop', 'Sale')
+        state = Sale.objects.order_by('state').values_list('state', flat=True).first()
+        headers = []
+        for max_sql_pivot_columns in [50, 0]:
+            results = self.pivot(max_sql_pivot_columns, filters=['state != %s' % state])
+            self.assertEqual(results['errors'], [])
+            headers.append([list(c.values())[0] for c in results['col_head']])
+        self.assertEqual(headers[0], headers[1])
+        self.assertNotIn(state, headers[0])
+        self.assertTrue(headers[0])
+
+    def test_empty_cells_are_not_shared(self):
+        results = self.pivot(0)
+        empty = [
+            cell for row in results['rows'].values() for cell in row.values() if not cell['count']
+        ]
+        self.assertEqual(len(set(map(id, empty))), len(empty))
+
+    def test_pivot_needs_two_columns(self):
+        report = PivotInterrogator(
+            aggregators=[], report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[]
+        )
+        self.assertTrue(report.pivot('shop:Sale', ['state'])['errors'])
+
+
+class TestWorkers(TransactionTestCase):
+    # Workers use their own connections, so they can't see data loaded in a test's transaction
+    fixtures = ['data.json',]
+
+    def test_run_in_worker(self):
+        import asyncio
+        from data_interrogator.workers import run_in_worker
+
+        report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+        results = asyncio.run(run_in_worker(report.interrogate, 'shop:Branch', columns=['name']))
+        self.assertEqual(results['errors'], [])
+
+    def test_cancelling_interrupts_query(self):
+        import time
+        from django.db import connections
+        from data_interrogator.workers import WorkerCall, get_executor
+
+        if connections['default'].vendor != 'sqlite':
+            self.skipTest("Relies on SQLite's interrupt")
+
+        def slow_query():
+            with connections['default'].cursor() as cursor:
+                cursor.execute(
+                    'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c LIMIT 10000000000) '
+                    'SELECT COUNT(*) FROM c'
+                )
+                return cursor.fetchone()
+
+        call = WorkerCall(slow_query)
+        future = get_executor().submit(call.run)
+        while not call.connections:
+            time.sleep(0.01)
+        time.sleep(0.3)
+        started = time.monotonic()
+        call.cancel()
+        self.assertIsNone(future.result(timeout=10))
+        self.assertLess(time.monotonic() - started, 5)
+
+    @skipUnless(django.VERSION >= (4, 1), "Async class based views need Django 4.1")
+    def test_async_api_view(self):
+        from asgiref.sync import async_to_sync
+        from django.test import RequestFactory
+        from data_interrogator.views import AsyncApiInterrogationView
+
+        view = AsyncApiInterrogationView.as_view(
+            report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[], test_func=lambda: True
+        )
+        request = RequestFactory().get('/api/', {'lead_base_model': 'shop:Branch', 'columns': 'name'})
+        response = async_to_sync(view)(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'rows', response.content)
+
+    @skipUnless(django.VERSION < (4, 1), "Async class based views work from Django 4.1")
+    def test_async_views_need_django_4_1(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from data_interrogator.views import AsyncApiInterrogationView
+        from data_interrogator.views.asynchronous import AsyncInterrogationAPIAutocompleteUrls
+
+        with self.assertRaises(ImproperlyConfigured):
+            AsyncApiInterrogationView.as_view()
+        with self.assertRaises(ImproperlyConfigured):
+            AsyncInterrogationAPIAutocompleteUrls().urls
+
+    def test_async_dispatch(self):
+        # Runs the async handlers directly, without the Django 4.1 as_view() support for them
+        import asyncio
+        import json
+        from django.contrib.auth.models import AnonymousUser
+        from django.test import RequestFactory
+        from data_interrogator.views import AsyncApiInterrogationView
+
+        def dispatch(test_func):
+            request = RequestFactory().get('/api/', {'lead_base_model': 'shop:Branch', 'columns': 'name'})
+            request.user = AnonymousUser()
+            view = AsyncApiInterrogationView(
+                report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[], test_func=test_func
+            )
+            view.setup(request)
+            return asyncio.run(view.dispatch(request))
+
+        response = dispatch(lambda: True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['errors'], [])
+        self.assertIn(dispatch(lambda: False).status_code, [302, 403])
+
+
+class TestJobs(TransactionTestCase):
+    # Jobs run in worker threads with their own connections, so the fixtures need to be committed
+    fixtures = ['data.json',]
+
+    def wait_for(self, job_id, timeout=10):
+        import time
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job = self.client.get('/api/jobs/%s' % job_id).json()
+            if job['status'] not in ['queued', 'running']:
+                return job
+            time.sleep(0.05)
+        self.fail("Job didn't finish")
+
+    def test_job_api(self):
+        response = self.client.get('/api/', {'mode': 'job', 'lead_base_model': 'shop:Branch', 'columns': 'name'})
+        self.assertEqual(response.status_code, 202)
+        job = self.wait_for(response.json()['id'])
+        self.assertEqual(job['status'], 'finished')
+        self.assertNotIn('owner', job)
+        self.assertIn('execute', job['timings'])
+
+        results = self.client.get('/api/jobs/%s/result' % job['id']).json()
+        expected = self.client.get('/api/', {'lead_base_model': 'shop:Branch', 'columns': 'name'}).json()
+        self.assertEqual(results['rows'], expected['rows'])
+        self.assertEqual(job['rows'], expected['count'])
+
+        self.assertEqual(self.client.post('/api/jobs/%s/cancel' % job['id']).json()['status'], 'finished')
+        self.assertEqual(self.client.get('/api/jobs/unknown').status_code, 404)
+
+    def test_jobs_with_errors_fail(self):
+        response = self.client.get('/api/', {'mode': 'job', 'lead_base_model': 'shop:Branch', 'columns': 'foo(name)'})
+        job = self.wait_for(response.json()['id'])
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(len(job['errors']), 1)
+
+    def test_jobs_are_private(self):
+        from data_interrogator.jobs import get_job_manager
+        report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+        job = get_job_manager().submit(report, owner=123, base_model='shop:Branch', columns=['name'])
+        self.assertEqual(self.client.get('/api/jobs/%s' % job['id']).status_code, 404)
+        self.assertEqual(self.client.get('/api/jobs/%s/result' % job['id']).status_code, 404)
+
+    def test_cancel_queued_job(self):
+        import threading
+        from data_interrogator.cache import LocalResultCache
+        from data_interrogator.jobs import JobManager
+
+        release = threading.Event()
+        ran = []
+
+        class Blocking:
+            def interrogate(self, **kwargs):
+                ran.append(kwargs['base_model'])
+                release.wait(10)
+                return {'rows': [], 'count': 0, 'errors': []}
+
+        manager = JobManager(store=LocalResultCache(), max_workers=1)
+        first = manager.submit(Blocking(), base_model='first')
+        second = manager.submit(Blocking(), base_model='second')
+        self.assertEqual(manager.cancel(second['id'])['status'], 'cancelled')
+        release.set()
+        manager.executor.shutdown(wait=True)
+
+        self.assertEqual(ran, ['first'])
+        self.assertEqual(manager.get(first['id'])['status'], 'finished')
+        self.assertEqual(manager.get(second['id'])['status'], 'cancelled')
+        self.assertIsNone(manager.result(second['id']))
+
+    def test_evicted_jobs_and_repeated_stages(self):
+        from data_interrogator.cache import LocalResultCache
+        from data_interrogator.jobs import JobManager
+
+        manager = JobManager(store=LocalResultCache(), max_workers=1)
+        writes = []
+        update = manager.update
+
+        def counting_update(job_id, **changes):
+            writes.append(changes)
+            return update(job_id, **changes)
+        manager.update = counting_update
+
+        class Evicting:
+            def interrogate(self, profile, **kwargs):
+                for i in range(3):
+                    with profile.stage('execute'):
+                        pass
+                manager.store.delete(manager.job_key(profile.job_id))
+                return {'rows': [], 'count': 0, 'errors': []}
+
+        # Run in this thread, so that any error is raised here
+        manager.store.set(manager.job_key('evicted'), {'id': 'evicted', 'status': 'queued'})
+        manager.run('evicted', Evicting(), {'base_model': 'shop:Branch'})
+
+        self.assertEqual([changes for changes in writes if 'stage' in changes], [{'stage': 'execute'}])
+        self.assertIsNone(manager.get('evicted'))
+        self.assertIsNone(manager.result('evicted'))
+
+
+class TestGuardRails(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        from data_interrogator.cache import clear_query_cache
+        clear_query_cache()
+
+    def test_max_rows(self):
+        Branch = apps.get_model('shop', 'Branch')
+
+        class LimitedInterrogator(Interrogator):
+            max_rows = 2
+
+        report = LimitedInterrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+        results = report.interrogate('shop:Branch', columns=['name'], order_by=['name'])
+        self.assertEqual(results['count'], 2)
+        self.assertEqual(len(results['errors']), 1)
+        self.assertEqual(
+            [r['name'] for r in results['rows']], list(Branch.objects.order_by('name').values_list('name', flat=True)[:2])
+        )
+
+        results = report.interrogate('shop:Branch', columns=['name'], page_size=5)
+        self.assertEqual(results['count'], 2)
+        self.assertIsNotNone(results['next_page'])
+
+        report.max_rows = Branch.objects.count()
+        self.assertEqual(report.interrogate('shop:Branch', columns=['name'])['errors'], [])
+
+    def test_statement_timeout(self):
+        from django.db import connection
+        from data_interrogator.db import statement_timeout
+
+        if connection.vendor != 'sqlite':
+            self.skipTest("Relies on SQLite's progress handler")
+
+        with self.assertRaises(exceptions.QueryTimeoutError):
+            with statement_timeout(connection, 0.1), connection.cursor() as cursor:
+                cursor.execute(
+                    'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c LIMIT 10000000000) '
+                    'SELECT COUNT(*) FROM c'
+                )
+
+        # The handler is removed afterwards
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+        class TimedInterrogator(Interrogator):
+            max_execution_time = 10
+
+        report = TimedInterrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+        results = report.interrogate('shop:SalesPerson', columns=['name', 'count(sale)'], total='exact')
+        self.assertEqual(results['errors'], [])
+
+    def test_statement_timeout_is_per_fetch(self):
+        import time
+        from django.db import connection
+        from data_interrogator.cache import CompiledQuery
+
+        if connection.vendor != 'sqlite':
+            self.skipTest("Relies on SQLite's progress handler")
+
+        Sale = apps.get_model('shop', 'Sale')
+        compiled = CompiledQuery(Sale.objects.values('id', 'sale_price').order_by('id'), [], ['id', 'sale_price'], {})
+        rows = 0
+        for i, row in enumerate(compiled.iterate(chunk_size=100, timeout=0.2)):
+            rows += 1
+            if i % 100 == 0 and i < 1000:
+                time.sleep(0.05)  # A slow client, the time it takes isn't spent in the database
+        self.assertEqual(rows, Sale.objects.count())
+
+    def test_query_cost(self):
+        from unittest import mock
+        from data_interrogator.cache import CompiledQuery
+
+        class CheckedInterrogator(Interrogator):
+            max_query_cost = 100
+            cost_limit_rows = 2
+
+        def estimate_cost(compiled):
+            # Pretend that only limited queries are cheap
+            return 10 if ' LIMIT ' in compiled.sql else 1000
+
+        report = CheckedInterrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+        with mock.patch.object(CompiledQuery, 'estimate_cost', estimate_cost):
+            results = report.interrogate('shop:Branch', columns=['name'])
+            self.assertEqual(results['rows'], [])
+            self.assertIn('estimated to cost 1000', results['errors'][0])
+
+            report.query_cost_action = 'limit'
+            results = report.interrogate('shop:Branch', columns=['name'])
+            self.assertEqual(results['count'], 2)
+            self.assertEqual(len(results['errors']), 1)
+
+            # Exports and incremental merges need every row, so they can't be cut down
+            results = report.stream('shop:Branch', columns=['name'])
+            self.assertEqual(list(results['rows']), [])
+            self.assertIn('estimated to cost 1000', results['errors'][0])
+            results = report.interrogate_incremental('shop:Sale', ['state', 'count(id)'], watermark='sale_date')
+            self.assertEqual(results['rows'], [])
+            self.assertIn('estimated to cost 1000', results['errors'][0])
+
+    def test_streams_and_incremental_interrogations(self):
+        class LimitedInterrogator(Interrogator):
+            max_rows = 2
+            max_execution_time = 10
+
+        report = LimitedInterrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+        results = report.stream('shop:Branch', columns=['name'], order_by=['name'], chunk_size=1)
+        self.assertEqual(results['errors'], [])
+        self.assertEqual(len(list(results['rows'])), 2)
+        self.assertEqual(results['errors'], [report.max_rows_warning()])
+
+        results = report.interrogate_incremental('shop:Sale', ['state', 'count(id)'], watermark='sale_date')
+        self.assertEqual(results['count'], 2)
+        self.assertEqual(results['errors'], [report.max_rows_warning()])
+        self.assertEqual(results['incremental']['full'], True)
+
+
+class TestDatabaseRouting(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        from data_interrogator.cache import clear_query_cache
+        clear_query_cache()
+
+    def test_interrogations_use_chosen_database(self):
+        class ReplicaInterrogator(Interrogator):
+            databases = ['default']
+
+        report = ReplicaInterrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+        results = report.interrogate('shop:Branch', columns=['name'], profile=True)
+        self.assertEqual(results['errors'], [])
+        self.assertEqual(results['stats']['database'], 'default')
+        self.assertIsNone(report.database)
+
+        with report.routed() as database:
+            self.assertEqual(database, 'default')
+            self.assertEqual(report.get_model_queryset().db, 'default')
+
+    def router(self, **health):
+        import time
+        from data_interrogator.routing import DatabaseHealth, DatabaseRouter
+
+        router = DatabaseRouter(list(health.keys()), check_interval=60)
+        for alias, (available, lag, latency) in health.items():
+            router._health[alias] = DatabaseHealth(available, lag, latency, time.monotonic())
+        return router
+
+    def test_round_robin(self):
+        router = self.router(replica_1=(True, 0, 0.1), replica_2=(True, 0, 0.1))
+        self.assertEqual([router.choose() for _ in range(4)], ['replica_1', 'replica_2', 'replica_1', 'replica_2'])
+
+    def test_least_latency(self):
+        router = self.router(replica_1=(True, 0, 0.2), replica_2=(True, 0, 0.1), replica_3=(False, None, None))
+        self.assertEqual(router.choose(strategy='least_latency'), 'replica_2')
+
+    def test_lagging_replicas_are_skipped(self):
+        router = self.router(replica_1=(True, 30, 0.1), replica_2=(True, 1, 0.1))
+        self.assertEqual({router.choose(max_lag=10) for _ in range(4)}, {'replica_2'})
+        self.assertEqual(router.choose(max_lag=0.5, fallback='primary'), 'primary')
+
+    def test_replication_lag(self):
+        from django.db import connection
+        from data_interrogator.routing import DatabaseRouter
+
+        health = DatabaseRouter(['default']).check('default')
+        self.assertTrue(health.available)
+        if connection.vendor == 'sqlite':
+            self.assertIsNone(health.lag)
+
+
+@override_settings(INTERROGATOR_ROLLUPS={
+    'sales_by_state': {
+        'base_model': 'shop:SalesPerson',
+        'columns': ['branch.state', 'total:=sum(sale.sale_price)', 'sales:=count(sale)'],
+    },
+    'sales_by_branch': {
+        'base_model': 'shop:Sale',
+        'columns': ['seller.branch.name', 'total:=sum(sale_price)', 'sales:=count(id)', 'latest:=max(sale_date)'],
+    },
+})
+class TestRollups(TransactionTestCase):
+    # Summary tables are created with a schema editor, which SQLite doesn't allow inside a test's transaction
+    fixtures = ['data.json',]
+    columns = ['branch.state', 'total:=sum(sale.sale_price)', 'sales:=count(sale)']
+
+    def setUp(self):
+        from data_interrogator.cache import clear_query_cache
+        clear_query_cache()
+        self.report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+
+    def interrogate(self, **kwargs):
+        return self.report.interrogate('shop:SalesPerson', columns=self.columns, order_by=['branch.state'], **kwargs)
+
+    def test_matching_interrogations_read_rollup(self):
+        from django.core.management import call_command
+
+        expected = self.interrogate(profile=True)
+        self.assertNotIn('rollup', expected['stats']['sql'])
+
+        call_command('refresh_rollups', stdout=StringIO())
+        results = self.interrogate(profile=True)
+        self.assertIn('data_interrogator_rollup_sales_by_state', results['stats']['sql'])
+        self.assertEqual(results['rows'], expected['rows'])
+        self.assertEqual(results['columns'], expected['columns'])
+
+        # Other interrogations still read the base tables
+        other = self.report.interrogate('shop:SalesPerson', columns=['branch.state', 'sum(sale.sale_price)'], profile=True)
+        self.assertNotIn('rollup', other['stats']['sql'])
+
+    def test_only_the_building_interrogator_reads_rollups(self):
+        from django.core.management import call_command
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        class OtherInterrogator(Interrogator):
+            pass
+
+        class RestrictedInterrogator(Interrogator):
+            def get_model_queryset(self):
+                return super().get_model_queryset().filter(age__gt=40)
+
+        call_command('refresh_rollups', stdout=StringIO())
+        with CaptureQueriesContext(connection) as queries:
+            self.interrogate(profile=True)
+        self.assertEqual(len([q for q in queries if 'data_interrogator_rollup_state' in q['sql']]), 1)
+
+        for interrogator_class in [OtherInterrogator, RestrictedInterrogator]:
+            self.report = interrogator_class(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+            with CaptureQueriesContext(connection) as queries:
+                results = self.interrogate(profile=True)
+            self.assertNotIn('rollup', results['stats']['sql'])
+            self.assertFalse([q for q in queries if 'data_interrogator_rollup_state' in q['sql']])
+
+    def test_stale_rollups_are_ignored(self):
+        from django.core.management import call_command
+
+        call_command('refresh_rollups', stdout=StringIO())
+        Sale = apps.get_model('shop', 'Sale')
+        sale = Sale.objects.first()
+        sale.sale_price += 1000
+        sale.save()
+
+        results = self.interrogate(profile=True)
+        self.assertNotIn('rollup', results['stats']['sql'])
+        self.assertIn(sale.seller.branch.state, [r['branch__state'] for r in results['rows']])
+
+        output = StringIO()
+        call_command('refresh_rollups', stdout=output)
+        self.assertIn('Refreshed sales_by_state', output.getvalue())
+        refreshed = self.interrogate(profile=True)
+        self.assertIn('rollup', refreshed['stats']['sql'])
+        self.assertEqual(refreshed['rows'], results['rows'])
+
+        output = StringIO()
+        call_command('refresh_rollups', stdout=output)
+        self.assertIn('up to date', output.getvalue())
+
+    def test_added_rows_are_merged(self):
+        from django.core.management import call_command
+        from django.utils import timezone
+        from data_interrogator.cache import get_result_cache
+
+        Sale = apps.get_model('shop', 'Sale')
+        Branch = apps.get_model('shop', 'Branch')
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        columns = ['seller.branch.name', 'total:=sum(sale_price)', 'sales:=count(id)', 'latest:=max(sale_date)']
+
+        def interrogate(use_rollups=True):
+            self.report.use_rollups = use_rollups
+            return self.report.interrogate('shop:Sale', columns=columns, order_by=['seller.branch.name'], profile=True)
+
+        call_command('refresh_rollups', 'sales_by_branch', stdout=StringIO())
+        # Rollup state is kept in the database, so every process sees it
+        get_result_cache().clear()
+
+        sale = Sale.objects.first()
+        Sale.objects.create(
+            product=sale.product, seller=sale.seller, sale_date=timezone.now(), sale_price=123, state='VIC'
+        )
+        seller = SalesPerson.objects.create(name='New', age=30, branch=Branch.objects.create(name='New', state='VIC'))
+        Sale.objects.create(product=sale.product, seller=seller, sale_date=sale.sale_date, sale_price=10, state='VIC')
+
+        results = interrogate()
+        self.assertIn('data_interrogator_rollup_sales_by_branch', results['stats']['sql'])
+        self.assertIn('New', [r['seller__branch__name'] for r in results['rows']])
+        self.assertEqual(results['rows'], interrogate(use_rollups=False)['rows'])
+
+        # Rows that change can't be merged, so the rollup is stale until it is rebuilt
+        sale.delete()
+        results = interrogate()
+        self.assertNotIn('rollup', results['stats']['sql'])
+        call_command('refresh_rollups', 'sales_by_branch', stdout=StringIO())
+        self.assertEqual(interrogate()['rows'], results['rows'])
+
+
+class TestBatch(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        from data_interrogator.cache import clear_query_cache
+        clear_query_cache()
+        self.report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+
+    def test_merged_interrogations_match_single_ones(self):
+        interrogations = [
+            {'base_model': 'shop:SalesPerson', 'columns': ['branch.state', 'sum(sale.sale_price)'], 'order_by': ['branch.state']},
+            {'base_model': 'shop:SalesPerson', 'columns': ['sales:=count(sale)', 'branch.state'], 'order_by': ['branch.state']},
+            {'base_model': 'shop:SalesPerson', 'columns': ['name'], 'filters': ['age > 30']},
+            {'base_model': 'shop:SalesPerson', 'columns': ['branch.state', 'not_a_field']},
+        ]
+        expected = [self.report.interrogate(**i) for i in interrogations]
+        results = self.report.interrogate_batch(interrogations)
+
+        self.assertEqual(len(results), len(interrogations))
+        for result, single in zip(results, expected):
+            self.assertEqual(result['rows'], single['rows'])
+            self.assertEqual([list(r) for r in result['rows']], [list(r) for r in single['rows']])
+            self.assertEqual(result['columns'], single['columns'])
+            self.assertEqual([str(e) for e in result['errors']], [str(e) for e in single['errors']])
+
+    def test_merged_interrogations_share_a_query(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        interrogations = [
+            {'base_model': 'shop:SalesPerson', 'columns': ['branch.state', 'sum(sale.sale_price)']},
+            {'base_model': 'shop:SalesPerson', 'columns': ['branch.state', 'count(sale)']},
+            {'base_model': 'shop:SalesPerson', 'columns': ['branch.state', 'max(age)']},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            self.report.interrogate_batch(interrogations)
+        selects = [q for q in queries.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(len(selects), 1)
+
+    def test_aggregates_over_other_relations_are_not_merged(self):
+        Branch = apps.get_model('shop', 'Branch')
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        self.report.rewrite_fanout = False
+        for other in ['g:=group(salesperson.sale.state)', 'm:=max(salesperson.sale.sale_date)']:
+            results = self.report.interrogate_batch([
+                {'base_model': 'shop:Branch', 'columns': ['name', 'n:=count(salesperson)'], 'order_by': ['name']},
+                {'base_model': 'shop:Branch', 'columns': ['name', other], 'order_by': ['name']},
+            ])
+            self.assertEqual(
+                [row['n'] for row in results[0]['rows']],
+                [SalesPerson.objects.filter(branch=branch).count() for branch in Branch.objects.order_by('name')]
+            )
+
+        Sale = apps.get_model('shop', 'Sale')
+        results = self.report.interrogate_batch([
+            {'base_model': 'shop:SalesPerson', 'columns': ['branch.state', 'n:=count(id)']},
+            {'base_model': 'shop:SalesPerson', 'columns': ['branch.state', 'm:=max(sale.sale_date)']},
+        ])
+        self.assertEqual(sum(row['n'] for row in results[0]['rows']), SalesPerson.objects.count())
+        self.assertEqual(
+            {row['m'] for row in results[1]['rows']},
+            {row['m'] for row in Sale.objects.values('seller__branch__state').annotate(m=Max('sale_date'))}
+        )
+
+    def test_batch_key(self):
+        key = self.report.get_batch_key
+        self.assertEqual(
+            key('shop:SalesPerson', ['branch.state', 'sum(sale.sale_price)'], ['age > 30']),
+            key('shop:salesperson', ['count(sale)', 'branch.state'], ['age > 30']),
+        )
+        self.assertNotEqual(
+            key('shop:SalesPerson', ['branch.state', 'sum(sale.sale_price)']),
+            key('shop:SalesPerson', ['branch.name', 'sum(sale.sale_price)']),
+        )
+        self.assertIsNone(key('shop:SalesPerson', ['name']))
+        self.assertIsNone(key('shop:SalesPerson', ['branch.state', 'count(sale)'], page_size=10))
+
+    def test_batch_view(self):
+        import json
+        response = self.client.post('/api/batch', json.dumps({'interrogations': [
+            {'lead_base_model': 'shop:SalesPerson', 'columns': 'branch.state,sum(sale.sale_price)'},
+            {'lead_base_model': 'shop:SalesPerson', 'columns': ['branch.state', 'count(sale)']},
+        ]}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[1]['columns'], ['branch__state', 'count::sale'])
+
+        response = self.client.post('/api/batch', 'nonsense', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class TestColumnar(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        self.report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+
+    def assertColumnsMatchRows(self, data, rows):
+        self.assertEqual(list(data), list(rows[0]))
+        for name, values in data.items():
+            self.assertEqual(list(values), [row[name] for row in rows])
+
+    def test_columns_match_rows(self):
+        kwargs = dict(
+            base_model='shop:SalesPerson', columns=['name', 'age', 'branch.state', 'num:=count(sale)'],
+            order_by=['name']
+        )
+        rows = self.report.interrogate(**kwargs)
+        results = self.report.interrogate(columnar=True, **kwargs)
+        self.assertNotIn('rows', results)
+        self.assertEqual(results['count'], rows['count'])
+        self.assertColumnsMatchRows(results['data'], rows['rows'])
+        self.assertNotIsInstance(results['data']['age'], list)
+        self.assertNotIsInstance(results['data']['num'], list)
+        self.assertIsInstance(results['data']['name'], list)
+
+    def test_columnar_paging(self):
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        names, token = [], None
+        while True:
+            results = self.report.interrogate(
+                'shop:SalesPerson', columns=['name'], order_by=['name'], page_size=7, page_token=token, columnar=True
+            )
+            self.assertEqual(list(results['data']), ['name'])
+            names.extend(results['data']['name'])
+            token = results['next_page']
+            if token is None:
+                break
+        self.assertEqual(names, list(SalesPerson.objects.order_by('name', 'pk').values_list('name', flat=True)))
+
+    def test_columnar_errors(self):
+        results = self.report.interrogate('shop:SalesPerson', columns=['not_a_field'], columnar=True)
+        self.assertEqual(results['data'], {})
+        self.assertTrue(results['errors'])
+
+    def test_api_columnar(self):
+        response = self.client.get("/api/?lead_base_model=shop:SalesPerson&columns=name,age&sort_by=name")
+        rows = response.json()['rows']
+        response = self.client.get("/api/?lead_base_model=shop:SalesPerson&columns=name,age&sort_by=name&columnar=true")
+        data = response.json()['data']
+        self.assertEqual(data, {'name': [r['name'] for r in rows], 'age': [r['age'] for r in rows]})
+
+
+class TestSerializers(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        self.report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+        self.result = self.report.interrogate(
+            'shop:Sale', columns=['id', 'sale_price', 'sale_date', 'state', 'seller.name'], order_by=['id']
+        )
+
+    def test_serializers_match_django(self):
+        import json
+        from django.core.serializers.json import DjangoJSONEncoder
+        from data_interrogator.serializers import AVAILABLE, get_json_serializer
+
+        expected = json.loads(json.dumps(self.result, cls=DjangoJSONEncoder))
+        for name in ['json', 'orjson']:
+            if not AVAILABLE[name]:
+                continue
+            serializer = get_json_serializer(name)
+            self.assertEqual(json.loads(serializer.dumps(self.result)), expected, name)
+            self.assertEqual(json.loads(b''.join(serializer.iter_dumps(self.result, chunk_size=7))), expected, name)
+
+    def test_durations_and_uuids(self):
+        import datetime
+        import decimal
+        import uuid
+        from data_interrogator.serializers import get_json_serializer
+
+        value = uuid.uuid4()
+        self.assertEqual(
+            get_json_serializer('json').dumps([datetime.timedelta(days=1, seconds=5), value, decimal.Decimal('1.50')]),
+            ('["P1DT00H00M05S","%s","1.50"]' % value).encode()
+        )
+
+    def test_standard_library_by_default(self):
+        from data_interrogator.serializers import AVAILABLE, get_json_serializer
+        self.assertEqual(get_json_serializer().name, 'json')
+        with override_settings(INTERROGATOR_JSON_SERIALIZER='auto'):
+            self.assertEqual(get_json_serializer().name, 'orjson' if AVAILABLE['orjson'] else 'json')
+
+    def test_unavailable_serializer(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from data_interrogator.serializers import get_json_serializer
+        with self.assertRaises(ImproperlyConfigured):
+            get_json_serializer('nonsense')
+
+    def test_view_serializer(self):
+        import json
+        from data_interrogator.views.views import ApiInterrogationView
+
+        view = ApiInterrogationView(json_serializer='json', stream_json=True)
+        response = view.render_to_response(self.result)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(
+            json.loads(b''.join(response.streaming_content))['rows'],
+            self.client.get("/api/?lead_base_model=shop:Sale&columns=id,sale_price,sale_date,state,seller.name&sort_by=id").json()['rows']
+        )
+
+
+class TestIndexAdvisor(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        import json
+        import tempfile
+        interrogations = [
+            {'base_model': 'shop:Sale', 'columns': ['id', 'sale_price'], 'filters': ['state = VIC'], 'order_by': ['sale_date']},
+            {'base_model': 'shop:Sale', 'columns': ['id'], 'filters': ['state = VIC'], 'order_by': ['-sale_date']},
+            {'base_model': 'shop:SalesPerson', 'columns': ['name', 'count(sale)'], 'filters': ['age > 30'], 'order_by': []},
+            {'base_model': 'shop:Sale', 'columns': ['id'], 'filters': ['seller = 1'], 'order_by': []},
+            {'base_model': 'shop:NotAModel', 'columns': ['id'], 'filters': [], 'order_by': []},
+        ]
+        self.log = tempfile.NamedTemporaryFile('w', suffix='.log', delete=False)
+        self.log.write("Not an interrogation\n")
+        for stats in interrogations:
+            self.log.write("INFO 2020-01-01 data_interrogator.stats %s\n" % json.dumps(stats))
+        self.log.close()
+
+    def tearDown(self):
+        import os
+        os.unlink(self.log.name)
+
+    def test_advisor(self):
+        from data_interrogator.advisor import advise_from_log
+
+        advisor = advise_from_log(self.log.name, Interrogator)
+        self.assertEqual(advisor.interrogations, 4)
+        self.assertEqual(advisor.failed, 1)
+        self.assertEqual(advisor.table_scans['shop_sale'], 2)
+        suggestions = {(s.label, tuple(s.fields)): s for s in advisor.suggestions()}
+        self.assertEqual(set(suggestions), {('shop.Sale', ('state', 'sale_date')), ('shop.SalesPerson', ('age',))})
+
+        sale = suggestions[('shop.Sale', ('state', 'sale_date'))]
+        self.assertEqual(sale.count, 2)
+        self.assertEqual(sale.index().fields, ['state', 'sale_date'])
+        partial = sale.partial_index()
+        self.assertEqual(partial.fields, ['sale_date'])
+        self.assertEqual(partial.condition, Q(state='VIC'))
+        self.assertIsNone(suggestions[('shop.SalesPerson', ('age',))].partial_index())
+
+    def test_resolve_path(self):
+        from data_interrogator.advisor import resolve_path
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        Sale = apps.get_model('shop', 'Sale')
+        joins, model, field, lookup = resolve_path(SalesPerson, 'sale__state__in')
+        self.assertEqual(joins, [(Sale, 'seller')])
+        self.assertEqual((model, field.name, lookup), (Sale, 'state', 'in'))
+        self.assertEqual(resolve_path(Sale, 'seller__name')[0], [])
+        self.assertIsNone(resolve_path(Sale, 'not_a_field')[2])
+
+    def test_command(self):
+        from django.core.management import call_command
+        output = StringIO()
+        call_command('suggest_indexes', self.log.name, stdout=output)
+        output = output.getvalue()
+        self.assertIn("Replayed 4 interrogations (1 couldn't be rebuilt)", output)
+        self.assertIn("shop.Sale, wanted by 2 interrogations", output)
+        self.assertIn("models.Index(fields=['state', 'sale_date'], name=", output)
+        self.assertIn("condition=models.Q(state='VIC')", output)
+
+    def test_admin_page_context(self):
+        # The test project doesn't install the admin, so only check what the page is given to show
+        from data_interrogator.admin.views import AdminIndexAdvisorView
+        view = AdminIndexAdvisorView()
+        with override_settings(INTERROGATOR_STATS_LOG=self.log.name):
+            context = view.get_context_data()
+        self.assertEqual(context['advisor'].interrogations, 4)
+        self.assertEqual(
+            [item['suggestion'].label for item in context['suggestions']], ['shop.Sale', 'shop.SalesPerson']
+        )
+        self.assertIn("condition=models.Q(state='VIC')", context['suggestions'][0]['partial_index'])
+
+        with override_settings(INTERROGATOR_STATS_LOG=self.log.name + '.missing'):
+            self.assertIn('error', view.get_context_data())
+
+
+class TestParser(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        self.report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+
+    def test_precedence(self):
+        from data_interrogator import parser
+        column = parser.parse_column('x:=a - b * c')
+        self.assertEqual(column.alias, 'x')
+        self.assertEqual(column.expression, parser.BinOp(
+            '-', parser.Field('a'), parser.BinOp('*', parser.Field('b'), parser.Field('c'))
+        ))
+        self.assertEqual(
+            parser.parse_expression('(a - b) * c'),
+            parser.BinOp('*', parser.BinOp('-', parser.Field('a'), parser.Field('b')), parser.Field('c'))
+        )
+        self.assertEqual(
+            parser.parse_expression('a - b - c'),
+            parser.BinOp('-', parser.BinOp('-', parser.Field('a'), parser.Field('b')), parser.Field('c'))
+        )
+
+    def test_not_equal_conditions(self):
+        Product = apps.get_model('shop', 'Product')
+        results = self.report.interrogate(
+            'shop:Product', columns=['name', 'other:=sumif(sale.sale_price, sale.state!=NSW)'], order_by=['name']
+        )
+        self.assertEqual(results['errors'], [])
+        q = Product.objects.order_by('name').values('name').annotate(
+            other=Sum(Case(When(~Q(sale__state='NSW'), then=F('sale__sale_price')), default=0))
+        )
+        self.assertEqual(results['rows'], list(q))
+        self.assertTrue(any(row['other'] for row in results['rows']))
+
+    def test_both_function_forms(self):
+        from data_interrogator import parser
+        self.assertEqual(
+            parser.parse_expression('sumif(sale.sale_price, sale.state.iexact=VIC)'),
+            parser.parse_expression('sumif::sale__sale_price, sale__state__iexact=VIC'),
+        )
+
+    def test_parsed_columns_are_cached(self):
+        from data_interrogator import parser
+        self.assertIs(parser.parse_column('count(sale)'), parser.parse_column('count(sale)'))
+
+    def test_math_columns(self):
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        results = self.report.interrogate(
+            'shop:SalesPerson', columns=['name', 'x:=age - age * 2', 'y:=(age - 1) * 2'], order_by=['name']
+        )
+        self.assertEqual(results['errors'], [])
+        people = SalesPerson.objects.order_by('name')
+        self.assertEqual([r['x'] for r in results['rows']], [-p.age for p in people])
+        self.assertEqual([r['y'] for r in results['rows']], [(p.age - 1) * 2 for p in people])
+
+    def test_math_in_aggregates(self):
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        results = self.report.interrogate(
+            'shop:SalesPerson', columns=['name', 'total:=sum(sale.sale_price - sale.product.cost_price * 2)'],
+            order_by=['name']
+        )
+        q = SalesPerson.objects.order_by('name').values('name').annotate(total=Sum(ExpressionWrapper(
+            F('sale__sale_price') - F('sale__product__cost_price') * 2, output_field=FloatField()
+        )))
+        self.assertEqual(results['rows'], list(q))
+
+    def test_filter_values_are_taken_as_written(self):
+        Sale = apps.get_model('shop', 'Sale')
+        results = self.report.interrogate('shop:Sale', columns=['id'], filters=['sale_price > 100.5'])
+        self.assertEqual(results['count'], Sale.objects.filter(sale_price__gt=100.5).count())
+        results = self.report.interrogate('shop:Sale', columns=['id'], filters=['sale_price > ~product.cost_price'])
+        self.assertEqual(results['count'], Sale.objects.filter(sale_price__gt=F('product__cost_price')).count())
+        results = self.report.interrogate('shop:Sale', columns=['id'], filters=['state != VIC'])
+        self.assertEqual(results['count'], Sale.objects.exclude(state='VIC').count())
+
+    def test_function_errors_are_messages(self):
+        for column in ['foo(name)', 'sum()']:
+            results = self.report.interrogate('shop:SalesPerson', columns=['name', column])
+            self.assertEqual(len(results['errors']), 1)
+            self.assertIsInstance(results['errors'][0], str)
+
+            response = self.client.get('/api/', {'lead_base_model': 'shop:SalesPerson', 'columns': 'name||' + column})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json()['errors']), 1)
+
+    def test_forbidden_fields_in_expressions(self):
+        Sale = apps.get_model('shop', 'Sale')
+        report = Interrogator(report_models=[('shop', 'Sale')], allowed=[('shop',)], excluded=[('shop', 'SalesPerson')])
+        for column in ['x:=sale_price - seller.age', 'x:=sum(sale_price) + sum(seller.age)', 'x:=sum(seller.age)']:
+            results = report.interrogate('shop:Sale', columns=['state', column])
+            self.assertEqual(len(results['errors']), 1, column)
+            self.assertIn('is forbidden', results['errors'][0])
+            self.assertTrue(all('x' not in row for row in results['rows']))
+
+        results = report.interrogate('shop:Sale', columns=['id'], filters=['sale_price > ~seller.age'])
+        self.assertEqual(results['errors'], [
+            "Filtering with the column [sale_price] is forbidden, this filter is removed from the output."
+        ])
+        results = report.interrogate('shop:Sale', columns=['state', 'n:=count(id)'], filters=['max(seller.age) > 1'])
+        self.assertEqual(len(results['errors']), 1)
+        results = report.interrogate('shop:Sale', columns=['id'], filters=['sale_price > ~product.cost_price'])
+        self.assertEqual(results['errors'], [])
+        self.assertEqual(results['count'], Sale.objects.filter(sale_price__gt=F('product__cost_price')).count())
+
+    def test_errors_have_positions(self):
+        results = self.report.interrogate('shop:SalesPerson', columns=['name', 'age - '])
+        self.assertEqual(results['errors'], ["Unexpected end of input at character 7 of 'age - '"])
+        results = self.report.interrogate('shop:SalesPerson', columns=['name'], filters=['age'])
+        self.assertEqual(len(results['errors']), 1)
+        self.assertIn("expected a comparison", results['errors'][0])
+
+
+class TestQueryShape(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        self.report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+
+    def test_canonical_paths(self):
+        from data_interrogator.interrogators import canonical_path
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        self.assertEqual(canonical_path(SalesPerson, 'sale__pk'), 'sale')
+        self.assertEqual(canonical_path(SalesPerson, 'sale__id'), 'sale')
+        self.assertEqual(canonical_path(SalesPerson, 'branch__pk'), 'branch')
+        self.assertEqual(canonical_path(SalesPerson, 'pk'), 'id')
+        self.assertEqual(canonical_path(SalesPerson, 'sale__state__iexact'), 'sale__state__iexact')
+
+    def test_identical_columns_share_an_annotation(self):
+        rows, errors, output_columns, _ = self.report.generate_queryset(
+            'shop:SalesPerson', columns=['name', 'count(sale)', 'n:=count(sale.pk)'], filters=[]
+        )
+        self.assertEqual(errors, [])
+        self.assertEqual(output_columns, ['name', 'count::sale', 'n'])
+        self.assertIsInstance(rows.query.annotations['n'], Count)
+        for row in rows:
+            self.assertEqual(row['n'], row['count::sale'])
+
+    def test_aggregate_filters_reuse_columns(self):
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        results = self.report.interrogate(
+            'shop:SalesPerson', columns=['name', 'num:=count(sale)'], filters=['count(sale.id) > 140'],
+            order_by=['name'], profile=True
+        )
+        self.assertEqual(results['errors'], [])
+        sql = results['stats']['sql']
+        self.assertNotIn('DISTINCT', sql)
+        self.assertEqual(sql.count('COUNT('), 2)  # Once selected and once in HAVING
+        q = SalesPerson.objects.values('name').annotate(num=Count('sale')).filter(num__gt=140).order_by('name')
+        self.assertEqual(results['rows'], list(q))
+
+    def test_aggregate_filters_without_a_column(self):
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        results = self.report.interrogate(
+            'shop:SalesPerson', columns=['name'], filters=['sum(sale.sale_price) > 30000', 'sum(sale.sale_price) < 40000']
+        )
+        self.assertEqual(results['errors'], [])
+        q = SalesPerson.objects.values('name').annotate(total=Sum('sale__sale_price')).filter(
+            total__gt=30000, total__lt=40000
+        )
+        self.assertEqual(sorted(r['name'] for r in results['rows']), sorted(r['name'] for r in q))
+        self.assertTrue(0 < results['count'] < SalesPerson.objects.count())
+        self.assertEqual(sorted(results['rows'][0]), ['f0sum::sale__sale_price', 'name'])
+
+    def test_not_equal_aggregate_filters(self):
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        counts = {r['name']: r['n'] for r in SalesPerson.objects.values('name').annotate(n=Count('sale'))}
+        some_count = sorted(counts.values())[len(counts) // 2]
+        expected = sorted(name for name, n in counts.items() if n != some_count)
+        self.assertTrue(expected)
+        for columns, filters in [
+            (['name'], ['count(sale) != %d' % some_count]),
+            (['name', 'n:=count(sale)'], ['n != %d' % some_count]),
+            (['name', 'n:=count(sale)'], ['count(sale) != %d' % some_count]),
+        ]:
+            results = self.report.interrogate('shop:SalesPerson', columns=columns, filters=filters)
+            self.assertEqual(results['errors'], [])
+            self.assertEqual(sorted(r['name'] for r in results['rows']), expected)
+
+
+class TestFanout(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        self.report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+
+    def test_aggregates_over_two_to_many_paths(self):
+        Branch = apps.get_model('shop', 'Branch')
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        Sale = apps.get_model('shop', 'Sale')
+        results = self.report.interrogate(
+            'shop:Branch', columns=[
+                'name', 'people:=count(salesperson)', 'sales:=count(salesperson.sale)',
+                'total:=sum(salesperson.sale.sale_price)', 'average:=avg(salesperson.sale.sale_price)',
+                'oldest:=max(salesperson.age)',
+            ], order_by=['name'], profile=True
+        )
+        self.assertEqual(results['errors'], [])
+        self.assertEqual(results['count'], Branch.objects.count())
+        self.assertNotIn('JOIN', results['stats']['sql'].split(' FROM ')[-1])
+        for row, branch in zip(results['rows'], Branch.objects.order_by('name')):
+            sales = Sale.objects.filter(seller__branch=branch).aggregate(
+                count=Count('id'), total=Sum('sale_price'), average=Avg('sale_price')
+            )
+            self.assertEqual(row['people'], SalesPerson.objects.filter(branch=branch).count())
+            self.assertEqual(row['sales'], sales['count'])
+            self.assertEqual(row['total'], sales['total'])
+            self.assertAlmostEqual(float(row['average']), float(sales['average']))
+            self.assertEqual(row['oldest'], SalesPerson.objects.filter(branch=branch).aggregate(m=Max('age'))['m'])
+
+    def test_cached_results_see_changes_to_subqueried_models(self):
+        from data_interrogator.cache import get_result_cache
+
+        class CachingInterrogator(Interrogator):
+            result_cache_ttl = 60
+
+        Sale = apps.get_model('shop', 'Sale')
+        get_result_cache().clear()
+        report = CachingInterrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+
+        def interrogate():
+            return report.interrogate(
+                'shop:Branch', columns=['name', 'people:=count(salesperson)', 'sales:=count(salesperson.sale)'],
+                order_by=['name'], profile=True
+            )
+
+        first = interrogate()
+        self.assertNotIn('JOIN', first['stats']['sql'].split(' FROM ')[-1])
+        Sale.objects.exclude(seller__branch=None).first().delete()
+        second = interrogate()
+        self.assertEqual(sum(r['sales'] for r in second['rows']), sum(r['sales'] for r in first['rows']) - 1)
+
+    def test_averages_of_whole_numbers(self):
+        Branch = apps.get_model('shop', 'Branch')
+        results = self.report.interrogate(
+            'shop:Branch', columns=['name', 'age:=avg(salesperson.age)', 'sales:=count(salesperson.sale)'],
+            order_by=['name'], profile=True
+        )
+        self.assertEqual(results['errors'], [])
+        self.assertNotIn('JOIN', results['stats']['sql'].split(' FROM ')[-1])
+        expected = Branch.objects.order_by('name').annotate(age=Avg('salesperson__age'))
+        self.assertTrue(any(branch.age != int(branch.age) for branch in expected))
+        for row, branch in zip(results['rows'], expected):
+            self.assertAlmostEqual(row['age'], branch.age)
+
+    def test_groups_of_base_rows(self):
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        Sale = apps.get_model('shop', 'Sale')
+        results = self.report.interrogate(
+            'shop:Branch', columns=['state', 'people:=count(salesperson)', 'sales:=count(salesperson.sale)'],
+            filters=['count(salesperson) > 4'], order_by=['state']
+        )
+        self.assertEqual(results['errors'], [])
+        self.assertTrue(results['rows'])
+        for row in results['rows']:
+            people = SalesPerson.objects.filter(branch__state=row['state']).count()
+            self.assertGreater(people, 4)
+            self.assertEqual(row['people'], people)
+            self.assertEqual(row['sales'], Sale.objects.filter(seller__branch__state=row['state']).count())
+
+    def test_single_to_many_path_is_joined(self):
+        rows, errors, output_columns, _ = self.report.generate_queryset(
+            'shop:SalesPerson', columns=['name', 'count(sale)', 'sum(sale.sale_price)'], filters=[]
+        )
+        self.assertIsInstance(rows.query.annotations['count::sale'], Count)
+        self.assertIn('JOIN', str(rows.query))
+
+
+class TestSampling(TestCase):
+    fixtures = ['data.json',]
+
+    def setUp(self):
+        self.report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+
+    def test_sums_and_counts_are_scaled(self):
+        results = self.report.interrogate(
+            'shop:Sale', columns=['state', 'count(id)', 'sum(sale_price)', 'max(sale_price)'], sample=50, profile=True
+        )
+        self.assertEqual(results['errors'], [])
+        self.assertEqual(results['sample'], {'percent': 50.0, 'scaled': ['count::id', 'sum::sale_price']})
+        self.assertIn('RANDOM()', results['stats']['sql'])
+        for row in results['rows']:
+            self.assertEqual(row['count::id'] % 2, 0)
+            self.assertLessEqual(row['max::sale_price'], 230)
+
+    def test_related_rows_are_not_scaled(self):
+        SalesPerson = apps.get_model('shop', 'SalesPerson')
+        results = self.report.interrogate(
+            'shop:SalesPerson', columns=['id', 'sales:=count(sale)', 'total:=sum(sale.sale_price)'], sample=50
+        )
+        self.assertEqual(results['errors'], [])
+        self.assertEqual(results['sample']['scaled'], [])
+        self.assertTrue(results['rows'])
+        expected = SalesPerson.objects.annotate(sales=Count('sale'), total=Sum('sale__sale_price')).in_bulk()
+        for row in results['rows']:
+            self.assertEqual(row['sales'], expected[row['id']].sales)
+            self.assertEqual(row['total'], expected[row['id']].total)
+
+    def test_row_budget(self):
+        Sale = apps.get_model('shop', 'Sale')
+        results = self.report.interrogate('shop:Sale', columns=['state', 'count(id)'], sample_rows=500)
+        self.assertEqual(results['errors'], [])
+        self.assertAlmostEqual(results['sample']['percent'], 50000.0 / Sale.objects.count(), places=3)
+
+        results = self.report.interrogate('shop:Sale', columns=['state', 'count(id)'], sample_rows=10 ** 9)
+        self.assertNotIn('sample', results)
+        self.assertEqual(sum(r['count::id'] for r in results['rows']), Sale.objects.count())
+
+    def test_invalid_samples(self):
+        for sample in ('x', -5):
+            results = self.report.interrogate('shop:Sale', columns=['state', 'count(id)'], sample=sample)
+            self.assertEqual(
+                results['errors'], ["Sample must be a percentage, or a number of rows, greater than zero"]
+            )
+
+    def test_tablesample_on_postgres(self):
+        from data_interrogator.db import SampledTable
+        compiler = apps.get_model('shop', 'Sale').objects.all().query.get_compiler('default')
+        table = SampledTable('shop_sale', 'T2', 10, method='BERNOULLI')
+        self.assertEqual(table.as_postgresql(compiler, None), ('"shop_sale" T2 TABLESAMPLE BERNOULLI (%s)', [10]))
+        self.assertEqual(table.relabeled_clone({'T2': 'T3'}).percent, 10)
+
+
+class TestIncremental(TestCase):
+    fixtures = ['data.json',]
+
+    columns = ['state', 'count(id)', 'total:=sum(sale_price)', 'avg(sale_price)', 'min(sale_price)', 'max(sale_date)']
+
+    def setUp(self):
+        self.report = Interrogator(report_models=Allowable.ALL_MODELS, allowed=Allowable.ALL_MODELS, excluded=[])
+
+    def assertSameRows(self, rows, expected):
+        self.assertEqual(len(rows), len(expected))
+        for row, other in zip(rows, expected):
+            self.assertEqual(list(row), list(other))
+            for key, value in row.items():
+                if key.startswith('avg'):
+                    self.assertAlmostEqual(float(value), float(other[key]))
+                else:
+                    self.assertEqual(value, other[key])
+
+    def interrogate(self, **kwargs):
+        return self.report.interrogate_incremental(
+            'shop:Sale', self.columns, 'sale_date', filters=['sale_price > 20'], order_by=['state'], **kwargs
+        )
+
+    def test_new_rows_are_merged(self):
+        import datetime
+        Sale = apps.get_model('shop', 'Sale')
+        first = self.interrogate(refresh=True)
+        self.assertEqual(first['errors'], [])
+        self.assertTrue(first['incremental']['full'])
+        full = self.report.interrogate('shop:Sale', self.columns, filters=['sale_price > 20'], order_by=['state'])
+        self.assertEqual(first['columns'], full['columns'])
+        self.assertSameRows(first['rows'], full['rows'])
+
+        latest = Sale.objects.order_by('-sale_date').first()
+        later = latest.sale_date + datetime.timedelta(days=1)
+        for state, price in [('VIC', 300), ('VIC', 5), ('ZZZ', 50)]:
+            Sale.objects.create(
+                product=latest.product, seller=latest.seller, sale_date=later, sale_price=price, state=state
+            )
+
+        second = self.interrogate()
+        self.assertEqual(second['incremental'], {'watermark': later, 'full': False})
+        full = self.report.interrogate('shop:Sale', self.columns, filters=['sale_price > 20'], order_by=['state'])
+        self.assertSameRows(second['rows'], full['rows'])
+        self.assertEqual(second['rows'][-1]['state'], 'ZZZ')
+
+    def test_unmergeable_interrogations_run_in_full(self):
+        results = self.report.interrogate_incremental(
+            'shop:SalesPerson', ['name', 'count(sale)'], 'age', order_by=['name']
+        )
+        self.assertIsNone(results['incremental'])
+        self.assertEqual(results['errors'], [])
+        names = apps.get_model('shop', 'SalesPerson').objects.values('name').distinct()
+        self.assertEqual(len(results['rows']), names.count())
+
+        results = self.report.interrogate_incremental('shop:Sale', ['state', 'group(state)'], 'sale_date')
+        self.assertIsNone(results['incremental'])
+
+        results = self.report.interrogate_incremental('shop:Sale', self.columns, 'product')
+        self.assertIsNone(results['incremental'])
+        self.assertEqual(results['errors'], ["The watermark [product] isn't a column of the base model"])
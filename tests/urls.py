@@ -1,6 +1,12 @@
 from django.urls import include, path
 from data_interrogator import views
 from data_interrogator.interrogators import Allowable
+from data_interrogator.views.views import InterrogationAPIAutocompleteUrls
+
+
+def allow_all_users():
+    return True
+
 
 urlpatterns = [
     path(r'data/', include(views.InterrogationAutocompleteUrls(
@@ -9,4 +15,10 @@ urlpatterns = [
         excluded=[],
         template_name="test_table_display.html"
     ).urls)),
+    path(r'api/', include(InterrogationAPIAutocompleteUrls(
+        report_models=Allowable.ALL_MODELS,
+        allowed=Allowable.ALL_MODELS,
+        excluded=[],
+        test_func=allow_all_users
+    ).urls)),
 ]